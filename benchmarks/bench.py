@@ -0,0 +1,337 @@
+"""Benchmark of the conversion endpoints.
+
+Starts the PDF server and a fixture HTTP server serving the document corpus
+on local ports, drives the conversion endpoints at the given concurrency and
+prints the results as JSON. Nothing is fetched from the network.
+
+Usage:
+    ./bin/python benchmarks/bench.py --concurrency 4 --requests 20 --output results.json
+
+Compare the results of two versions with the same arguments on the same
+machine.
+"""
+from aiohttp import web
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from pdfserver import server
+from pdfserver.presets import PRESETS
+import aiohttp
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import struct
+import sys
+import threading
+import time
+import zlib
+
+
+ENDPOINTS = ('convert', 'convert_sync', 'convert-html', 'convert-html_sync')
+DOCUMENTS = ('small', 'images', 'tables', 'long', 'split')
+# Documents rendered in chunks, with their split selector
+SPLIT = {'split': 'section'}
+
+STYLESHEET = """
+body { font-family: sans-serif; font-size: 10pt; }
+h1 { color: #245; }
+table { border-collapse: collapse; width: 100%; }
+td, th { border: 1px solid #999; padding: 2pt 4pt; }
+img { width: 45%; margin: 2pt; }
+"""
+
+
+def png(width, height, seed):
+    """A PNG image with a gradient, generated without image libraries."""
+    rows = b''.join(
+        b'\0' + bytes(
+            value
+            for x in range(width)
+            for value in ((x * seed) % 256, (y * 7 + seed) % 256, (x + y) % 256)
+        )
+        for y in range(height)
+    )
+
+    def chunk(kind, data):
+        return (
+            struct.pack('>I', len(data)) + kind + data
+            + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+        )
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (
+        b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+        + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+    )
+
+
+def document(kind, base_url):
+    """HTML of a corpus document. Images are served by the fixture server."""
+    head = f'<title>{kind}</title>'
+    if kind == 'small':
+        body = '<h1>Invoice</h1>' + '<p>Lorem ipsum dolor sit amet, consectetur.</p>' * 5
+    elif kind == 'images':
+        body = '<h1>Images</h1>' + ''.join(
+            f'<img src="{base_url}/image/{index}.png">' for index in range(24)
+        )
+    elif kind == 'tables':
+        rows = ''.join(
+            f'<tr><td>{row}</td>' + ''.join(f'<td>{row * col}</td>' for col in range(8)) + '</tr>'
+            for row in range(600)
+        )
+        body = f'<h1>Tables</h1><table><tr><th>#</th>{"<th>col</th>" * 8}</tr>{rows}</table>'
+    elif kind == 'long':
+        body = chapters(range(200))
+    elif kind == 'split':
+        # The long document in 8 parts, with page numbers
+        head += '<style>@page { @bottom-center { content: counter(page) } }</style>'
+        body = ''.join(
+            f'<section>{chapters(range(part * 25, (part + 1) * 25))}</section>' for part in range(8)
+        )
+    else:
+        raise ValueError(f'Unknown document: {kind}')
+    return f'<!DOCTYPE html><html><head>{head}</head><body>{body}</body></html>'
+
+
+def chapters(numbers):
+    """One page long chapters."""
+    return ''.join(
+        f'<h1 style="break-before: page">Chapter {number}</h1>'
+        + '<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>' * 6
+        for number in numbers
+    )
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves the corpus documents, the stylesheet and the images."""
+
+    protocol_version = 'HTTP/1.1'
+    images = {}
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        base_url = f'http://{self.headers["Host"]}'
+        if path.startswith('/doc/'):
+            body = document(path[len('/doc/'):], base_url).encode()
+            content_type = 'text/html; charset=utf-8'
+        elif path == '/style.css':
+            body = STYLESHEET.encode()
+            content_type = 'text/css'
+        elif path.startswith('/image/'):
+            seed = int(path[len('/image/'):].split('.')[0]) + 1
+            if seed not in self.images:
+                self.images[seed] = png(160, 120, seed)
+            body = self.images[seed]
+            content_type = 'image/png'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def rss(pid):
+    """Resident memory of a process in bytes (Linux), or 0."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+async def sample_memory(peak):
+    """Track the peak resident memory of the server and its render workers."""
+    while True:
+        pids = [os.getpid()] + [
+            worker.process.pid for worker in server.render_engine._workers
+            if worker.process is not None
+        ]
+        peak[0] = max(peak[0], sum(rss(pid) for pid in pids))
+        await asyncio.sleep(0.05)
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+async def convert(session, base, endpoint, payload):
+    """Run one conversion, return the (status, PDF size) of the download."""
+    async with session.post(f'{base}/{endpoint}', json=payload) as resp:
+        if endpoint.endswith('_sync'):
+            return resp.status, len(await resp.read())
+        if resp.status != 200:
+            return resp.status, 0
+        uid = (await resp.json())['uid']
+
+    while True:
+        async with session.get(f'{base}/status/{uid}') as resp:
+            status = await resp.json()
+        if status['status'] == 'completed':
+            break
+        if status['status'] == 'failed':
+            return 500, 0
+        await asyncio.sleep(0.02)
+    async with session.get(f'{base}{status["download"]}') as resp:
+        return resp.status, len(await resp.read())
+
+
+def payload(endpoint, kind, fixture_url, number, reuse, preset='default'):
+    # Unique requests, unless results may be reused
+    marker = '' if reuse else f'?n={number}'
+    if endpoint.startswith('convert-html'):
+        html = document(kind, fixture_url)
+        if not reuse:
+            html += f'<!-- {number} -->'
+        data = {'html': html, 'css': STYLESHEET, 'preset': preset}
+    else:
+        data = {
+            'url': f'{fixture_url}/doc/{kind}{marker}',
+            'css': [f'{fixture_url}/style.css'],
+            'preset': preset,
+        }
+    if kind in SPLIT:
+        data['split'] = SPLIT[kind]
+    return data
+
+
+async def run_scenario(session, base, fixture_url, endpoint, kind, preset, args, counter):
+    latencies = []
+    sizes = []
+    errors = {}
+    peak = [0]
+    pending = iter(range(args.requests))
+
+    async def client():
+        for _ in pending:
+            number = next(counter)
+            start = time.perf_counter()
+            status, size = await convert(
+                session, base, endpoint,
+                payload(endpoint, kind, fixture_url, number, args.reuse, preset),
+            )
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+                sizes.append(size)
+            else:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+    sampler = asyncio.create_task(sample_memory(peak))
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+
+    return {
+        'endpoint': endpoint,
+        'document': kind,
+        'preset': preset,
+        'concurrency': args.concurrency,
+        'requests': args.requests,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 3),
+        'latency': {
+            name: None if value is None else round(value, 4)
+            for name, value in (
+                ('p50', percentile(latencies, 50)),
+                ('p95', percentile(latencies, 95)),
+                ('p99', percentile(latencies, 99)),
+                ('mean', statistics.mean(latencies) if latencies else None),
+            )
+        },
+        'peak_rss': peak[0],
+        'output_size': round(statistics.mean(sizes)) if sizes else None,
+    }
+
+
+async def benchmark(args):
+    fixture = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    threading.Thread(target=fixture.serve_forever, daemon=True).start()
+    fixture_url = f'http://127.0.0.1:{fixture.server_address[1]}'
+
+    app = await server.init()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    base = f'http://127.0.0.1:{runner.addresses[0][1]}'
+
+    results = []
+    counter = iter(range(sys.maxsize))
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+            # Start the workers and fill their caches
+            for endpoint in args.endpoints:
+                await convert(session, base, endpoint, payload(endpoint, 'small', fixture_url, -1, False))
+            for kind in args.documents:
+                for endpoint in args.endpoints:
+                    for preset in args.presets:
+                        result = await run_scenario(
+                            session, base, fixture_url, endpoint, kind, preset, args, counter
+                        )
+                        print(
+                            f"{endpoint:18} {kind:7} {preset:8} "
+                            f"{result['throughput']:8.2f} req/s  "
+                            f"p95 {result['latency']['p95']}s  {result['output_size']} bytes",
+                            file=sys.stderr,
+                        )
+                        results.append(result)
+    finally:
+        await runner.cleanup()
+        fixture.shutdown()
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'workers': server.render_engine.size,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--concurrency', type=int, default=4, help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=20, help='Requests per scenario')
+    parser.add_argument(
+        '--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS),
+    )
+    parser.add_argument(
+        '--documents', nargs='+', choices=DOCUMENTS, default=list(DOCUMENTS),
+    )
+    parser.add_argument(
+        '--presets', nargs='+', choices=list(PRESETS), default=['default'],
+        help='Output presets to compare',
+    )
+    parser.add_argument(
+        '--reuse', action='store_true', help='Send identical requests, allowing result reuse',
+    )
+    parser.add_argument('--output', help='Write the JSON results to this file')
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Named stylesheet bundles.
+
+Bundles are read from the JSON file in ``config.STYLESHEET_BUNDLES`` when
+the server starts. Every render worker parses them once (see
+``pdfserver.worker.init_worker``), requests refer to them by name with
+``css_profile``. The file maps names to lists of sources: URLs, paths
+relative to the file, or objects with inline ``css``::
+
+    {
+        "corporate-a4": [
+            "https://cdn.example.com/corporate.css",
+            "a4.css",
+            {"css": "@page { size: A4; margin: 2cm }"}
+        ]
+    }
+"""
+from pdfserver import config
+from pdfserver.fetcher import basic_auth_url_fetcher
+from pdfserver.fetcher import read_result
+from pdfserver.log import logger
+import hashlib
+import json
+import os
+
+
+# name -> StylesheetBundle, filled by register_bundles()
+BUNDLES = {}
+
+
+class StylesheetBundle:
+    """The stylesheets of a bundle as (css, base_url) tuples, and a digest
+    of their content for the result cache key.
+    """
+
+    def __init__(self, name, sources):
+        self.name = name
+        self.sources = sources
+        digest = hashlib.sha256()
+        for css, base_url in sources:
+            digest.update(f'{base_url}\0{css}\0'.encode())
+        self.digest = digest.hexdigest()
+
+
+def read_source(source, directory):
+    """Return the (css, base_url) of a bundle source."""
+    if isinstance(source, dict) and isinstance(source.get('css'), str):
+        return source['css'], None
+    if not isinstance(source, str):
+        raise ValueError(f"Invalid stylesheet source: {source!r}")
+    if source.startswith(('http://', 'https://')):
+        result = basic_auth_url_fetcher(source)
+        css = read_result(result).decode(result.get('encoding') or 'utf-8')
+        return css, result['redirected_url']
+    path = os.path.join(directory, source)
+    with open(path, encoding='utf-8') as f:
+        return f.read(), path
+
+
+def load_bundles(path):
+    """Read the bundles defined in the JSON file at ``path``.
+
+    :return: A dict of name -> :class:`StylesheetBundle`.
+    :raises ValueError: If the file is not a valid bundle definition.
+    """
+    with open(path, encoding='utf-8') as f:
+        definitions = json.load(f)
+    if not isinstance(definitions, dict):
+        raise ValueError(f"{path} must map bundle names to lists of stylesheets")
+    directory = os.path.dirname(os.path.abspath(path))
+    bundles = {}
+    for name, sources in definitions.items():
+        if not isinstance(sources, list):
+            raise ValueError(f"Bundle {name} must be a list of stylesheets")
+        bundles[name] = StylesheetBundle(
+            name, [read_source(source, directory) for source in sources]
+        )
+    return bundles
+
+
+def register_bundles(path=None):
+    """Load the bundles from ``path`` (defaults to
+    ``config.STYLESHEET_BUNDLES``) and make them available to requests.
+
+    :return: A dict of name -> list of (css, base_url) for the render
+        workers.
+    """
+    path = config.STYLESHEET_BUNDLES if path is None else path
+    BUNDLES.clear()
+    if path:
+        BUNDLES.update(load_bundles(path))
+        logger.info(f"Registered stylesheet bundles: {', '.join(BUNDLES)}")
+    return {name: bundle.sources for name, bundle in BUNDLES.items()}
+
+
+def digest(name):
+    """Digest of the bundle ``name`` for result cache keys, or None."""
+    return None if name is None else BUNDLES[name].digest
@@ -1,15 +1,87 @@
+from collections import OrderedDict
+from contextlib import suppress
+from pdfserver import config
 from pdfserver.log import logger
+from pdfserver.storage import PDFStorage
+from pdfserver.storage import write_pdf_file
 from pdfserver.utils import TaskStatus
 from uuid import uuid4
 import asyncio
+import heapq
+import itertools
+import os
 import time
 
 
+class PDFJob:
+    """Record of a conversion job and its result."""
+
+    __slots__ = (
+        'uid', 'data', 'filename', 'timestamp', 'status', 'message', 'key',
+        'content_type', 'items', 'render', 'stats', 'profile',
+    )
+
+    def __init__(self, uid):
+        self.uid = uid
+        self.data = None
+        self.filename = ''
+        self.timestamp = time.time()
+        self.status = TaskStatus.RUNNING.value
+        self.message = ''
+        self.key = None
+        self.content_type = 'application/pdf'
+        # Jobs of a batch
+        self.items = None
+        # The queued or running render, see ``pdfserver.engine``
+        self.render = None
+        # Statistics and profile of the render, see ``pdfserver.worker``
+        self.stats = None
+        self.profile = None
+
+
 class ExpiringPDFCache:
-    def __init__(self, expiry_minutes=30):
+    """Jobs and their PDFs, removed ``expiry_minutes`` after they were
+    added or completed.
+
+    Expiry times are kept in a heap, so a cleanup only touches expired
+    jobs. Completed jobs are also evicted in least recently used order once
+    their PDFs exceed ``max_bytes`` in total.
+
+    Subscribers (see :meth:`subscribe`) are notified when a job completes,
+    fails or is removed.
+
+    With a shared ``store`` (see ``pdfserver.store``), the state of every
+    job is written through to it and jobs of other server processes are
+    looked up there. PDFs are always written to the spool directory then.
+    """
+
+    def __init__(self, expiry_minutes=30, memory_budget=None, max_bytes=None, store=None):
         self.storage = {}
+        self.results = {}
+        self.pdfs = PDFStorage(memory_budget)
+        self.store = None
         self.expiry_seconds = expiry_minutes * 60
+        self.max_bytes = config.CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.evictions = 0
+        self.expirations = 0
+        self.hits = 0
+        self.misses = 0
+        self._expiry_heap = []
+        self._sequence = itertools.count()
+        self._completed = OrderedDict()
+        self._subscribers = {}
         self._cleanup_task = None
+        if store is not None:
+            self.use_store(store)
+
+    def use_store(self, store):
+        """Share the jobs with other server processes through ``store``."""
+        self.store = store
+        self.pdfs.memory_budget = 0
+
+    def _write_through(self, job):
+        if self.store is not None:
+            self.store.put(job, job.timestamp + self.expiry_seconds)
 
     async def start_cleanup_task(self):
         if self._cleanup_task is None:
@@ -34,46 +106,209 @@ class ExpiringPDFCache:
             except Exception as e:
                 logger.error(f"Error in cleanup loop: {e}")
 
+    def _schedule_expiry(self, job):
+        heapq.heappush(
+            self._expiry_heap,
+            (job.timestamp + self.expiry_seconds, next(self._sequence), job.uid, job.timestamp),
+        )
+
+    def subscribe(self, uids):
+        """Subscribe to state changes of the jobs ``uids``.
+
+        :return: An ``asyncio.Queue`` receiving the uid of every job which
+            changed. Pass it to :meth:`unsubscribe` when done.
+        """
+        queue = asyncio.Queue()
+        for uid in uids:
+            self._subscribers.setdefault(uid, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, uids, queue):
+        for uid in uids:
+            subscribers = self._subscribers.get(uid)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self._subscribers[uid]
+
+    def _notify(self, uid):
+        for queue in self._subscribers.get(uid, ()):
+            queue.put_nowait(uid)
+
+    def _remove(self, uid):
+        job = self.storage.pop(uid)
+        self._completed.pop(uid, None)
+        if job.key is not None and self.results.get(job.key) == uid:
+            del self.results[job.key]
+        if job.data is not None:
+            self.pdfs.remove(job.data)
+        if job.profile is not None:
+            with suppress(FileNotFoundError):
+                os.unlink(job.profile)
+        if self.store is not None:
+            self.store.delete(uid)
+        self._notify(uid)
+        return job
+
     async def _remove_expired(self):
         """Remove expired PDFs from cache"""
         current_time = time.time()
-        expired_keys = [
-            key for key, pdf in self.storage.items()
-            if current_time - pdf['timestamp'] > self.expiry_seconds
-        ]
+        expired = 0
+        while self._expiry_heap and self._expiry_heap[0][0] < current_time:
+            _, _, uid, timestamp = heapq.heappop(self._expiry_heap)
+            job = self.storage.get(uid)
+            if job is None or job.timestamp != timestamp:
+                # Removed already, or rescheduled when it completed
+                continue
+            self._remove(uid)
+            expired += 1
+            logger.info(f"Removed expired PDF: {uid}")
 
-        for key in expired_keys:
-            del self.storage[key]
-            logger.info(f"Removed expired PDF: {key}")
+        if expired:
+            self.expirations += expired
+            logger.info(f"Cache cleanup: removed {expired} expired PDFs, {self.stats()}")
+        if self.store is not None:
+            self.store.remove_expired()
 
-        if expired_keys:
-            logger.info(f"Cache cleanup: removed {len(expired_keys)} expired PDFs")
+    def _evict(self):
+        while self._completed and self.pdfs.memory_bytes + self.pdfs.disk_bytes > self.max_bytes:
+            uid, _ = self._completed.popitem(last=False)
+            self._remove(uid)
+            self.evictions += 1
+            logger.info(f"Evicted PDF: {uid}")
 
-    def save_pdf(self, uid, filename, pdf_data):
-        """Store PDF data with current timestamp"""
-        if uid not in self.storage:
+    def stats(self):
+        return {
+            'jobs': len(self.storage),
+            'pdfs': len(self._completed),
+            'memory_bytes': self.pdfs.memory_bytes,
+            'disk_bytes': self.pdfs.disk_bytes,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def save_pdf(self, uid, filename, pdf_data, key=None, content_type=None):
+        """Store PDF data with current timestamp.
+
+        If a content address ``key`` is given, the PDF is reused for
+        identical requests (see ``find_result``). ``content_type`` is set for
+        results which are not a PDF (e.g. ZIP archives of a batch).
+        """
+        job = self.storage.get(uid)
+        if job is None:
             logger.error(f"Attempted to store PDF with unknown UID: {uid}")
             return
-        self.storage[uid]['filename'] = filename
-        self.storage[uid]['status'] = TaskStatus.COMPLETED.value
-        self.storage[uid]['timestamp'] = time.time()
-        self.storage[uid]['data'] = pdf_data
-        pdf_data.seek(0)
-        logger.info(f"Stored PDF: {uid} ({len(pdf_data.read())} bytes)")
-
-    def add(self):
+        if key is not None:
+            job.key = key
+            self.results[key] = uid
+        job.filename = filename
+        if content_type is not None:
+            job.content_type = content_type
+        job.status = TaskStatus.COMPLETED.value
+        job.timestamp = time.time()
+        job.data = pdf_data
+        job.stats = pdf_data.stats
+        job.profile = pdf_data.profile
+        self.pdfs.add(pdf_data)
+        self._schedule_expiry(job)
+        self._completed[uid] = job
+        self._write_through(job)
+        logger.info(f"Stored PDF: {uid} ({pdf_data.size} bytes)")
+        self._notify(uid)
+        self._evict()
+
+    def pin(self, pdf_data):
+        """Keep the stored ``pdf_data`` until :meth:`unpin`, even if its job
+        is removed or evicted in the meantime.
+        """
+        self.pdfs.add(pdf_data)
+
+    def unpin(self, pdf_data):
+        self.pdfs.remove(pdf_data)
+
+    def complete_batch(self, uid):
+        """Mark a batch without a combined result as completed."""
+        job = self.storage.get(uid)
+        if job is None:
+            logger.error(f"Attempted to complete unknown UID: {uid}")
+            return
+        job.status = TaskStatus.COMPLETED.value
+        job.timestamp = time.time()
+        self._schedule_expiry(job)
+        self._write_through(job)
+        self._notify(uid)
+
+    def fail_pdf(self, uid, message):
+        """Mark a job as failed."""
+        job = self.storage.get(uid)
+        if job is None:
+            logger.error(f"Attempted to fail unknown UID: {uid}")
+            return
+        job.status = TaskStatus.FAILED.value
+        job.message = message
+        self._write_through(job)
+        self._notify(uid)
+
+    async def fit_to_budget(self, pdf_data):
+        """Return ``pdf_data``, moved to the spool directory if it is kept in
+        memory but does not fit the memory budget of the cache anymore.
+        """
+        if pdf_data.path is not None or pdf_data.refs or self.pdfs.fits_in_memory(pdf_data):
+            return pdf_data
+        logger.info(f"Memory budget exhausted, writing PDF to disk ({pdf_data.size} bytes)")
+        return await asyncio.to_thread(write_pdf_file, pdf_data.data)
+
+    def add(self, filename='', items=None):
         uid = uuid4().hex
-        self.storage[uid] = {
-            'data': None,
-            'filename': '',
-            'timestamp': time.time(),
-            'status': TaskStatus.RUNNING.value,
-            'message': '',
-        }
-        return uid, self.storage[uid]
+        job = PDFJob(uid)
+        job.filename = filename
+        job.items = items
+        self.storage[uid] = job
+        self._schedule_expiry(job)
+        self._write_through(job)
+        return uid, job
+
+    def add_batch(self, filename, filenames):
+        """Add a batch job with an item job for each of ``filenames``.
+
+        :return: A (uid, job) tuple of the batch, the uids of its items are
+            in ``job.items``.
+        """
+        items = [self.add(item_filename)[0] for item_filename in filenames]
+        return self.add(filename, items)
 
     def get_pdf(self, pdf_id):
-        """Retrieve PDF data if not expired"""
-        if pdf_id not in self.storage:
+        """Retrieve PDF data if not expired. Jobs of other server processes
+        are looked up in the shared store, if any.
+        """
+        job = self.storage.get(pdf_id)
+        if job is not None and pdf_id in self._completed:
+            self._completed.move_to_end(pdf_id)
+        if job is None and self.store is not None:
+            job = self.store.get(pdf_id, PDFJob)
+        return job
+
+    def find_result(self, key):
+        """Return the PDF data of a finished render with the content
+        address ``key``, or None.
+        """
+        uid = self.results.get(key)
+        if uid not in self._completed:
+            self.results.pop(key, None)
+            self.misses += 1
             return None
-        return self.storage[pdf_id]
+        self.hits += 1
+        self._completed.move_to_end(uid)
+        return self.storage[uid].data
+
+    def store_result(self, key, filename, pdf_data):
+        """Store the result of a render which has no job of its own (e.g.
+        of a synchronous request), so identical requests can reuse it and
+        its storage is released when it expires.
+        """
+        if key is not None and self.results.get(key) in self._completed:
+            return
+        uid, _ = self.add()
+        self.save_pdf(uid, filename, pdf_data, key=key)
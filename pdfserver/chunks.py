@@ -0,0 +1,147 @@
+"""Splitting long documents into chunks rendered in parallel.
+
+The body of a document is split before the elements matching a CSS
+selector (the ``split`` field of a request), top-level matches only: a
+match inside another match does not start a chunk. Every chunk is the
+whole document with the body reduced to its part, ancestors of the split
+elements are repeated in each chunk. The render workers parse the
+document and cut out their chunk, see ``pdfserver.worker.render_chunk``,
+the chunks are merged into one PDF afterwards.
+
+Chunks are laid out independently. The ``page`` counter continues from the
+previous chunks (their pages are counted in a first pass). Documents using
+state which would restart in every chunk (other counters, named strings,
+running elements, the position of a page in the document) are rendered in
+one piece, see :func:`unsplittable`.
+"""
+import cssselect2
+import math
+import re
+
+
+# Page based counters need the page counts of the previous chunks
+PAGE_COUNTER = re.compile(r'\bcounters?\(\s*page\s*[,)]', re.IGNORECASE)
+# CSS depending on the previous chunks or on the whole document, with the
+# reason why it prevents splitting
+UNSPLITTABLE = (
+    (
+        re.compile(r'\bcounters?\(\s*pages\s*[,)]|\btarget-(?:counters?|text)\(', re.IGNORECASE),
+        "it needs the total number of pages or refers to other elements",
+    ),
+    (
+        re.compile(
+            r'\bcounters?\(\s*(?!page\s*[,)])|\bcounter-(?:increment|reset|set)\s*:',
+            re.IGNORECASE,
+        ),
+        "it uses counters",
+    ),
+    (
+        re.compile(r'@page\b[^{]*:\s*(?:first|left|right|blank|nth)\b', re.IGNORECASE),
+        "it styles pages by their position",
+    ),
+    (
+        re.compile(r'\b(?:page-)?break-(?:before|after)\s*:\s*(?:left|right|recto|verso)\b', re.IGNORECASE),
+        "it breaks to left or right pages",
+    ),
+    (
+        re.compile(r'\bstring-set\s*:|\brunning\(', re.IGNORECASE),
+        "it uses named strings or running elements",
+    ),
+)
+
+
+def validate_selector(selector):
+    """:raises ValueError: If ``selector`` is not a valid CSS selector."""
+    if not isinstance(selector, str) or not selector.strip():
+        raise ValueError("Split must be a CSS selector")
+    try:
+        cssselect2.compile_selector_list(selector)
+    except cssselect2.SelectorError as e:
+        raise ValueError(f"Invalid split selector: {e}")
+
+
+def positions(root):
+    """Return element -> (index, index of its last descendant) in tree
+    order.
+    """
+    order = list(root.iter())
+    sizes = {}
+    for element in reversed(order):
+        sizes[element] = 1 + sum(sizes[child] for child in element)
+    return {element: (index, index + sizes[element] - 1) for index, element in enumerate(order)}
+
+
+def chunk_ranges(root, selector, tree_positions=None):
+    """Return the chunks of the body of ``root`` as [start, end) ranges of
+    tree order positions. The first chunk starts with the body, so it
+    includes what comes before the first split element.
+    """
+    tree_positions = positions(root) if tree_positions is None else tree_positions
+    body = root.find('body')
+    if body is None:
+        return []
+    body_start, body_end = tree_positions[body]
+    starts = []
+    last = body_start
+    for match in cssselect2.ElementWrapper.from_html_root(root).query_all(selector):
+        start, end = tree_positions[match.etree_element]
+        # Only split elements in the body which are not inside another one
+        if body_start < start <= body_end and start > last:
+            starts.append(start)
+            last = end
+    starts[:1] = [body_start]
+    return list(zip(starts, starts[1:] + [math.inf]))
+
+
+def count(root, selector):
+    """Return the number of chunks of the document ``root``."""
+    return len(chunk_ranges(root, selector))
+
+
+def _prune(element, start, end, tree_positions):
+    for child in list(element):
+        first, last = tree_positions[child]
+        if first >= end or last < start:
+            element.remove(child)
+            continue
+        if start <= first and last < end:
+            continue
+        # Text before the first child and after the end of the element
+        # belong to the chunk containing them
+        if not start <= first < end:
+            child.text = None
+        if not start <= last < end:
+            child.tail = None
+        _prune(child, start, end, tree_positions)
+
+
+def select(root, selector, index):
+    """Reduce the body of the document ``root`` to its chunk ``index``,
+    in place.
+
+    :raises IndexError: If the document has less chunks.
+    """
+    tree_positions = positions(root)
+    start, end = chunk_ranges(root, selector, tree_positions)[index]
+    body = root.find('body')
+    if not start <= tree_positions[body][0] < end:
+        body.text = None
+    _prune(body, start, end, tree_positions)
+
+
+def unsplittable(stylesheets):
+    """Tell whether the CSS ``stylesheets`` prevent splitting a document.
+
+    :return: The reason why the document has to be rendered in one piece,
+        or None.
+    """
+    for css in stylesheets:
+        for pattern, reason in UNSPLITTABLE:
+            if pattern.search(css):
+                return reason
+    return None
+
+
+def uses_page_counter(stylesheets):
+    """Tell whether the CSS ``stylesheets`` show page numbers."""
+    return any(PAGE_COUNTER.search(css) for css in stylesheets)
@@ -0,0 +1,131 @@
+import os
+
+
+def env_int(name, default):
+    """Read an integer setting from the environment."""
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return int(value)
+
+
+# Number of server processes accepting requests on the same port. With
+# more than one, jobs are shared through a store in PDF_STORE_DIR (defaults
+# to a "pdfserver-store" folder in the system temp directory), so any
+# process can answer /status and /pdf. The directory may also be set for a
+# single process, to keep finished jobs across restarts of the server.
+SERVER_PROCESSES = env_int('PDF_SERVER_PROCESSES', 1)
+STORE_DIR = os.environ.get('PDF_STORE_DIR', '')
+
+# Number of render worker processes of each server process. Defaults to
+# one per CPU core, divided among the server processes.
+RENDER_WORKERS = env_int('PDF_RENDER_WORKERS', max(1, (os.cpu_count() or 1) // SERVER_PROCESSES))
+
+# Set to 0 to start render workers on the first job instead of warming them
+# up with a built-in document when the server starts.
+WARMUP = env_int('PDF_WARMUP', 1)
+
+# How render workers are started. "forkserver" preloads WeasyPrint once in a
+# clean server process and forks every worker from there.
+RENDER_START_METHOD = os.environ.get('PDF_RENDER_START_METHOD', 'forkserver')
+
+# New jobs are refused with "429 Too Many Requests" while this many jobs
+# wait for a render worker (0 disables the limit).
+QUEUE_MAX_DEPTH = env_int('PDF_QUEUE_MAX_DEPTH', 100)
+
+# Parsed stylesheet cache of each render worker: maximum number of
+# stylesheets, and for how many seconds a stylesheet is used without
+# revalidation if the server does not send Cache-Control.
+CSS_CACHE_SIZE = env_int('PDF_CSS_CACHE_SIZE', 64)
+CSS_CACHE_TTL = env_int('PDF_CSS_CACHE_TTL', 60)
+
+# Hard limits of a single job: the worker is killed when a job runs longer
+# than this many seconds or its resident memory exceeds this many bytes
+# (0 disables them).
+RENDER_TIMEOUT = env_int('PDF_RENDER_TIMEOUT', 300)
+RENDER_MAX_MEMORY = env_int('PDF_RENDER_MAX_MEMORY', 2 * 1024 * 1024 * 1024)
+
+# Render workers are replaced by a new process after this many jobs, or when
+# their resident memory after a job exceeds this many bytes (0 disables it).
+WORKER_MAX_JOBS = env_int('PDF_WORKER_MAX_JOBS', 1000)
+WORKER_RECYCLE_MEMORY = env_int('PDF_WORKER_RECYCLE_MEMORY', 1024 * 1024 * 1024)
+
+# The font configuration and web font cache of a render worker are replaced
+# after this many jobs (0 disables it) or when the cached fonts exceed this
+# many bytes.
+FONT_RECYCLE_JOBS = env_int('PDF_FONT_RECYCLE_JOBS', 0)
+FONT_CACHE_MAX_BYTES = env_int('PDF_FONT_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+
+# Reuse finished PDFs for identical requests (1) or always render (0).
+# Identical requests in flight are rendered once either way.
+RESULT_CACHE = env_int('PDF_RESULT_CACHE', 1)
+# Timeout in seconds of the HEAD requests looking up the validators
+# (ETag / Last-Modified) of documents and stylesheets for reusing PDFs
+VALIDATOR_TIMEOUT = env_int('PDF_VALIDATOR_TIMEOUT', 2)
+
+# Subresource cache of each render worker (images, fonts, stylesheets):
+# memory budget, freshness lifetime of responses without Cache-Control, and
+# an optional directory where entries beyond the memory budget are written,
+# with its own budget.
+RESOURCE_CACHE_MAX_BYTES = env_int('PDF_RESOURCE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+RESOURCE_CACHE_TTL = env_int('PDF_RESOURCE_CACHE_TTL', 60)
+RESOURCE_CACHE_DIR = os.environ.get('PDF_RESOURCE_CACHE_DIR', '')
+RESOURCE_CACHE_DISK_MAX_BYTES = env_int('PDF_RESOURCE_CACHE_DISK_MAX_BYTES', 512 * 1024 * 1024)
+
+# Memory budget of the loaded images each render worker keeps for later
+# renders (0 disables it). Images are reused while their response in the
+# resource cache is valid.
+IMAGE_CACHE_MAX_BYTES = env_int('PDF_IMAGE_CACHE_MAX_BYTES', 128 * 1024 * 1024)
+
+# Keep-alive connection pool of the URL fetcher, per process: number of
+# hosts with pooled connections, and connections kept per host.
+FETCH_POOL_HOSTS = env_int('PDF_FETCH_POOL_HOSTS', 10)
+FETCH_POOL_CONNECTIONS = env_int('PDF_FETCH_POOL_CONNECTIONS', 8)
+
+# Storage of finished PDFs: directory for PDFs which are not kept in memory
+# (defaults to a "pdfserver" folder in the system temp directory), size from
+# which renders write PDFs to a file instead of memory, and total memory
+# used for PDFs kept in memory.
+SPOOL_DIR = os.environ.get('PDF_SPOOL_DIR', '')
+SPOOL_THRESHOLD = env_int('PDF_SPOOL_THRESHOLD', 8 * 1024 * 1024)
+CACHE_MEMORY_BUDGET = env_int('PDF_CACHE_MEMORY_BUDGET', 256 * 1024 * 1024)
+
+# Completed PDFs are evicted, least recently used first, once all stored
+# PDFs (in memory and on disk) exceed this size.
+CACHE_MAX_BYTES = env_int('PDF_CACHE_MAX_BYTES', 4 * 1024 * 1024 * 1024)
+
+# JSON file defining named stylesheet bundles, which every render worker
+# parses once at startup, see pdfserver.bundles.
+STYLESHEET_BUNDLES = os.environ.get('PDF_STYLESHEET_BUNDLES', '')
+
+# Output preset of requests which do not choose one, see pdfserver.presets.
+RENDER_PRESET = os.environ.get('PDF_RENDER_PRESET', 'default')
+
+# Maximum size of an HTML document uploaded to /convert-html as text/html or
+# multipart/form-data body (after decoding Content-Encoding).
+HTML_MAX_BYTES = env_int('PDF_HTML_MAX_BYTES', 100 * 1024 * 1024)
+# Maximum size of the other fields of a multipart/form-data upload (css,
+# options, ...), they are read into memory.
+FORM_FIELD_MAX_BYTES = env_int('PDF_FORM_FIELD_MAX_BYTES', 64 * 1024)
+
+# Maximum number of items in one /convert-batch request.
+BATCH_MAX_ITEMS = env_int('PDF_BATCH_MAX_ITEMS', 1000)
+
+# Allow clients to request a cProfile or tracemalloc profile of a render
+# (the "profile" field of /convert and /convert-html).
+PROFILING = env_int('PDF_PROFILING', 0)
+
+# Longest wait (in seconds) a client may request from /status long-polling.
+# Event streams send a keep-alive comment at this interval.
+STATUS_MAX_WAIT = env_int('PDF_STATUS_MAX_WAIT', 60)
+
+# Callbacks of finished asynchronous jobs: retries after a failed delivery,
+# delay before the first retry (doubled for every further one) and timeout
+# of an attempt in seconds, and connections kept open for deliveries.
+WEBHOOK_RETRIES = env_int('PDF_WEBHOOK_RETRIES', 5)
+WEBHOOK_BACKOFF = env_int('PDF_WEBHOOK_BACKOFF', 2)
+WEBHOOK_TIMEOUT = env_int('PDF_WEBHOOK_TIMEOUT', 30)
+WEBHOOK_CONNECTIONS = env_int('PDF_WEBHOOK_CONNECTIONS', 20)
+# Base URL of the download links sent to callbacks, e.g. the address of a
+# reverse proxy. Defaults to the origin the client used for the request.
+PUBLIC_URL = os.environ.get('PDF_PUBLIC_URL', '')
@@ -0,0 +1,646 @@
+"""Multiprocessing render engine.
+
+WeasyPrint spends most of its time in pure Python code, so rendering in
+threads does not scale past one core. The engine keeps a fixed number of
+worker processes, each owned by a dispatcher thread which takes jobs from a
+shared priority queue, sends them to its worker and hands the result back
+through a ``concurrent.futures.Future``.
+"""
+from concurrent.futures import Future
+from contextlib import suppress
+from pdfserver import config
+from pdfserver import metrics
+from pdfserver.log import logger
+from pdfserver.profiling import resident_memory
+import asyncio
+import itertools
+import math
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+
+
+# Job priorities, lower values are dispatched first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BACKGROUND: 'background'}
+
+# Seconds between checks of the limits of a running job
+WATCHDOG_INTERVAL = 0.1
+
+# Seconds before starting a worker process again after starting it failed,
+# doubled after every failure up to the maximum
+WORKER_START_BACKOFF = 1
+WORKER_START_BACKOFF_MAX = 30
+
+
+class WorkerDied(Exception):
+    """The worker process exited (or was killed) while rendering a job."""
+
+
+class RenderLimitExceeded(WorkerDied):
+    """The job ran longer or used more memory than allowed, its worker was
+    killed.
+
+    :param reason: ``timeout`` or ``memory_limit``.
+    """
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+class QueueFull(Exception):
+    """No more jobs are admitted until the queue has drained a bit.
+
+    :param retry_after: Estimated seconds until there is room again.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Render queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _worker_main(conn, initializer=None, initargs=()):
+    """Main loop of a worker process: receive jobs, send back results
+    together with the metrics recorded while running them.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if initializer is not None:
+        initializer(*initargs)
+    # Forget samples inherited from the parent process
+    metrics.drain()
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        func, args = message
+        try:
+            result = func(*args)
+        except Exception as e:
+            try:
+                conn.send((False, e, metrics.drain()))
+            except Exception:
+                # The exception itself can not be pickled.
+                conn.send((False, RuntimeError(repr(e)), {}))
+        else:
+            conn.send((True, result, metrics.drain()))
+
+
+class Admission:
+    """Queue slots reserved by :meth:`RenderEngine.admit` for jobs which
+    are not submitted yet. Every job submitted with the admission takes one
+    of them, :meth:`release` gives back those which are left.
+    """
+
+    def __init__(self, engine, count):
+        self.engine = engine
+        self.count = count
+
+    def take(self, count=1):
+        """Move ``count`` of the slots left to a new :class:`Admission`,
+        e.g. for one item of a batch.
+        """
+        with self.engine._inflight_lock:
+            count = min(count, self.count)
+            self.count -= count
+        return Admission(self.engine, count)
+
+    def release(self, count=None):
+        """Give back ``count`` (by default all) reserved slots."""
+        self.engine._unreserve(self, self.count if count is None else count)
+
+
+class RenderJob:
+    """A function call to be executed by one of the render workers."""
+
+    def __init__(self, func, args, key=None, priority=PRIORITY_BACKGROUND):
+        self.func = func
+        self.args = args
+        self.key = key
+        self.priority = priority
+        # Sequence number of the current queue entry of the job
+        self.sequence = None
+        self.queued_at = time.monotonic()
+        self.future = Future()
+        self.worker = None
+        self.waiters = 1
+
+    def cancel(self, reason='cancelled'):
+        """Cancel the job. A job which is already rendering gets its
+        worker process killed, which frees the slot immediately.
+
+        :param reason: Why the job is cancelled, ``cancelled`` or
+            ``timeout``, recorded as the reason of the worker restart.
+        """
+        if self.future.cancel():
+            return
+        worker = self.worker
+        if worker is not None and not self.future.done():
+            worker.abort(self, reason)
+
+
+class RenderWorker:
+    """A worker process and the pipe used to talk to it."""
+
+    def __init__(self, context, initializer=None, initargs=()):
+        self.context = context
+        self.initializer = initializer
+        self.initargs = initargs
+        self.process = None
+        self.conn = None
+        self.jobs = 0
+        self.busy = False
+        # The job being rendered, and why the process was killed by abort()
+        self.job = None
+        self.killed = None
+        self._job_lock = threading.Lock()
+
+    def start(self):
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_worker_main,
+            args=(child_conn, self.initializer, self.initargs),
+            daemon=True,
+        )
+        try:
+            self.process.start()
+        except BaseException:
+            self.conn.close()
+            self.process = self.conn = None
+            raise
+        finally:
+            child_conn.close()
+        self.jobs = 0
+        logger.info(f"Started render worker (pid {self.process.pid})")
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def kill(self):
+        process = self.process
+        if process is not None and process.is_alive():
+            process.kill()
+
+    def assign(self, job):
+        """Record that the worker renders ``job`` (None when done)."""
+        with self._job_lock:
+            self.job = job
+            self.killed = None
+
+    def abort(self, job, reason):
+        """Kill the worker process if it still renders ``job``."""
+        with self._job_lock:
+            if self.job is not job:
+                return
+            self.killed = reason
+            self.kill()
+
+    def memory(self):
+        """Resident memory of the worker process in bytes, or None."""
+        process = self.process
+        return None if process is None else resident_memory(process.pid)
+
+    def _check_limits(self, start, timeout, max_memory):
+        if timeout and time.monotonic() - start > timeout:
+            raise RenderLimitExceeded(
+                f"PDF generation exceeded the time limit of {timeout} seconds", 'timeout'
+            )
+        if max_memory and (self.memory() or 0) > max_memory:
+            raise RenderLimitExceeded(
+                f"PDF generation exceeded the memory limit of {max_memory // 2 ** 20} MB",
+                'memory_limit',
+            )
+
+    def run(self, func, args, timeout=None, max_memory=None):
+        """Run ``func(*args)`` in the worker process.
+
+        :param timeout: Seconds after which the job is aborted.
+        :param max_memory: Resident memory in bytes beyond which the job is
+            aborted.
+        :raises RenderLimitExceeded: If a limit was exceeded, the worker
+            process has been killed then.
+        :raises WorkerDied: If the worker process exited.
+        """
+        if self.process is None or not self.process.is_alive():
+            self.stop()
+            self.start()
+        self.busy = True
+        start = time.monotonic()
+        try:
+            self.conn.send((func, args))
+            if timeout or max_memory:
+                while not self.conn.poll(WATCHDOG_INTERVAL):
+                    self._check_limits(start, timeout, max_memory)
+            success, result, samples = self.conn.recv()
+        except RenderLimitExceeded as e:
+            logger.warning(f"Killing render worker (pid {self.process.pid}): {e}")
+            self.kill()
+            self.stop()
+            metrics.WORKER_RESTARTS.inc(reason=e.reason)
+            raise
+        except (EOFError, OSError):
+            self.process.join(timeout=1)
+            exitcode = self.process.exitcode
+            self.stop()
+            with self._job_lock:
+                reason = self.killed or 'died'
+            metrics.WORKER_RESTARTS.inc(reason=reason)
+            if reason != 'died':
+                raise WorkerDied(f"Render worker killed, job {reason}")
+            raise WorkerDied(f"Render worker exited with code {exitcode}")
+        finally:
+            self.assign(None)
+            self.busy = False
+        self.jobs += 1
+        metrics.merge(samples)
+        if not success:
+            raise result
+        return result
+
+
+class RenderEngine:
+    """Pool of render worker processes.
+
+    Jobs are dispatched by priority, then in submission order.
+
+    :param workers: Number of worker processes, defaults to
+        ``config.RENDER_WORKERS``.
+    :param start_method: The multiprocessing start method.
+    :param max_queued: Number of waiting jobs beyond which :meth:`admit`
+        refuses new ones, defaults to ``config.QUEUE_MAX_DEPTH``.
+    :param initializer: Called with ``initargs`` in every worker process
+        when it starts (or is restarted), before it runs any job. May be
+        set until the engine is started.
+    :param warmup: Run once in every worker process when the engine starts
+        and when a worker is replaced, before the worker takes jobs.
+        Returns the seconds spent in its phases. May be set until the
+        engine is started.
+    :param timeout: Seconds a job may run, defaults to
+        ``config.RENDER_TIMEOUT``.
+    :param max_memory: Resident memory of a worker while running a job,
+        defaults to ``config.RENDER_MAX_MEMORY``.
+    :param max_jobs: Jobs after which a worker is replaced, defaults to
+        ``config.WORKER_MAX_JOBS``.
+    :param recycle_memory: Resident memory after a job beyond which the
+        worker is replaced, defaults to ``config.WORKER_RECYCLE_MEMORY``.
+    """
+
+    def __init__(self, workers=None, start_method=None, max_queued=None,
+                 initializer=None, initargs=(), warmup=None, timeout=None,
+                 max_memory=None, max_jobs=None, recycle_memory=None):
+        self.size = workers or config.RENDER_WORKERS
+        self.start_method = start_method or config.RENDER_START_METHOD
+        self.max_queued = config.QUEUE_MAX_DEPTH if max_queued is None else max_queued
+        self.initializer = initializer
+        self.initargs = initargs
+        self.warmup = warmup
+        self.timeout = config.RENDER_TIMEOUT if timeout is None else timeout
+        self.max_memory = config.RENDER_MAX_MEMORY if max_memory is None else max_memory
+        self.max_jobs = config.WORKER_MAX_JOBS if max_jobs is None else max_jobs
+        self.recycle_memory = (
+            config.WORKER_RECYCLE_MEMORY if recycle_memory is None else recycle_memory
+        )
+        # Startup timings of the workers, see ``startup_report``
+        self.started_at = None
+        self.ready_after = None
+        self.warmup_timings = []
+        self._ready_workers = 0
+        # Moving average of the render duration, used to estimate waiting times
+        self.average_duration = 1.0
+        self._jobs = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._waiting = set()
+        # Queue slots of admitted jobs which are not submitted yet
+        self._reserved = 0
+        self._threads = []
+        self._workers = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def start(self):
+        """Start the dispatcher threads. With a ``warmup``, every dispatcher
+        starts its worker process right away and warms it up before taking
+        jobs (see :meth:`ready`). Otherwise worker processes are started by
+        their dispatcher when the first job arrives.
+        """
+        with self._lock:
+            if self._threads:
+                return
+            context = multiprocessing.get_context(self.start_method)
+            if self.start_method == 'forkserver':
+                context.set_forkserver_preload(['pdfserver.worker'])
+            self.started_at = time.monotonic()
+            self._stopping.clear()
+            for index in range(self.size):
+                worker = RenderWorker(context, self.initializer, self.initargs)
+                thread = threading.Thread(
+                    target=self._dispatch,
+                    args=(worker,),
+                    name=f'render-dispatch-{index}',
+                    daemon=True,
+                )
+                self._workers.append(worker)
+                self._threads.append(thread)
+                thread.start()
+
+    def shutdown(self):
+        """Stop all dispatcher threads and worker processes."""
+        with self._lock:
+            self._stopping.set()
+            for _ in self._threads:
+                self._jobs.put((math.inf, next(self._sequence), None))
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+            self._workers = []
+            self.started_at = self.ready_after = None
+            self.warmup_timings = []
+            self._ready_workers = 0
+
+    def ready(self):
+        """Whether all workers have been warmed up (or the engine runs
+        without warm-up and has been started).
+        """
+        return self.ready_after is not None
+
+    def startup_report(self):
+        """Seconds until the engine was ready, and the startup phases of
+        each worker.
+        """
+        return {
+            'ready': self.ready(),
+            'workers': {'ready': self._ready_workers, 'total': self.size},
+            'ready_after': None if self.ready_after is None else round(self.ready_after, 4),
+            'warmup': list(self.warmup_timings),
+        }
+
+    def _start_worker(self, worker):
+        """Start the process of ``worker``, retrying with a backoff while it
+        fails. Returns False if the engine was shut down meanwhile.
+        """
+        delay = WORKER_START_BACKOFF
+        while True:
+            try:
+                worker.start()
+                return True
+            except Exception as e:
+                logger.error(f"Starting render worker failed, retrying in {delay}s: {e!r}")
+            if self._stopping.wait(delay):
+                return False
+            delay = min(2 * delay, WORKER_START_BACKOFF_MAX)
+
+    def _warm_up(self, worker):
+        """Start the process of ``worker`` and run the warm-up in it.
+
+        :return: The seconds spent in the startup phases, or None if the
+            engine was shut down before the process could be started.
+        """
+        start = time.monotonic()
+        if not self._start_worker(worker):
+            return None
+        try:
+            timings = worker.run(self.warmup, ())
+        except Exception as e:
+            logger.warning(f"Warm-up of render worker failed: {e!r}")
+            timings = {}
+        total = time.monotonic() - start
+        # Starting the process includes the initializer
+        timings = {'process': total - sum(timings.values()), **timings, 'total': total}
+        return {phase: round(seconds, 4) for phase, seconds in timings.items()}
+
+    def _recycle_reason(self, worker):
+        """Return why ``worker`` should be replaced after its last job, or
+        None.
+        """
+        if worker.process is None:
+            return 'died'
+        if self.max_jobs and worker.jobs >= self.max_jobs:
+            return 'jobs'
+        if self.recycle_memory and (worker.memory() or 0) > self.recycle_memory:
+            return 'memory'
+        return None
+
+    def _recycle(self, worker):
+        """Replace the process of ``worker`` if needed, so long running
+        servers keep a stable memory footprint.
+        """
+        reason = self._recycle_reason(worker)
+        if reason is None:
+            return
+        try:
+            if reason != 'died':
+                logger.info(
+                    f"Recycling render worker (pid {worker.process.pid}) after "
+                    f"{worker.jobs} jobs, {worker.memory()} bytes resident"
+                )
+                metrics.WORKER_RESTARTS.inc(reason=reason)
+                worker.stop()
+            # Without warm-up, the new process is started by the next job
+            if self.warmup is not None:
+                self._warm_up(worker)
+        except Exception as e:
+            # The next job starts a new process
+            logger.error(f"Replacing render worker failed: {e!r}")
+            with suppress(Exception):
+                worker.kill()
+            worker.process = worker.conn = None
+
+    def _worker_ready(self, timings=None):
+        # Not ``_lock``, shutdown() holds it while joining the dispatchers
+        with self._inflight_lock:
+            if timings is not None:
+                self.warmup_timings.append(timings)
+            self._ready_workers += 1
+            if self._ready_workers == self.size and self.started_at is not None:
+                self.ready_after = time.monotonic() - self.started_at
+                logger.info(f"Render workers ready after {self.ready_after:.2f}s")
+
+    def _dispatch(self, worker):
+        try:
+            if self.warmup is not None:
+                timings = self._warm_up(worker)
+                if timings is not None:
+                    self._worker_ready(timings)
+            else:
+                self._worker_ready()
+            while True:
+                _, sequence, job = self._jobs.get()
+                if job is None:
+                    break
+                with self._inflight_lock:
+                    if job.sequence != sequence:
+                        # Queued again with a higher priority
+                        continue
+                    self._waiting.discard(job)
+                job.worker = worker
+                worker.assign(job)
+                if not job.future.set_running_or_notify_cancel():
+                    worker.assign(None)
+                    job.worker = None
+                    continue
+                start = time.monotonic()
+                metrics.QUEUE_WAIT.observe(
+                    start - job.queued_at,
+                    priority=PRIORITY_NAMES.get(job.priority, job.priority),
+                )
+                try:
+                    result = worker.run(job.func, job.args, self.timeout, self.max_memory)
+                except BaseException as e:
+                    job.future.set_exception(e)
+                else:
+                    job.future.set_result(result)
+                finally:
+                    job.worker = None
+                    duration = time.monotonic() - start
+                    metrics.WORKER_DURATION.observe(duration)
+                    self.average_duration = 0.8 * self.average_duration + 0.2 * duration
+                self._recycle(worker)
+        finally:
+            worker.stop()
+
+    def queued(self):
+        """Number of jobs waiting for a worker."""
+        return len(self._waiting)
+
+    def busy(self):
+        """Number of workers rendering a job."""
+        return sum(1 for worker in self._workers if worker.busy)
+
+    def retry_after(self):
+        """Estimated seconds until a job submitted now would start."""
+        queued = self.queued() + self._reserved
+        return max(1, math.ceil(queued * self.average_duration / self.size))
+
+    def admit(self, count=1):
+        """Reserve queue slots for ``count`` more jobs, which are submitted
+        later with the returned :class:`Admission`. Reserved slots count as
+        queued jobs until they are taken or released.
+
+        :raises QueueFull: If they would exceed ``max_queued``.
+        """
+        with self._inflight_lock:
+            if self.max_queued and len(self._waiting) + self._reserved + count > self.max_queued:
+                raise QueueFull(self.retry_after())
+            self._reserved += count
+        return Admission(self, count)
+
+    def _unreserve(self, admission, count):
+        with self._inflight_lock:
+            count = min(count, admission.count)
+            admission.count -= count
+            self._reserved -= count
+
+    def position(self, job):
+        """Return the number of jobs dispatched before ``job``, or None if
+        it is not waiting anymore.
+        """
+        with self._inflight_lock:
+            if job not in self._waiting:
+                return None
+            entry = (job.priority, job.sequence)
+            return sum(
+                1 for waiting in self._waiting
+                if (waiting.priority, waiting.sequence) < entry
+            )
+
+    def _enqueue(self, job):
+        job.sequence = next(self._sequence)
+        self._waiting.add(job)
+        self._jobs.put((job.priority, job.sequence, job))
+
+    def submit(self, func, *args, key=None, priority=PRIORITY_BACKGROUND, admission=None):
+        """Queue ``func(*args)`` for execution in a worker process.
+
+        Jobs submitted with the ``key`` of a job which is still queued or
+        running are not executed again, the running job is returned instead.
+        A queued job is moved up if it is submitted again with a higher
+        priority.
+
+        :param admission: The :class:`Admission` the job takes its queue
+            slot from.
+        :return: The :class:`RenderJob`.
+        """
+        self.start()
+        if admission is not None:
+            admission.release(1)
+        job = RenderJob(func, args, key, priority)
+        with self._inflight_lock:
+            if key is not None:
+                existing = self._inflight.get(key)
+                if existing is not None:
+                    existing.waiters += 1
+                    if priority < existing.priority and existing in self._waiting:
+                        existing.priority = priority
+                        self._enqueue(existing)
+                    return existing
+                self._inflight[key] = job
+            self._enqueue(job)
+        job.future.add_done_callback(lambda future: self._forget(job))
+        return job
+
+    def _forget(self, job):
+        with self._inflight_lock:
+            self._waiting.discard(job)
+            self._forget_locked(job)
+
+    def release(self, job, reason='cancelled'):
+        """Give up waiting for ``job``. The job is cancelled once nobody is
+        waiting for it anymore, see :meth:`RenderJob.cancel`.
+        """
+        with self._inflight_lock:
+            job.waiters -= 1
+            abandoned = job.waiters <= 0
+            if abandoned:
+                self._forget_locked(job)
+        if abandoned:
+            job.cancel(reason)
+
+    def _forget_locked(self, job):
+        if job.key is not None and self._inflight.get(job.key) is job:
+            del self._inflight[job.key]
+
+    async def run(self, func, *args, key=None, timeout=None, priority=PRIORITY_BACKGROUND,
+                  admission=None):
+        """Execute ``func(*args)`` in a worker process and return its result.
+
+        Identical jobs running at the same time are executed once if they
+        are given the same ``key``.
+
+        Cancelling the awaiting task, or exceeding ``timeout`` seconds,
+        cancels the job (unless others still wait for it) and raises
+        ``asyncio.CancelledError`` or ``asyncio.TimeoutError`` respectively.
+        """
+        job = self.submit(func, *args, key=key, priority=priority, admission=admission)
+        return await self.wait(job, timeout)
+
+    async def wait(self, job, timeout=None):
+        """Wait for the result of a submitted job, see :meth:`run`."""
+        result = asyncio.wrap_future(job.future)
+        try:
+            # shield, so cancelling one waiter does not cancel the shared job
+            return await asyncio.wait_for(asyncio.shield(result), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            # Nobody is interested in the outcome of the abandoned job
+            result.add_done_callback(lambda future: future.cancelled() or future.exception())
+            self.release(job, 'timeout' if isinstance(e, asyncio.TimeoutError) else 'cancelled')
+            raise
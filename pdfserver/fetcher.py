@@ -1,36 +1,166 @@
-from copy import deepcopy
+from collections import OrderedDict
+from contextlib import suppress
+from email.message import Message
+from functools import lru_cache
+from hashlib import sha256
+from pdfserver import config
+from pdfserver import metrics
+from pdfserver.log import logger
+from urllib.error import HTTPError
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
 from urllib.request import Request, urlopen
 from weasyprint.urls import HTTP_HEADERS
 from weasyprint.urls import StreamingGzipFile
 from weasyprint.urls import UNICODE_SCHEME_RE
 from urllib3.util import make_headers
+import tempfile
+import threading
+import time
+import urllib3
 import zlib
 import os
 
 
-def basic_auth_url_fetcher(url, timeout=120, ssl_context=None, auth=None):
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def pool_manager():
+    """Return the keep-alive connection pool of this process.
+
+    The pool is thread-safe. Connections can not be shared with forked
+    processes, so every process creates its own pool.
+    """
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool_pid != pid:
+        with _pool_lock:
+            if _pool_pid != pid:
+                _pool = urllib3.PoolManager(
+                    num_pools=config.FETCH_POOL_HOSTS,
+                    maxsize=config.FETCH_POOL_CONNECTIONS,
+                )
+                _pool_pid = pid
+    return _pool
+
+
+@lru_cache(maxsize=8)
+def _auth_headers(username, password):
+    headers = dict(HTTP_HEADERS)
+    if username and password:
+        headers.update(make_headers(basic_auth=f'{username}:{password}'))
+    return headers
+
+
+def _request_headers(headers=None):
+    request_headers = _auth_headers(
+        os.environ.get('REMOTE_USERNAME'), os.environ.get('REMOTE_PASSWORD')
+    )
+    if headers:
+        return {**request_headers, **headers}
+    return request_headers
+
+
+class PooledResponseFile:
+    """File object over a pooled response. Closing it returns the
+    connection to the pool instead of closing it.
+    """
+
+    def __init__(self, response, host=None):
+        self.response = response
+        self.host = host
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.response.read(None if size is None or size < 0 else size)
+        self.size += len(data)
+        return data
+
+    def close(self):
+        self.response.drain_conn()
+        self.response.release_conn()
+        if self.host is not None:
+            metrics.FETCH_BYTES.inc(self.size, host=self.host)
+            self.host = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _response_info(headers):
+    info = Message()
+    for name, value in headers.items():
+        info[name] = value
+    return info
+
+
+def _redirected_url(url, response):
+    for redirect in response.retries.history if response.retries else ():
+        if redirect.redirect_location:
+            url = urljoin(url, redirect.redirect_location)
+    return url
+
+
+def _pooled_fetch(url, timeout, headers):
+    host = urlsplit(url).hostname or ''
+    start = time.monotonic()
+    try:
+        response = pool_manager().request(
+            'GET', url, headers=_request_headers(headers), timeout=timeout,
+            preload_content=False, decode_content=True,
+        )
+    except Exception:
+        metrics.FETCH_ERRORS.inc(host=host)
+        raise
+    metrics.FETCH_DURATION.observe(time.monotonic() - start, host=host)
+    response_info = _response_info(response.headers)
+    if response.status >= 300:
+        response.drain_conn()
+        response.release_conn()
+        if response.status != 304:
+            metrics.FETCH_ERRORS.inc(host=host)
+        raise HTTPError(url, response.status, response.reason, response_info, None)
+    return {
+        'redirected_url': _redirected_url(url, response),
+        'mime_type': response_info.get_content_type(),
+        'encoding': response_info.get_param('charset'),
+        'filename': response_info.get_filename(),
+        'headers': response_info,
+        'file_obj': PooledResponseFile(response, host),
+    }
+
+
+def basic_auth_url_fetcher(url, timeout=120, ssl_context=None, auth=None, headers=None):
     """This is a copy of weasyprint's default fetcher, but adds
     basic auth header and removes file:// support.
     Expect auth being a username, password tuple
+
+    HTTP(S) requests go through a keep-alive connection pool.
+
+    Additional request ``headers`` (e.g. for conditional requests) can be
+    given, the response headers are returned as ``headers``.
     """
     if UNICODE_SCHEME_RE.match(url):
+        if url.startswith(('http://', 'https://')) and ssl_context is None:
+            return _pooled_fetch(url, timeout, headers)
+
         # See https://bugs.python.org/issue34702
         if url.startswith('file://'):
             url = url.split('?')[0]
 
-        headers = deepcopy(HTTP_HEADERS)
-        username = os.environ.get('REMOTE_USERNAME', None)
-        password = os.environ.get('REMOTE_PASSWORD', None)
-        if username and password:
-            headers.update(make_headers(basic_auth=f'{username}:{password}'))
-
-        response = urlopen(Request(url, headers=headers), timeout=timeout, context=ssl_context)
+        response = urlopen(Request(url, headers=_request_headers(headers)), timeout=timeout, context=ssl_context)
         response_info = response.info()
         result = {
             'redirected_url': response.geturl(),
             'mime_type': response_info.get_content_type(),
             'encoding': response_info.get_param('charset'),
             'filename': response_info.get_filename(),
+            'headers': response_info,
         }
         content_encoding = response_info.get('Content-Encoding')
         if content_encoding == 'gzip':
@@ -47,3 +177,253 @@ def basic_auth_url_fetcher(url, timeout=120, ssl_context=None, auth=None):
         return result
     else:  # pragma: no cover
         raise ValueError('Not an absolute URI: %r' % url)
+
+
+def cache_lifetime(headers, default):
+    """Return for how many seconds a response may be reused without
+    revalidation, based on its Cache-Control header.
+
+    :param headers: The response headers.
+    :param default: Lifetime used if the response does not specify one.
+    :return: The lifetime in seconds, or None if it must not be stored.
+    """
+    directives = {}
+    for directive in (headers.get('Cache-Control') or '').split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.lower()] = value.strip('"')
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+    if 'max-age' in directives:
+        try:
+            return max(int(directives['max-age']), 0)
+        except ValueError:
+            return 0
+    return default
+
+
+def fetch_validators(url, timeout=None):
+    """Return the validators (ETag and Last-Modified) of ``url`` using a
+    HEAD request, or None if there are none or the request fails.
+
+    :param timeout: Defaults to ``config.VALIDATOR_TIMEOUT``.
+    """
+    timeout = config.VALIDATOR_TIMEOUT if timeout is None else timeout
+    try:
+        response = pool_manager().request(
+            'HEAD', url, headers=_request_headers(), timeout=timeout
+        )
+    except Exception:
+        return None
+    if response.status >= 300:
+        return None
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return None
+    return f'{etag}|{last_modified}'
+
+
+def read_result(result):
+    """Return the content of a URL fetcher result as bytes."""
+    if 'string' in result:
+        return result['string']
+    with result['file_obj'] as file_obj:
+        return file_obj.read()
+
+
+class CachedResource:
+    __slots__ = (
+        'redirected_url', 'mime_type', 'encoding', 'filename',
+        'data', 'path', 'size', 'etag', 'last_modified', 'fresh_until', 'fetched',
+    )
+
+    def __init__(self, result, data, lifetime):
+        headers = result['headers']
+        self.redirected_url = result['redirected_url']
+        self.mime_type = result['mime_type']
+        self.encoding = result['encoding']
+        self.filename = result['filename']
+        self.data = data
+        self.path = None
+        self.size = len(data)
+        self.etag = headers.get('ETag')
+        self.last_modified = headers.get('Last-Modified')
+        self.fresh_until = time.monotonic() + lifetime
+        self.fetched = time.monotonic()
+
+    def result(self, data=None):
+        """Return the resource in the shape of a URL fetcher result."""
+        data = self.data if data is None else data
+        result = {
+            'redirected_url': self.redirected_url,
+            'mime_type': self.mime_type,
+            'encoding': self.encoding,
+            'filename': self.filename,
+        }
+        if data is not None:
+            result['string'] = data
+        else:
+            result['file_obj'] = open(self.path, 'rb')
+        return result
+
+
+class ResourceCache:
+    """Bounded cache for fetched subresources (images, fonts, stylesheets).
+
+    Responses are reused while they are fresh according to Cache-Control
+    (or ``ttl`` seconds if there is none) and revalidated with
+    If-None-Match / If-Modified-Since afterwards. Entries exceeding the
+    memory budget are written to ``disk_dir`` if configured, or dropped.
+
+    :param max_bytes: Memory budget for cached content.
+    :param ttl: Freshness lifetime of responses without Cache-Control.
+    :param disk_dir: Directory for entries spilled to disk, or None.
+    :param disk_max_bytes: Budget for the spilled entries.
+    """
+
+    def __init__(self, max_bytes=None, ttl=None, disk_dir=None, disk_max_bytes=None,
+                 url_fetcher=basic_auth_url_fetcher):
+        self.max_bytes = config.RESOURCE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.ttl = config.RESOURCE_CACHE_TTL if ttl is None else ttl
+        self.disk_dir = config.RESOURCE_CACHE_DIR if disk_dir is None else disk_dir
+        self.disk_max_bytes = (
+            config.RESOURCE_CACHE_DISK_MAX_BYTES if disk_max_bytes is None else disk_max_bytes
+        )
+        self.url_fetcher = url_fetcher
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._folder = None
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'memory_bytes': self.memory_bytes,
+            'disk_bytes': self.disk_bytes,
+        }
+
+    def fetch(self, url):
+        """URL fetcher serving responses from the cache."""
+        entry = self.entries.get(url)
+        if entry is not None:
+            self.entries.move_to_end(url)
+            if time.monotonic() < entry.fresh_until:
+                self.hits += 1
+                metrics.RESOURCE_CACHE_HITS.inc()
+                return entry.result()
+
+        request_headers = {}
+        if entry is not None:
+            if entry.etag:
+                request_headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                request_headers['If-Modified-Since'] = entry.last_modified
+
+        try:
+            result = self.url_fetcher(url, headers=request_headers)
+        except HTTPError as e:
+            if e.code == 304 and entry is not None:
+                self.hits += 1
+                self.revalidations += 1
+                metrics.RESOURCE_CACHE_HITS.inc()
+                metrics.RESOURCE_CACHE_REVALIDATIONS.inc()
+                entry.fresh_until = time.monotonic() + (cache_lifetime(e.headers, self.ttl) or 0)
+                return entry.result()
+            raise
+
+        self.misses += 1
+        metrics.RESOURCE_CACHE_MISSES.inc()
+        self._remove(url)
+        lifetime = cache_lifetime(result['headers'], self.ttl)
+        if lifetime is None:
+            return result
+        if lifetime == 0 and not (result['headers'].get('ETag') or result['headers'].get('Last-Modified')):
+            # Could never be reused
+            return result
+
+        data = read_result(result)
+        entry = CachedResource(result, data, lifetime)
+        self.entries[url] = entry
+        self.memory_bytes += entry.size
+        self._enforce_budget()
+        return entry.result(data)
+
+    def validator(self, url):
+        """Return a string which changes whenever the cached response of
+        ``url`` changes: its ETag / Last-Modified, or the time it was
+        fetched if it has neither. A stale response is revalidated first.
+
+        :return: The validator, or None if the response is not cached.
+        """
+        entry = self.entries.get(url)
+        if entry is not None and time.monotonic() >= entry.fresh_until:
+            try:
+                result = self.fetch(url)
+            except Exception:
+                return None
+            if 'file_obj' in result:
+                result['file_obj'].close()
+            entry = self.entries.get(url)
+        if entry is None:
+            return None
+        if entry.etag or entry.last_modified:
+            return f'{entry.etag}|{entry.last_modified}'
+        return f'fetched {entry.fetched}'
+
+    def _remove(self, url):
+        entry = self.entries.pop(url, None)
+        if entry is None:
+            return
+        if entry.path is not None:
+            self.disk_bytes -= entry.size
+            with suppress(FileNotFoundError):
+                os.unlink(entry.path)
+        else:
+            self.memory_bytes -= entry.size
+
+    def _spill(self, url, entry):
+        if self._folder is None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._folder = tempfile.mkdtemp(prefix='resources-', dir=self.disk_dir)
+        # Named after the requested URL, several of them may redirect to the
+        # same resource
+        path = os.path.join(self._folder, sha256(url.encode()).hexdigest())
+        with open(path, 'wb') as f:
+            f.write(entry.data)
+        entry.path = path
+        entry.data = None
+        self.memory_bytes -= entry.size
+        self.disk_bytes += entry.size
+
+    def _enforce_budget(self):
+        in_memory = [url for url, entry in self.entries.items() if entry.data is not None]
+        for url in in_memory:
+            if self.memory_bytes <= self.max_bytes:
+                break
+            entry = self.entries[url]
+            if self.disk_dir and entry.size <= self.disk_max_bytes:
+                self._spill(url, entry)
+            else:
+                self._remove(url)
+                self.evictions += 1
+                metrics.RESOURCE_CACHE_EVICTIONS.inc()
+                logger.debug(f"Evicted resource from cache: {url}")
+
+        for url in list(self.entries):
+            if self.disk_bytes <= self.disk_max_bytes:
+                break
+            if self.entries[url].path is not None:
+                self._remove(url)
+                self.evictions += 1
+                metrics.RESOURCE_CACHE_EVICTIONS.inc()
+                logger.debug(f"Evicted resource from cache: {url}")
@@ -0,0 +1,60 @@
+from pdfserver.fetcher import basic_auth_url_fetcher
+from pdfserver.fetcher import read_result
+from urllib.parse import urlsplit
+
+
+FONT_EXTENSIONS = ('.woff', '.woff2', '.ttf', '.otf', '.eot')
+
+
+def is_font(url, mime_type):
+    """Guess whether a fetched resource is a web font."""
+    if mime_type and (
+        mime_type.startswith('font/')
+        or mime_type.startswith('application/font-')
+        or mime_type.startswith('application/x-font-')
+        or mime_type == 'application/vnd.ms-fontobject'
+    ):
+        return True
+    return urlsplit(url).path.lower().endswith(FONT_EXTENSIONS)
+
+
+class FontCache:
+    """Downloaded web fonts, keyed by URL.
+
+    Other resources are passed through to the URL fetcher untouched.
+    """
+
+    def __init__(self, url_fetcher=basic_auth_url_fetcher):
+        self.url_fetcher = url_fetcher
+        self.fonts = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.fonts.clear()
+        self.size = 0
+
+    def fetch(self, url):
+        """URL fetcher returning cached fonts."""
+        cached = self.fonts.get(url)
+        if cached is not None:
+            self.hits += 1
+            return dict(cached)
+
+        result = self.url_fetcher(url)
+        if not is_font(url, result.get('mime_type')):
+            return result
+
+        self.misses += 1
+        data = read_result(result)
+        cached = {
+            'string': data,
+            'redirected_url': result.get('redirected_url', url),
+            'mime_type': result.get('mime_type'),
+            'encoding': result.get('encoding'),
+            'filename': result.get('filename'),
+        }
+        self.fonts[url] = cached
+        self.size += len(data)
+        return dict(cached)
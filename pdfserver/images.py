@@ -0,0 +1,208 @@
+from collections import OrderedDict
+from pdfserver import config
+from pdfserver import metrics
+from pdfserver.log import logger
+from weasyprint.images import RasterImage
+
+
+# Options which change how WeasyPrint encodes images, see ``pdfserver.presets``
+IMAGE_OPTIONS = ('optimize_images', 'jpeg_quality', 'dpi')
+
+
+class SharedImages(dict):
+    """The ``cache`` option of the renders with one set of image options.
+
+    WeasyPrint stores loaded images by URL and their encoded data under
+    keys derived from the image id. Images loaded by earlier renders are
+    found if the response they were loaded from is still valid (see
+    ``ResourceCache.validator``). Images which can not be revalidated are
+    only kept for the current render.
+
+    With the ``dpi`` option, WeasyPrint replaces the data of an image by
+    a downsampled copy when drawing it smaller. The data an image was
+    loaded with is restored after each render, so that later renders
+    drawing it larger don't start from the copy.
+    """
+
+    def __init__(self, owner):
+        super().__init__()
+        self.owner = owner
+        # url -> (validator, image id) of images kept across renders
+        self.validators = {}
+        # url -> image id of images kept for the current render only
+        self.transient = {}
+        # image id -> encoded bytes stored under keys of the image
+        self.sizes = {}
+        # Image ids whose entries are removed after the current render
+        self.stale = set()
+        self.seen = set()
+        # url -> (image, data object) of the images as they were loaded
+        self.sources = {}
+        # Registered image ids, and source data they replaced in this
+        # render (None if there was none)
+        self.image_ids = set()
+        self.replaced = {}
+
+    def __contains__(self, url):
+        if not super().__contains__(url):
+            return False
+        if url in self.transient or url in self.seen:
+            return True
+        self.seen.add(url)
+        validator, image_id = self.validators[url]
+        if self.owner.validator(url) != validator:
+            # Changed since it was loaded, the data of the image may still
+            # be used by the current render
+            del self.validators[url]
+            super().__delitem__(url)
+            self._forget(url)
+            self.stale.add(image_id)
+            self.owner.lru.pop((id(self), url), None)
+            return False
+        self.owner.lru.move_to_end((id(self), url))
+        self.owner.count(hit=True)
+        return True
+
+    def __setitem__(self, key, value):
+        if isinstance(value, bytes):
+            image_id, slot = key.split('-', 2)[:2]
+            old = self.get(key)
+            if slot == 'source' and image_id in self.image_ids:
+                self.replaced.setdefault(key, old)
+            self._set_data(image_id, key, value, old)
+            self.stale.discard(image_id)
+            return
+
+        # Loaded an image (or None if it failed), SVG images are bound to
+        # the layout of the current render
+        url = key
+        self.seen.add(url)
+        self.owner.count(hit=False)
+        image_id = getattr(value, 'id', None)
+        validator = self.owner.validator(url) if isinstance(value, RasterImage) else None
+        if validator is None:
+            self.transient[url] = image_id
+        else:
+            self.validators[url] = (validator, image_id)
+            self.owner.lru[(id(self), url)] = self
+        if isinstance(value, RasterImage):
+            self.sources[url] = (value, value.image_data)
+            self.image_ids.add(image_id)
+        return super().__setitem__(url, value)
+
+    def _set_data(self, image_id, key, value, old):
+        if value is None:
+            self.pop(key, None)
+        else:
+            super().__setitem__(key, value)
+        change = len(value or b'') - len(old or b'')
+        self.sizes[image_id] = self.sizes.get(image_id, 0) + change
+        self.owner.size += change
+
+    def restore(self):
+        """Give downsampled images back the data they were loaded with."""
+        for key, data in self.replaced.items():
+            self._set_data(key.split('-', 1)[0], key, data, self.get(key))
+        self.replaced.clear()
+        for image, data in self.sources.values():
+            image.image_data = data
+
+    def remove(self, url):
+        """Remove the image loaded from ``url`` and its data."""
+        image_id = self.transient.pop(url, None)
+        entry = self.validators.pop(url, None)
+        if entry is not None:
+            image_id = entry[1]
+        if super().__contains__(url):
+            super().__delitem__(url)
+        self._forget(url)
+        if image_id is not None:
+            self._remove_data(image_id)
+
+    def _forget(self, url):
+        image, _ = self.sources.pop(url, (None, None))
+        if image is not None:
+            self.image_ids.discard(image.id)
+
+    def _remove_data(self, image_id):
+        prefix = f'{image_id}-'
+        for key in [key for key in self if isinstance(key, str) and key.startswith(prefix)]:
+            super().__delitem__(key)
+        self.owner.size -= self.sizes.pop(image_id, 0)
+
+    def end_render(self):
+        self.restore()
+        for url in list(self.transient):
+            self.remove(url)
+        for image_id in self.stale:
+            self._remove_data(image_id)
+        self.stale.clear()
+        self.seen.clear()
+
+
+class ImageCache:
+    """Decoded and encoded images shared by the renders of a worker.
+
+    Images are reused while the response they were loaded from is valid
+    in the resource cache (same ETag / Last-Modified, or not refetched).
+    Renders with different image options (see ``IMAGE_OPTIONS``) get
+    separate caches, since the options are applied when an image is
+    loaded.
+
+    Nothing is evicted while a render is running, since images loaded
+    earlier in the render still refer to their data. :meth:`end_render`
+    trims the cache to ``max_bytes`` afterwards, least recently used first.
+
+    :param validator: Returns the validator of the cached response of a
+        URL, or None if it is not cached.
+    """
+
+    def __init__(self, validator, max_bytes=None):
+        self.validator = validator
+        self.max_bytes = config.IMAGE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.caches = {}
+        # (cache id, url) -> SharedImages, in least recently used order
+        self.lru = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'images': len(self.lru),
+            'bytes': self.size,
+        }
+
+    def count(self, hit):
+        if hit:
+            self.hits += 1
+            metrics.IMAGE_CACHE_HITS.inc()
+        else:
+            self.misses += 1
+            metrics.IMAGE_CACHE_MISSES.inc()
+
+    def for_options(self, options):
+        """Return the ``cache`` option for a render with ``options``, or
+        None if the cache is disabled.
+        """
+        if self.max_bytes <= 0:
+            return None
+        signature = tuple(options.get(name) for name in IMAGE_OPTIONS)
+        cache = self.caches.get(signature)
+        if cache is None:
+            cache = self.caches[signature] = SharedImages(self)
+        return cache
+
+    def end_render(self):
+        """Drop what only the finished render needed and trim the cache."""
+        for cache in self.caches.values():
+            cache.end_render()
+        while self.lru and self.size > self.max_bytes:
+            (_, url), cache = self.lru.popitem(last=False)
+            cache.remove(url)
+            self.evictions += 1
+            logger.debug(f"Evicted image from cache: {url}")
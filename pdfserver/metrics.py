@@ -0,0 +1,246 @@
+"""Metrics in the Prometheus text format.
+
+Metrics are recorded in the server as well as in the render workers (e.g.
+subresource fetches). Render workers send the samples recorded during a job
+back together with its result (see :func:`drain` and :func:`merge`), so
+``/metrics`` of the server covers the whole pool.
+"""
+import math
+import threading
+
+
+REGISTRY = {}
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+FETCH_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = tuple(2 ** exponent * 1024 for exponent in range(4, 19, 2))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class of metrics with a fixed set of label names."""
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def drain(self):
+        """Return the recorded samples and reset them."""
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def merge(self, values):
+        for key, value in values.items():
+            with self.lock:
+                self.values[key] = self.values.get(key, 0) + value
+
+    def collect(self):
+        with self.lock:
+            values = dict(self.values)
+        return [
+            f'{self.name}{_labels(self.labelnames, key)} {_number(value)}'
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = (*buckets, math.inf)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def merge(self, values):
+        for key, (counts, total) in values.items():
+            with self.lock:
+                own_counts, own_total = self.values.get(key, ([0] * len(self.buckets), 0))
+                self.values[key] = (
+                    [own + other for own, other in zip(own_counts, counts)],
+                    own_total + total,
+                )
+
+    def collect(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _labels(self.labelnames, key, [('le', _number(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_number(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Collector(Metric):
+    """A metric read from the application state when it is scraped.
+
+    :param func: Returns the value, or a dict of label value tuples to
+        values if there are ``labelnames``.
+    :param type: ``gauge`` or ``counter``.
+    """
+
+    def __init__(self, name, help, func, labelnames=(), type='gauge'):
+        super().__init__(name, help, labelnames)
+        self.func = func
+        self.type = type
+
+    def drain(self):
+        return {}
+
+    def merge(self, values):
+        pass
+
+    def collect(self):
+        values = self.func()
+        if not self.labelnames:
+            values = {(): values}
+        return [
+            f'{self.name}{_labels(self.labelnames, key)} {_number(value)}'
+            for key, value in sorted(values.items())
+        ]
+
+
+def drain():
+    """Return the samples recorded in this process and reset them."""
+    samples = {}
+    for name, metric in REGISTRY.items():
+        values = metric.drain()
+        if values:
+            samples[name] = values
+    return samples
+
+
+def merge(samples):
+    """Add samples returned by :func:`drain` in another process."""
+    for name, values in samples.items():
+        metric = REGISTRY.get(name)
+        if metric is not None:
+            metric.merge(values)
+
+
+def render():
+    """Return all metrics in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY.values():
+        lines.extend(metric.header())
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+RENDER_DURATION = Histogram(
+    'pdfserver_render_duration_seconds',
+    'Time from accepting a conversion until its PDF is ready.',
+    ['endpoint', 'preset'],
+)
+QUEUE_WAIT = Histogram(
+    'pdfserver_queue_wait_seconds',
+    'Time jobs waited for a render worker.',
+    ['priority'],
+)
+WORKER_DURATION = Histogram(
+    'pdfserver_worker_duration_seconds',
+    'Time render workers spent on a job.',
+)
+PDF_SIZE = Histogram(
+    'pdfserver_pdf_size_bytes',
+    'Size of rendered PDFs.',
+    ['preset'],
+    buckets=SIZE_BUCKETS,
+)
+FETCH_DURATION = Histogram(
+    'pdfserver_fetch_duration_seconds',
+    'Time until the response headers of fetched documents and subresources arrived.',
+    ['host'],
+    buckets=FETCH_BUCKETS,
+)
+FETCH_BYTES = Counter(
+    'pdfserver_fetch_bytes_total',
+    'Bytes of fetched documents and subresources.',
+    ['host'],
+)
+WORKER_RESTARTS = Counter(
+    'pdfserver_worker_restarts_total',
+    'Render worker processes replaced by a new one.',
+    ['reason'],
+)
+IMAGE_CACHE_HITS = Counter(
+    'pdfserver_image_cache_hits_total',
+    'Images reused from earlier renders by the render workers.',
+)
+IMAGE_CACHE_MISSES = Counter(
+    'pdfserver_image_cache_misses_total',
+    'Images loaded by the render workers.',
+)
+RESOURCE_CACHE_HITS = Counter(
+    'pdfserver_resource_cache_hits_total',
+    'Subresources served from the resource cache of the render workers.',
+)
+RESOURCE_CACHE_MISSES = Counter(
+    'pdfserver_resource_cache_misses_total',
+    'Subresources fetched by the render workers without a cached response.',
+)
+RESOURCE_CACHE_REVALIDATIONS = Counter(
+    'pdfserver_resource_cache_revalidations_total',
+    'Stale cached subresources confirmed unchanged by their server.',
+)
+RESOURCE_CACHE_EVICTIONS = Counter(
+    'pdfserver_resource_cache_evictions_total',
+    'Subresources dropped from the resource cache to stay within its budget.',
+)
+FETCH_ERRORS = Counter(
+    'pdfserver_fetch_errors_total',
+    'Failed fetches of documents and subresources.',
+    ['host'],
+)
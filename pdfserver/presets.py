@@ -0,0 +1,65 @@
+"""Named sets of WeasyPrint output options.
+
+Presets trade output size against quality: images are recompressed and
+downsampled, fonts are hinted. Requests pick a preset (the default is
+``config.RENDER_PRESET``) and may override single options.
+"""
+from pdfserver import config
+
+
+PRESETS = {
+    # WeasyPrint defaults, images are embedded as they are
+    'default': {},
+    # Small files for reading on screens
+    'screen': {'optimize_images': True, 'jpeg_quality': 70, 'dpi': 96, 'hinting': True},
+    'ebook': {'optimize_images': True, 'jpeg_quality': 80, 'dpi': 150, 'hinting': True},
+    # Full resolution for printing, images are only recompressed losslessly
+    'print': {'optimize_images': True, 'dpi': 300},
+}
+
+
+def _boolean(value):
+    return isinstance(value, bool)
+
+
+def _quality(value):
+    return type(value) is int and 1 <= value <= 95
+
+
+def _dpi(value):
+    return type(value) is int and value > 0
+
+
+# WeasyPrint options a request may set, with their validators and the
+# description of valid values
+OPTIONS = {
+    'optimize_images': (_boolean, 'true or false'),
+    'jpeg_quality': (_quality, 'an integer from 1 to 95'),
+    'dpi': (_dpi, 'a positive integer'),
+    'hinting': (_boolean, 'true or false'),
+    'full_fonts': (_boolean, 'true or false'),
+}
+
+
+def resolve(preset=None, overrides=None):
+    """Return the options of ``preset`` with ``overrides`` applied.
+
+    :return: The WeasyPrint options, with the name of the preset as
+        ``preset``.
+    :raises ValueError: If the preset or an option is invalid.
+    """
+    preset = config.RENDER_PRESET if preset is None else preset
+    if preset not in PRESETS:
+        raise ValueError(f"Preset must be one of {', '.join(PRESETS)}")
+    options = dict(PRESETS[preset])
+    if overrides is not None:
+        if not isinstance(overrides, dict):
+            raise ValueError("Options must be an object")
+        for name, value in overrides.items():
+            if name not in OPTIONS:
+                raise ValueError(f"Unknown option: {name}")
+            valid, description = OPTIONS[name]
+            if not valid(value):
+                raise ValueError(f"Option {name} must be {description}")
+            options[name] = value
+    return {'preset': preset, **options}
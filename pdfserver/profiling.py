@@ -0,0 +1,99 @@
+"""Stage timings, peak memory and profiles of renders."""
+from contextlib import contextmanager
+from pdfserver.storage import spool_dir
+import cProfile
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+PROFILERS = ('cprofile', 'tracemalloc')
+
+
+def reset_peak_memory():
+    """Reset the peak resident memory of this process (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def resident_memory(pid):
+    """Return the current resident memory of the process ``pid`` in bytes,
+    or None where it can not be read (Linux only).
+    """
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_memory():
+    """Return the peak resident memory of this process in bytes, since the
+    last :func:`reset_peak_memory` on Linux, since the start elsewhere.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StageTimer:
+    """Wall clock time of consecutive stages, in seconds."""
+
+    def __init__(self):
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def stage(self, name):
+        """Record the time since the previous stage as ``name``."""
+        now = time.perf_counter()
+        self.timings[name] = now - self._last
+        self._last = now
+
+
+@contextmanager
+def profiled(profiler):
+    """Profile the enclosed code with ``cprofile`` or ``tracemalloc``.
+
+    :return: The list the path of the profile is appended to, a file in the
+        spool directory. Nothing is recorded if ``profiler`` is None.
+    """
+    paths = []
+    if profiler is None:
+        yield paths
+        return
+
+    fd, path = tempfile.mkstemp(dir=spool_dir(), suffix=f'.{profiler}')
+    os.close(fd)
+    try:
+        if profiler == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield paths
+            finally:
+                profile.disable()
+            profile.dump_stats(path)
+        else:
+            tracemalloc.start(25)
+            try:
+                yield paths
+                snapshot = tracemalloc.take_snapshot()
+            finally:
+                tracemalloc.stop()
+            snapshot.dump(path)
+    except BaseException:
+        os.unlink(path)
+        raise
+    paths.append(path)
@@ -1,62 +1,489 @@
 from aiohttp import web
-from concurrent.futures import ThreadPoolExecutor
+from pdfserver import bundles
+from pdfserver import config
+from pdfserver import metrics
+from pdfserver import presets
 from pdfserver.cache import ExpiringPDFCache
-from pdfserver.fetcher import basic_auth_url_fetcher
+from pdfserver.engine import PRIORITY_BACKGROUND
+from pdfserver.engine import PRIORITY_INTERACTIVE
+from pdfserver.engine import QueueFull
+from pdfserver.engine import RenderEngine
+from pdfserver.engine import RenderLimitExceeded
+from pdfserver.fetcher import fetch_validators
 from pdfserver.log import logger
+from pdfserver.profiling import StageTimer
+from pdfserver.storage import store_dir
+from pdfserver.store import JobStore
+from pdfserver.uploads import UploadedHTML
+from pdfserver.utils import extract_batch_data_from_request
 from pdfserver.utils import extract_html_data_from_request
 from pdfserver.utils import extrat_data_from_request
+from pdfserver.utils import parse_wait
 from pdfserver.utils import pdf_response
+from pdfserver.utils import render_key
 from pdfserver.utils import TaskStatus
-from weasyprint import HTML
-from weasyprint.text.fonts import FontConfiguration
+from pdfserver.webhooks import WebhookSender
+from pdfserver.worker import count_chunk_pages
+from pdfserver.worker import init_worker
+from pdfserver.worker import merge_pdfs
+from pdfserver.worker import plan_chunks
+from pdfserver.worker import render_chunk
+from pdfserver.worker import render_html
+from pdfserver.worker import render_html_file
+from pdfserver.worker import render_url
+from pdfserver.worker import warm_up
+from pdfserver.worker import zip_pdfs
+from contextlib import suppress
 from weasyprint.urls import URLFetchingError
 import markdown
 import asyncio
-import io
+import itertools
+import json
+import os
+import signal
+import sys
+import time
 
 
+# Seconds between checks of jobs of other server processes, see ``poll_interval``
+STORE_POLL_INTERVAL = 0.5
+# Server processes exiting within RESTART_MIN_UPTIME seconds are restarted
+# after a delay, doubled from RESTART_BACKOFF up to RESTART_BACKOFF_MAX
+# seconds, at most RESTART_ATTEMPTS times in a row, see ``serve_processes``
+RESTART_MIN_UPTIME = 10
+RESTART_BACKOFF = 1
+RESTART_BACKOFF_MAX = 60
+RESTART_ATTEMPTS = 5
+
+# Seconds spent in the startup phases of the server process, see /ready
+startup_timings = {}
+
 routes = web.RouteTableDef()
 pdf_cache = ExpiringPDFCache(expiry_minutes=30)
-pdf_executor = ThreadPoolExecutor(max_workers=10)
+render_engine = RenderEngine()
+webhook_sender = WebhookSender()
+# References to the tasks of asynchronous jobs, so they are not garbage
+# collected while running.
+background_tasks = set()
+
+
+def start_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+metrics.Collector(
+    'pdfserver_queue_depth', 'Jobs waiting for a render worker.', lambda: render_engine.queued()
+)
+metrics.Collector('pdfserver_workers', 'Render worker processes.', lambda: render_engine.size)
+metrics.Collector(
+    'pdfserver_workers_busy', 'Render workers rendering a job.', lambda: render_engine.busy()
+)
+metrics.Collector(
+    'pdfserver_cache_jobs', 'Jobs in the PDF cache.', lambda: pdf_cache.stats()['jobs']
+)
+metrics.Collector(
+    'pdfserver_cache_pdfs', 'Finished PDFs in the PDF cache.', lambda: pdf_cache.stats()['pdfs']
+)
+metrics.Collector(
+    'pdfserver_cache_bytes', 'Size of the PDFs in the PDF cache.',
+    lambda: {
+        ('memory',): pdf_cache.stats()['memory_bytes'],
+        ('disk',): pdf_cache.stats()['disk_bytes'],
+    },
+    labelnames=['storage'],
+)
+for name in ('hits', 'misses', 'evictions', 'expirations'):
+    metrics.Collector(
+        f'pdfserver_cache_{name}_total', f'PDF cache {name}.',
+        lambda name=name: pdf_cache.stats()[name], type='counter',
+    )
+
+
+async def url_render_key(url, css, options=None, css_profile=None, split=None):
+    """Content address of rendering ``url`` with the stylesheets ``css``
+    and ``css_profile`` and the output ``options``, in chunks if ``split``
+    is given.
+
+    The validators (ETag / Last-Modified) of the document and stylesheets
+    are part of the key, they are fetched with concurrent HEAD requests off
+    the event loop. Without result reuse (``config.RESULT_CACHE``), they
+    are not needed and not fetched.
+
+    :return: A (key, cacheable) tuple. The result may only be cached if all
+        validators are known.
+    """
+    sources = [url, *css]
+    if not config.RESULT_CACHE:
+        key = render_key(
+            'url', url, css, options, bundles.digest(css_profile), [None] * len(sources), split
+        )
+        return key, False
+    validators = await asyncio.gather(
+        *(asyncio.to_thread(fetch_validators, source) for source in sources)
+    )
+    key = render_key('url', url, css, options, bundles.digest(css_profile), validators, split)
+    return key, all(validators)
+
 
+def html_render_key(html_content, css, options=None, css_profile=None, split=None):
+    """Content address of rendering an HTML string or
+    :class:`UploadedHTML`.
 
-def _create_pdf_sync(url, css):
-    temp_file = io.BytesIO()
-    font_config = FontConfiguration()
+    :return: A (key, cacheable) tuple.
+    """
+    if isinstance(html_content, UploadedHTML):
+        key = render_key(
+            'html-file', html_content.digest, css, options, bundles.digest(css_profile), split
+        )
+    else:
+        key = render_key(
+            'html', html_content, css, options, bundles.digest(css_profile), split
+        )
+    return key, bool(config.RESULT_CACHE)
+
+
+async def render_cached(key, cacheable, func, *args, timeout=None,
+                        priority=PRIORITY_BACKGROUND, job=None, cleanup=None, split=None,
+                        admission=None):
+    """Return the PDF with the content address ``key`` from the result
+    cache, or render it. A render which is already in flight for the same
+    key is shared instead of started again.
+
+    :param job: The job record waiting for the render, its queue position
+        is reported by ``/status``.
+    :param cleanup: Called once the render does not need its input anymore
+        (e.g. to delete an uploaded document).
+    :param split: Render in chunks split before the elements matching this
+        selector, see :func:`render_split`.
+    :param admission: The queue slot reserved for the render, see
+        ``RenderEngine.admit``.
+    :return: The PDF (see ``pdfserver.storage``).
+    """
+    if cacheable:
+        pdf_data = pdf_cache.find_result(key)
+        if pdf_data is not None:
+            logger.info(f"Reusing rendered PDF: {key}")
+            if cleanup is not None:
+                cleanup()
+            return pdf_data
+    if split is not None:
+        try:
+            pdf_data = await asyncio.wait_for(
+                render_split(split, func, *args, priority=priority, admission=admission), timeout
+            )
+        finally:
+            if cleanup is not None:
+                cleanup()
+        return await pdf_cache.fit_to_budget(pdf_data)
     try:
-        html = HTML(url, url_fetcher=basic_auth_url_fetcher)
-        html.write_pdf(temp_file, stylesheets=css, font_config=font_config)
-        return temp_file
-    except URLFetchingError:
-        logger.error(f"Failed to fetch URL: {url}")
+        render_job = render_engine.submit(
+            func, *args, key=key, priority=priority, admission=admission
+        )
+    except BaseException:
+        if cleanup is not None:
+            cleanup()
         raise
-    except Exception as e:
-        logger.error(f"Error generating PDF: {e}")
+    if cleanup is not None:
+        render_job.future.add_done_callback(lambda future: cleanup())
+    if job is not None:
+        job.render = render_job
+    try:
+        pdf_data = await render_engine.wait(render_job, timeout)
+    finally:
+        if job is not None:
+            job.render = None
+    return await pdf_cache.fit_to_budget(pdf_data)
+
+
+async def render_for_request(key, cacheable, func, *args, timeout=None, cleanup=None,
+                             split=None, admission=None):
+    """Render on behalf of a synchronous request.
+
+    The render is abandoned when the deadline passes or when the client
+    disconnects (the handler task gets cancelled), which frees the worker.
+    """
+    try:
+        return await render_cached(
+            key, cacheable, func, *args, timeout=timeout, priority=PRIORITY_INTERACTIVE,
+            cleanup=cleanup, split=split, admission=admission,
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"Render abandoned after {timeout}s deadline")
+        raise
+    except asyncio.CancelledError:
+        logger.info("Client disconnected, render abandoned")
+        raise
+
+
+# Documents the render functions take, for splitting them into chunks
+SPLIT_DOCUMENTS = {render_url: 'url', render_html: 'html', render_html_file: 'html-file'}
+
+
+async def gather_jobs(jobs, discard=None):
+    """Await all ``jobs``. When one of them fails, the others are cancelled,
+    the results of those which finished are passed to ``discard``, and the
+    exception is raised.
+    """
+    tasks = [asyncio.ensure_future(job) for job in jobs]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if discard is not None:
+            for task in tasks:
+                if not task.cancelled() and task.exception() is None:
+                    discard(task.result())
+        raise
+
+
+async def render_split(split, func, source, css, profile, options, css_profile,
+                       priority=PRIORITY_BACKGROUND, admission=None):
+    """Render a document in chunks on all render workers and merge them,
+    see ``pdfserver.chunks``. If the document shows page numbers, the
+    pages of the chunks are counted in a first pass, along with the
+    rendering of the first chunk.
+
+    Documents which can not be split are rendered in one piece.
+
+    :param func: The render function of the whole document, followed by
+        its arguments.
+    :return: The PDF (see ``pdfserver.storage``).
+    """
+    start = time.monotonic()
+    document = (SPLIT_DOCUMENTS[func], source)
+    count, page_numbers = await render_engine.run(
+        plan_chunks, document, css, css_profile, split, priority=priority, admission=admission
+    )
+    if count < 2:
+        return await render_engine.run(
+            func, source, css, profile, options, css_profile, priority=priority
+        )
+
+    pdfs = [None] * count
+    offsets = [0] * count
+    if page_numbers:
+        # The first chunk needs no offset, it is rendered while the pages of
+        # the others are counted. Nothing follows the last one, it is not
+        # counted.
+        def discard(result):
+            if not isinstance(result, int):
+                result.delete()
+
+        pdfs[0], *pages = await gather_jobs(
+            [
+                render_engine.run(
+                    render_chunk, document, css, options, css_profile, split, 0, priority=priority
+                ),
+                *(
+                    render_engine.run(
+                        count_chunk_pages, document, css, options, css_profile, split, index,
+                        priority=priority,
+                    )
+                    for index in range(1, count - 1)
+                ),
+            ],
+            discard=discard,
+        )
+        offsets = list(itertools.accumulate([pdfs[0].stats['pages'], *pages], initial=0))
+    remaining = [index for index in range(count) if pdfs[index] is None]
+    try:
+        rendered = await gather_jobs(
+            (
+                render_engine.run(
+                    render_chunk, document, css, options, css_profile, split, index, offsets[index],
+                    priority=priority,
+                )
+                for index in remaining
+            ),
+            discard=lambda pdf: pdf.delete(),
+        )
+    except BaseException:
+        if pdfs[0] is not None:
+            pdfs[0].delete()
         raise
+    for index, pdf in zip(remaining, rendered):
+        pdfs[index] = pdf
+    try:
+        pdf_data = await render_engine.run(merge_pdfs, pdfs, True, priority=priority)
+    finally:
+        for pdf in pdfs:
+            pdf.delete()
+    pdf_data.stats = {
+        'chunks': count,
+        'passes': 2 if page_numbers else 1,
+        'pages': sum(pdf.stats['pages'] for pdf in pdfs),
+        'total': round(time.monotonic() - start, 4),
+        'size': pdf_data.size,
+        'preset': preset_name(options),
+    }
+    logger.info(f"Rendered document in {count} chunks: {json.dumps(pdf_data.stats)}")
+    return pdf_data
+
+
+def queue_full_response(error):
+    return web.json_response(
+        {"error": "Too many PDFs are queued, try again later"},
+        status=429,
+        headers={'Retry-After': str(error.retry_after)}
+    )
+
+
+def profile_sync_response():
+    return web.json_response(
+        {"error": "Profiling is only available for asynchronous conversions"},
+        status=400
+    )
+
+
+def preset_name(options):
+    """Label of the output preset of ``options``, for the metrics."""
+    return (options or {}).get('preset', 'default')
 
 
-async def create_pdf(url, css, filename, uid):
+def discard_upload(html_content):
+    if isinstance(html_content, UploadedHTML):
+        html_content.delete()
+
+
+def html_renderer(html_content):
+    """Return the render function, its HTML argument and the cleanup for
+    ``html_content`` of a request.
+    """
+    if isinstance(html_content, UploadedHTML):
+        return render_html_file, html_content.path, html_content.delete
+    return render_html, html_content, None
+
+
+def render_error(error):
+    """Message of a failed render for the job record or the response."""
+    if isinstance(error, RenderLimitExceeded):
+        return str(error)
+    return 'Error generating PDF'
+
+
+async def send_result(request, key, cacheable, filename, pdf_data):
+    """Send the PDF rendered for a synchronous request, and store it for
+    identical requests if ``cacheable`` (or to release its file when it
+    expires).
+
+    Storing it can evict it right away, it is kept until it is sent.
+    """
+    pdf_cache.pin(pdf_data)
+    try:
+        if cacheable or pdf_data.path is not None:
+            pdf_cache.store_result(key if cacheable else None, filename, pdf_data)
+        response = pdf_response(request, pdf_data, filename)
+        await response.prepare(request)
+        return response
+    finally:
+        pdf_cache.unpin(pdf_data)
+
+
+def remaining_time(start, timeout):
+    """Seconds left of the client deadline ``timeout`` of a request
+    started at ``start``, or None without deadline.
+    """
+    if timeout is None:
+        return None
+    return max(0, timeout - (time.monotonic() - start))
+
+
+def render_timeout_response(timeout):
+    return web.json_response(
+        {"error": f"PDF generation exceeded the deadline of {timeout} seconds"},
+        status=504
+    )
+
+
+async def create_pdf(url, css, filename, uid, endpoint='convert', profile=None, options=None,
+                     css_profile=None, split=None, admission=None):
     """
     Helper function to create a PDF from a URL with optional CSS files.
 
     :param url: The URL to fetch HTML from.
-    :param css_files: List of CSS file URLs to apply.
+    :param css: List of CSS file URLs to apply.
     :param filename: Name of the output PDF file.
     :param uid: Unique identifier for the PDF.
+    :param endpoint: Endpoint name for the metrics.
+    :param profile: Profiler to run during the render, which is never
+        shared with other requests then.
+    :param options: Output options, see ``pdfserver.presets``.
+    :param css_profile: Name of a stylesheet bundle applied before ``css``.
+    :param admission: The queue slot reserved for the render, released
+        when done.
     :return: BytesIO object containing the PDF data.
     """
-    cache = pdf_cache.storage[uid]
+    start = time.monotonic()
     try:
-        # Run the blocking PDF generation in a thread pool
-        loop = asyncio.get_event_loop()
-        temp_file = await loop.run_in_executor(pdf_executor, _create_pdf_sync, url, css)
-        pdf_cache.save_pdf(uid, filename, temp_file)
+        if profile is None:
+            key, cacheable = await url_render_key(url, css, options, css_profile, split)
+        else:
+            key, cacheable = None, False
+        # Run the blocking PDF generation in a render worker process
+        pdf_data = await render_cached(
+            key, cacheable, render_url, url, css, profile, options, css_profile,
+            job=pdf_cache.storage.get(uid), split=split, admission=admission,
+        )
+        pdf_cache.save_pdf(uid, filename, pdf_data, key=key if cacheable else None)
+        metrics.RENDER_DURATION.observe(
+            time.monotonic() - start, endpoint=endpoint, preset=preset_name(options)
+        )
     except URLFetchingError:
-        cache['status'] = TaskStatus.FAILED.value
-        cache['message'] = 'Failed to fetch URL'
-    except Exception:
-        cache['status'] = TaskStatus.FAILED.value
-        cache['message'] = 'Error generating PDF'
+        pdf_cache.fail_pdf(uid, 'Failed to fetch URL')
+    except Exception as e:
+        pdf_cache.fail_pdf(uid, render_error(e))
+    finally:
+        if admission is not None:
+            admission.release()
+
+
+def public_origin(request):
+    """Origin of the links to this server sent to callbacks of
+    ``request``: ``config.PUBLIC_URL`` if set, else the origin the client
+    used, as forwarded by a proxy in ``X-Forwarded-Proto`` and
+    ``X-Forwarded-Host``.
+    """
+    if config.PUBLIC_URL:
+        return config.PUBLIC_URL.rstrip('/')
+    scheme = request.headers.get('X-Forwarded-Proto', request.scheme)
+    host = request.headers.get('X-Forwarded-Host', request.host)
+    # The first proxy is closest to the client
+    return f"{scheme.split(',')[0].strip()}://{host.split(',')[0].strip()}"
+
+
+async def with_callback(job, origin, uid, callback, callback_mode):
+    """Run ``job`` and POST its result to ``callback`` afterwards.
+
+    With ``callback_mode`` ``link``, the status (see ``/status``) is sent
+    as JSON, with absolute download URLs starting with ``origin`` (see
+    :func:`public_origin`). With ``pdf``, the PDF itself is sent if the
+    job completed.
+    """
+    await job
+    if callback is None:
+        return
+    pdf = pdf_cache.get_pdf(uid)
+    if pdf is None:
+        return
+    status = job_status(uid, pdf)
+    for link in ('download', 'profile'):
+        if link in status:
+            status[link] = origin + status[link]
+    if pdf.status != TaskStatus.COMPLETED.value or callback_mode != 'pdf':
+        await webhook_sender.deliver(callback, status)
+        return
+    # The PDF must not be removed while it is sent, which takes a while
+    # with retries
+    pdf_cache.pin(pdf.data)
+    try:
+        await webhook_sender.deliver(callback, status, pdf)
+    finally:
+        pdf_cache.unpin(pdf.data)
 
 
 @routes.post('/convert')
@@ -73,6 +500,7 @@ async def convert_to_pdf(request):
 
     Returns:
     - JSON response with PDF ID and status "running".
+    - 429 if too many PDFs are queued.
     """
     data = await extrat_data_from_request(request)
 
@@ -81,11 +509,22 @@ async def convert_to_pdf(request):
             {"error": data['error']},
             status=400
         )
+    try:
+        admission = render_engine.admit()
+    except QueueFull as e:
+        return queue_full_response(e)
 
-    uid, cache = pdf_cache.add()
-    asyncio.create_task(create_pdf(data['url'], data['css'], data['filename'], uid))
+    uid, job = pdf_cache.add()
+    start_background(with_callback(
+        create_pdf(
+            data['url'], data['css'], data['filename'], uid,
+            profile=data['profile'], options=data['options'], css_profile=data['css_profile'],
+            split=data['split'], admission=admission,
+        ),
+        public_origin(request), uid, data['callback'], data['callback_mode'],
+    ))
     response = web.json_response(
-        {"uid": uid, "filename": data['filename'], "status": cache['status']},
+        {"uid": uid, "filename": data['filename'], "status": job.status},
         status=200
     )
     return response
@@ -101,10 +540,14 @@ async def convert_to_pdf_sync(request):
         "url": "http://localhost/path/to/endpoint",
         "css_files": ["http://localhost/path/to/file.css", ...],
         "filename": 'a_file.pdf',
+        "timeout": 30,
     }
     Returns:
     - A PDF file as a response.
+    - 429 if too many PDFs are queued.
+    - 504 if the render did not finish within ``timeout`` seconds.
     """
+    start = time.monotonic()
     data = await extrat_data_from_request(request)
 
     if data['error']:
@@ -112,44 +555,68 @@ async def convert_to_pdf_sync(request):
             {"error": data['error']},
             status=400
         )
+    if data['profile']:
+        return profile_sync_response()
     try:
-        temp_file = _create_pdf_sync(data['url'], data['css'])
+        admission = render_engine.admit()
+    except QueueFull as e:
+        return queue_full_response(e)
+    try:
+        # The deadline covers looking up the document and rendering it
+        key, cacheable = await asyncio.wait_for(
+            url_render_key(
+                data['url'], data['css'], data['options'], data['css_profile'], data['split']
+            ),
+            remaining_time(start, data['timeout']),
+        )
+        pdf_data = await render_for_request(
+            key, cacheable, render_url, data['url'], data['css'], None, data['options'],
+            data['css_profile'], timeout=remaining_time(start, data['timeout']),
+            split=data['split'], admission=admission,
+        )
+    except asyncio.TimeoutError:
+        return render_timeout_response(data['timeout'])
     except URLFetchingError:
         return web.json_response(
             {"error": "Failed to fetch URL"},
             status=400
         )
-    except Exception:
+    except Exception as e:
         return web.json_response(
-            {"error": "Error generating PDF"},
+            {"error": render_error(e)},
             status=400
         )
-    return pdf_response(temp_file, data['filename'])
-
-
-def _create_pdf_from_html_sync(html_content, css):
-    temp_file = io.BytesIO()
-    font_config = FontConfiguration()
-    try:
-        html = HTML(string=html_content)
-        html.write_pdf(temp_file, stylesheets=css, font_config=font_config)
-        return temp_file
-    except Exception as e:
-        logger.error(f"Error generating PDF: {e}")
-        raise
+    finally:
+        admission.release()
+    metrics.RENDER_DURATION.observe(
+        time.monotonic() - start, endpoint='convert_sync', preset=preset_name(data['options'])
+    )
+    return await send_result(request, key, cacheable, data['filename'], pdf_data)
 
 
-async def create_pdf_from_html(html_content, css, filename, uid):
-    cache = pdf_cache.storage[uid]
+async def create_pdf_from_html(html_content, css, filename, uid, endpoint='convert-html',
+                               profile=None, options=None, css_profile=None, split=None,
+                               admission=None):
+    start = time.monotonic()
     try:
-        loop = asyncio.get_event_loop()
-        temp_file = await loop.run_in_executor(
-            pdf_executor, _create_pdf_from_html_sync, html_content, css
+        if profile is None:
+            key, cacheable = html_render_key(html_content, css, options, css_profile, split)
+        else:
+            key, cacheable = None, False
+        func, html_arg, cleanup = html_renderer(html_content)
+        pdf_data = await render_cached(
+            key, cacheable, func, html_arg, css, profile, options, css_profile,
+            job=pdf_cache.storage.get(uid), cleanup=cleanup, split=split, admission=admission,
         )
-        pdf_cache.save_pdf(uid, filename, temp_file)
-    except Exception:
-        cache['status'] = TaskStatus.FAILED.value
-        cache['message'] = 'Error generating PDF'
+        pdf_cache.save_pdf(uid, filename, pdf_data, key=key if cacheable else None)
+        metrics.RENDER_DURATION.observe(
+            time.monotonic() - start, endpoint=endpoint, preset=preset_name(options)
+        )
+    except Exception as e:
+        pdf_cache.fail_pdf(uid, render_error(e))
+    finally:
+        if admission is not None:
+            admission.release()
 
 
 @routes.post('/convert-html')
@@ -159,66 +626,372 @@ async def convert_html_to_pdf(request):
     if data['error']:
         return web.json_response(
             {"error": data['error']},
-            status=400
+            status=data['error_status']
         )
 
-    uid, cache = pdf_cache.add()
-    asyncio.create_task(
-        create_pdf_from_html(data['html'], data['css'], data['filename'], uid)
-    )
+    try:
+        admission = render_engine.admit()
+    except QueueFull as e:
+        discard_upload(data['html'])
+        return queue_full_response(e)
+
+    uid, job = pdf_cache.add()
+    start_background(with_callback(
+        create_pdf_from_html(
+            data['html'], data['css'], data['filename'], uid,
+            profile=data['profile'], options=data['options'], css_profile=data['css_profile'],
+            split=data['split'], admission=admission,
+        ),
+        public_origin(request), uid, data['callback'], data['callback_mode'],
+    ))
     return web.json_response(
-        {"uid": uid, "filename": data['filename'], "status": cache['status']},
+        {"uid": uid, "filename": data['filename'], "status": job.status},
         status=200
     )
 
 
 @routes.post('/convert-html_sync')
 async def convert_html_to_pdf_sync(request):
+    start = time.monotonic()
     data = await extract_html_data_from_request(request)
 
     if data['error']:
         return web.json_response(
             {"error": data['error']},
+            status=data['error_status']
+        )
+    if data['profile']:
+        discard_upload(data['html'])
+        return profile_sync_response()
+    try:
+        admission = render_engine.admit()
+    except QueueFull as e:
+        discard_upload(data['html'])
+        return queue_full_response(e)
+
+    key, cacheable = html_render_key(
+        data['html'], data['css'], data['options'], data['css_profile'], data['split']
+    )
+    func, html_arg, cleanup = html_renderer(data['html'])
+    try:
+        pdf_data = await render_for_request(
+            key, cacheable, func, html_arg, data['css'], None, data['options'],
+            data['css_profile'], timeout=remaining_time(start, data['timeout']), cleanup=cleanup,
+            split=data['split'], admission=admission,
+        )
+    except asyncio.TimeoutError:
+        return render_timeout_response(data['timeout'])
+    except Exception as e:
+        return web.json_response(
+            {"error": render_error(e)},
             status=400
         )
+    finally:
+        admission.release()
+    metrics.RENDER_DURATION.observe(
+        time.monotonic() - start, endpoint='convert-html_sync',
+        preset=preset_name(data['options']),
+    )
+    return await send_result(request, key, cacheable, data['filename'], pdf_data)
+
+
+def batch_concurrency():
+    """Number of items of a batch which are queued at the same time."""
+    return 2 * render_engine.size
+
+
+async def create_batch(batch_id, items, output, filename, admission=None):
+    """
+    Helper function to render the items of a batch in parallel and
+    optionally combine them.
+
+    :param batch_id: Unique identifier of the batch.
+    :param items: Item payloads, see ``extract_batch_data_from_request``.
+    :param output: ``pdf`` to merge the PDFs, ``zip`` for a ZIP archive or
+        None to keep the PDFs separate.
+    :param filename: Name of the combined file.
+    :param admission: The queue slots reserved for the first items.
+    """
+    uids = pdf_cache.storage[batch_id].items
+    # Feed the queue gradually, so a large batch does not crowd out other
+    # jobs or exceed the queue depth
+    slots = asyncio.Semaphore(batch_concurrency())
+
+    async def create_item(uid, item):
+        async with slots:
+            item_admission = admission.take() if admission is not None else None
+            if 'url' in item:
+                await create_pdf(
+                    item['url'], item['css'], item['filename'], uid,
+                    endpoint='convert-batch', options=item['options'],
+                    css_profile=item['css_profile'], admission=item_admission,
+                )
+            else:
+                await create_pdf_from_html(
+                    item['html'], item['css'], item['filename'], uid,
+                    endpoint='convert-batch', options=item['options'],
+                    css_profile=item['css_profile'], admission=item_admission,
+                )
+
+    try:
+        await asyncio.gather(*(create_item(uid, item) for uid, item in zip(uids, items)))
+    finally:
+        if admission is not None:
+            admission.release()
+
+    jobs = [pdf_cache.get_pdf(uid) for uid in uids]
+    failed = sum(1 for job in jobs if job is None or job.status != TaskStatus.COMPLETED.value)
+    if failed:
+        pdf_cache.fail_pdf(batch_id, f'Failed to generate {failed} of {len(jobs)} PDFs')
+        return
+    if output is None:
+        pdf_cache.complete_batch(batch_id)
+        return
+
     try:
-        temp_file = _create_pdf_from_html_sync(data['html'], data['css'])
+        if output == 'zip':
+            pdf_data = await render_engine.run(zip_pdfs, [(job.filename, job.data) for job in jobs])
+            content_type = 'application/zip'
+        else:
+            pdf_data = await render_engine.run(merge_pdfs, [job.data for job in jobs])
+            content_type = 'application/pdf'
+        pdf_data = await pdf_cache.fit_to_budget(pdf_data)
+        pdf_cache.save_pdf(batch_id, filename, pdf_data, content_type=content_type)
     except Exception:
+        pdf_cache.fail_pdf(batch_id, 'Error combining PDFs')
+
+
+def batch_status(batch_id, batch):
+    items = []
+    for uid in batch.items:
+        job = pdf_cache.get_pdf(uid)
+        if job is None:
+            items.append({"uid": uid, "status": TaskStatus.FAILED.value, "message": "PDF not found"})
+            continue
+        item = {"uid": uid, "filename": job.filename, "status": job.status, "message": job.message}
+        if job.status == TaskStatus.COMPLETED.value:
+            item['download'] = f'/pdf/{uid}'
+        items.append(item)
+
+    response_data = {
+        "batch_id": batch_id,
+        "status": batch.status,
+        "filename": batch.filename,
+        "message": batch.message,
+        "items": items,
+    }
+    if batch.status == TaskStatus.COMPLETED.value and batch.data is not None:
+        response_data['download'] = f'/pdf/{batch_id}'
+    return response_data
+
+
+@routes.post('/convert-batch')
+async def convert_batch(request):
+    """
+    Asynchronous endpoint to convert many URLs and HTML strings at once.
+
+    Expected JSON payload:
+    {
+        "items": [
+            {"url": "http://localhost/invoice/1", "css": [...], "filename": "1.pdf"},
+            {"html": "<h1>Invoice 2</h1>", "css": "h1 { color: red; }"},
+            ...
+        ],
+        "output": "pdf",
+        "filename": "invoices.pdf",
+    }
+    Returns:
+    - The batch id and the uids of the items.
+    """
+    data = await extract_batch_data_from_request(request)
+
+    if data['error']:
         return web.json_response(
-            {"error": "Error generating PDF"},
+            {"error": data['error']},
             status=400
         )
-    return pdf_response(temp_file, data['filename'])
+    try:
+        admission = render_engine.admit(min(len(data['items']), batch_concurrency()))
+    except QueueFull as e:
+        return queue_full_response(e)
+
+    batch_id, batch = pdf_cache.add_batch(
+        data['filename'], [item['filename'] for item in data['items']]
+    )
+    start_background(
+        create_batch(batch_id, data['items'], data['output'], data['filename'], admission)
+    )
+    return web.json_response(batch_status(batch_id, batch), status=200)
+
+
+def poll_interval(uids, timeout):
+    """Seconds to wait for a notification about ``uids``. Jobs of other
+    server processes do not notify this one, their state is polled from the
+    shared store.
+    """
+    if all(uid in pdf_cache.storage for uid in uids):
+        return timeout
+    return min(timeout, STORE_POLL_INTERVAL)
+
+
+async def wait_for_change(uid, timeout):
+    """Wait up to ``timeout`` seconds for the job ``uid`` to complete, fail
+    or expire.
+    """
+    deadline = time.monotonic() + timeout
+    queue = pdf_cache.subscribe([uid])
+    try:
+        while True:
+            pdf = pdf_cache.get_pdf(uid)
+            remaining = deadline - time.monotonic()
+            if pdf is None or pdf.status != TaskStatus.RUNNING.value or remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(queue.get(), poll_interval([uid], remaining))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        pdf_cache.unsubscribe([uid], queue)
+
+
+@routes.get('/batch/{batch_id}')
+async def get_batch_status(request):
+    batch_id = request.match_info['batch_id']
+    wait, error = parse_wait(request.query)
+    if error:
+        return web.json_response(
+            {"error": error},
+            status=400
+        )
+    batch = pdf_cache.get_pdf(batch_id)
+    if batch and batch.items is not None and wait and batch.status == TaskStatus.RUNNING.value:
+        await wait_for_change(batch_id, wait)
+        batch = pdf_cache.get_pdf(batch_id)
+    if not batch or batch.items is None:
+        return web.json_response(
+            {"error": "Batch not found"},
+            status=404
+        )
+    return web.json_response(batch_status(batch_id, batch))
+
+
+def job_status(pdf_id, pdf):
+    response_data = {
+        "uid": pdf_id,
+        "status": pdf.status,
+        "filename": pdf.filename,
+        'timestamp': pdf.timestamp,
+        'message': pdf.message
+    }
+
+    if pdf.status == TaskStatus.COMPLETED.value:
+        response_data['download'] = f'/pdf/{pdf_id}'
+        if pdf.stats is not None:
+            response_data['stats'] = pdf.stats
+        if pdf.profile is not None:
+            response_data['profile'] = f'/profile/{pdf_id}'
+    elif pdf.render is not None:
+        position = render_engine.position(pdf.render)
+        if position is not None:
+            response_data['queue_position'] = position
+    return response_data
 
 
 @routes.get('/status/{pdf_id}')
 async def get_pdf_status(request):
+    """
+    Status of a job. With ``?wait=<seconds>``, the response of a running
+    job is delayed until it completes or fails (long-polling).
+    """
     pdf_id = request.match_info['pdf_id']
+    wait, error = parse_wait(request.query)
+    if error:
+        return web.json_response(
+            {"error": error},
+            status=400
+        )
     pdf = pdf_cache.get_pdf(pdf_id)
+    if pdf and wait and pdf.status == TaskStatus.RUNNING.value:
+        await wait_for_change(pdf_id, wait)
+        pdf = pdf_cache.get_pdf(pdf_id)
     if not pdf:
         return web.json_response(
             {"error": "PDF not found"},
             status=404
         )
+    return web.json_response(job_status(pdf_id, pdf))
 
-    response_data = {
-        "uid": pdf_id,
-        "status": pdf['status'],
-        "filename": pdf['filename'],
-        'timestamp': pdf['timestamp'],
-        'message': pdf['message']
-    }
 
-    if pdf['status'] == TaskStatus.COMPLETED.value:
-        response_data['download'] = f'/pdf/{pdf_id}'
-    return web.json_response(response_data)
+@routes.get('/events')
+async def job_events(request):
+    """
+    Server-Sent Events stream of the status of the jobs given as
+    ``?ids=<uid>,<uid>,...``. The current status of each job is sent
+    first, then every change. The stream ends once all jobs are completed,
+    failed or gone.
+    """
+    uids = list(dict.fromkeys(uid for uid in request.query.get('ids', '').split(',') if uid))
+    if not uids:
+        return web.json_response(
+            {"error": "Job ids are required"},
+            status=400
+        )
+
+    queue = pdf_cache.subscribe(uids)
+    try:
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+        })
+        await response.prepare(request)
+        pending = set(uids)
+        for uid in uids:
+            await send_job_event(response, uid, pending)
+        idle = 0
+        while pending:
+            interval = poll_interval(pending, config.STATUS_MAX_WAIT)
+            try:
+                uid = await asyncio.wait_for(queue.get(), interval)
+            except asyncio.TimeoutError:
+                # Check on the jobs of other server processes
+                for uid in [uid for uid in pending if uid not in pdf_cache.storage]:
+                    pdf = pdf_cache.get_pdf(uid)
+                    if pdf is None or pdf.status != TaskStatus.RUNNING.value:
+                        await send_job_event(response, uid, pending)
+                idle += interval
+                if idle >= config.STATUS_MAX_WAIT:
+                    await response.write(b': keep-alive\n\n')
+                    idle = 0
+                continue
+            if uid in pending:
+                await send_job_event(response, uid, pending)
+        await response.write_eof()
+        return response
+    finally:
+        pdf_cache.unsubscribe(uids, queue)
+
+
+async def send_job_event(response, uid, pending):
+    pdf = pdf_cache.get_pdf(uid)
+    if pdf is None:
+        data = {"uid": uid, "error": "PDF not found"}
+    else:
+        data = job_status(uid, pdf)
+    if pdf is None or pdf.status != TaskStatus.RUNNING.value:
+        pending.discard(uid)
+    await response.write(f'event: status\ndata: {json.dumps(data)}\n\n'.encode())
 
 
 @routes.get('/pdf/{pdf_id}')
 async def get_pdf(request):
     pdf_id = request.match_info['pdf_id']
     pdf = pdf_cache.get_pdf(pdf_id)
-    return pdf_response(pdf['data'], pdf['filename'])
+    if not pdf or pdf.status != TaskStatus.COMPLETED.value:
+        return web.json_response(
+            {"error": "PDF not found"},
+            status=404
+        )
+    return pdf_response(request, pdf.data, pdf.filename, pdf.content_type)
 
 
 @routes.get('/')
@@ -261,26 +1034,158 @@ async def index(request):
     return web.Response(text=html_content, content_type='text/html')
 
 
+@routes.get('/profile/{pdf_id}')
+async def get_profile(request):
+    pdf_id = request.match_info['pdf_id']
+    pdf = pdf_cache.get_pdf(pdf_id)
+    if not pdf or pdf.profile is None:
+        return web.json_response(
+            {"error": "Profile not found"},
+            status=404
+        )
+    extension = os.path.splitext(pdf.profile)[1]
+    return web.FileResponse(pdf.profile, headers={
+        'Content-Type': 'application/octet-stream',
+        'Content-Disposition': f'attachment; filename="{pdf_id}{extension}"',
+    })
+
+
+@routes.get('/metrics')
+async def get_metrics(request):
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+    )
+
+
 @routes.get('/health')
 async def health_check(request):
     return web.Response(text="OK", content_type='text/plain')
 
 
+@routes.get('/ready')
+async def ready_check(request):
+    """Ready once every render worker has been warmed up. Reports the
+    seconds spent in the startup phases of the server and the workers.
+    """
+    report = {**render_engine.startup_report(), 'startup': startup_timings}
+    return web.json_response(report, status=200 if report['ready'] else 503)
+
+
 async def init():
     app = web.Application()
     app.router.add_static('/static/', path='pdfserver/static', name='static')
     app.add_routes(routes)
 
+    timer = StageTimer()
+    presets.resolve()  # Fails on an unknown PDF_RENDER_PRESET
+    # Every render worker parses the bundles when it starts
+    render_engine.initializer = init_worker
+    render_engine.initargs = (bundles.register_bundles(),)
+    timer.stage('bundles')
+    # Workers are warmed up in the background, see /ready
+    render_engine.warmup = warm_up if config.WARMUP else None
+    render_engine.start()
+    timer.stage('engine')
+    directory = store_dir()
+    if directory and pdf_cache.store is None:
+        # Opened in the server process, SQLite connections must not be
+        # inherited across fork
+        pdf_cache.use_store(JobStore(os.path.join(directory, 'jobs.sqlite')))
     await pdf_cache.start_cleanup_task()
+    timer.stage('store')
+    startup_timings.update({phase: round(seconds, 4) for phase, seconds in timer.timings.items()})
 
     # Cleanup on shutdown
     async def cleanup_on_shutdown(app):
         await pdf_cache.stop_cleanup_task()
+        await webhook_sender.close()
+        if pdf_cache.store is not None:
+            pdf_cache.store.close()
+            pdf_cache.store = None
+        render_engine.shutdown()
 
     app.on_cleanup.append(cleanup_on_shutdown)
     return app
 
 
-if __name__ == '__main__':
+def serve(reuse_port=False):
     app = asyncio.run(init())
-    web.run_app(app, host='0.0.0.0', port=8040)
+    # Cancel handlers of disconnected clients, so abandoned sync renders
+    # free their worker.
+    web.run_app(
+        app, host='0.0.0.0', port=8040, handler_cancellation=True, reuse_port=reuse_port
+    )
+
+
+def serve_processes(count):
+    """Run ``count`` server processes listening on the same port
+    (SO_REUSEPORT, the kernel balances connections between them). They
+    share their jobs through the store in ``store_dir()``.
+
+    Processes which exit unexpectedly are restarted, with an increasing
+    delay if they keep exiting right after their start. SIGINT and SIGTERM
+    stop all of them.
+
+    :return: 0, or 1 if the processes kept exiting and the others were
+        stopped.
+    """
+    # pid -> start time
+    children = {}
+    stopping = False
+    failures = 0
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 1
+            try:
+                serve(reuse_port=True)
+                code = 0
+            finally:
+                os._exit(code)
+        children[pid] = time.monotonic()
+        logger.info(f"Started server process (pid {pid})")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            with suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for _ in range(count):
+        spawn()
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if stopping:
+            continue
+        if started is not None and time.monotonic() - started < RESTART_MIN_UPTIME:
+            failures += 1
+        else:
+            failures = 0
+        if failures > RESTART_ATTEMPTS:
+            logger.error(f"Server process {pid} exited ({status}) {failures} times in a row, stopping")
+            stop(None, None)
+            continue
+        delay = min(RESTART_BACKOFF * 2 ** (failures - 1), RESTART_BACKOFF_MAX) if failures else 0
+        logger.warning(f"Server process {pid} exited ({status}), restarting in {delay}s")
+        time.sleep(delay)
+        if not stopping:
+            spawn()
+    return 1 if failures > RESTART_ATTEMPTS else 0
+
+
+if __name__ == '__main__':
+    if config.SERVER_PROCESSES > 1:
+        sys.exit(serve_processes(config.SERVER_PROCESSES))
+    else:
+        serve()
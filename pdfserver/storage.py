@@ -0,0 +1,180 @@
+"""Storage for finished PDFs.
+
+Small PDFs are kept in memory, large ones are written to files in the spool
+directory. Both are picklable, so render workers can hand them back to the
+server: a worker writing a large PDF hands back the file name only.
+"""
+from pdfserver import config
+import hashlib
+import io
+import os
+import tempfile
+
+
+def store_dir():
+    """Return the directory of the job store shared by the server
+    processes, or '' if there is only one process and none is configured.
+    """
+    if config.STORE_DIR or config.SERVER_PROCESSES <= 1:
+        return config.STORE_DIR
+    return os.path.join(tempfile.gettempdir(), 'pdfserver-store')
+
+
+def spool_dir():
+    """Return the spool directory for PDFs, creating it if needed. PDFs of
+    a shared job store are spooled below its directory.
+    """
+    directory = config.SPOOL_DIR
+    if not directory and store_dir():
+        directory = os.path.join(store_dir(), 'pdfs')
+    if not directory:
+        directory = os.path.join(tempfile.gettempdir(), 'pdfserver')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+class PDFData:
+    """A PDF kept in memory. Its ``etag`` is a hash of the content, computed
+    where the PDF is created (i.e. in the render worker).
+    """
+
+    path = None
+    # Statistics and profile of the render, see ``pdfserver.worker``
+    stats = None
+    profile = None
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.etag = hashlib.sha256(data).hexdigest()
+        self.refs = 0
+
+    def open(self):
+        return io.BytesIO(self.data)
+
+    def read(self):
+        return self.data
+
+    def delete(self):
+        self.data = b''
+
+
+class PDFFile:
+    """A PDF stored in a file of the spool directory."""
+
+    stats = None
+    profile = None
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.refs = 0
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def delete(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def write_pdf_file(data):
+    """Write PDF bytes to a new file in the spool directory.
+
+    :return: The :class:`PDFFile`.
+    """
+    with tempfile.NamedTemporaryFile(dir=spool_dir(), suffix='.pdf', delete=False) as f:
+        f.write(data)
+    return PDFFile(f.name, len(data))
+
+
+class SpoolWriter:
+    """Write target for renders. The PDF is built in memory up to
+    ``threshold`` bytes and moved to a file in the spool directory as soon
+    as it grows beyond that.
+    """
+
+    def __init__(self, threshold=None):
+        self.threshold = config.SPOOL_THRESHOLD if threshold is None else threshold
+        self.buffer = io.BytesIO()
+        self.file = None
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.file is None and self.size > self.threshold:
+            self.file = tempfile.NamedTemporaryFile(dir=spool_dir(), suffix='.pdf', delete=False)
+            self.file.write(self.buffer.getbuffer())
+            self.buffer = None
+        if self.file is not None:
+            return self.file.write(data)
+        return self.buffer.write(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def result(self):
+        """Finish writing.
+
+        :return: A :class:`PDFData` or :class:`PDFFile`.
+        """
+        if self.file is None:
+            return PDFData(self.buffer.getvalue())
+        self.file.close()
+        return PDFFile(self.file.name, self.size)
+
+    def discard(self):
+        """Remove the file written so far, if any."""
+        if self.file is not None:
+            self.file.close()
+            PDFFile(self.file.name, self.size).delete()
+
+
+class PDFStorage:
+    """Keeps track of the memory used by stored PDFs.
+
+    PDFs are kept in memory as long as the total stays within
+    ``memory_budget``, PDFs beyond it are written to the spool directory.
+    """
+
+    def __init__(self, memory_budget=None):
+        self.memory_budget = config.CACHE_MEMORY_BUDGET if memory_budget is None else memory_budget
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+
+    def fits_in_memory(self, pdf):
+        return self.memory_bytes + pdf.size <= self.memory_budget
+
+    def add(self, pdf):
+        """Account for a reference to a stored PDF. In-memory PDFs must fit
+        the budget, see :meth:`fits_in_memory`.
+        """
+        pdf.refs += 1
+        if pdf.refs > 1:
+            return
+        if pdf.path is None:
+            self.memory_bytes += pdf.size
+        else:
+            self.disk_bytes += pdf.size
+
+    def remove(self, pdf):
+        """Drop a reference to a stored PDF, the PDF is deleted together
+        with the last reference.
+        """
+        pdf.refs -= 1
+        if pdf.refs > 0:
+            return
+        if pdf.path is None:
+            self.memory_bytes -= pdf.size
+        else:
+            self.disk_bytes -= pdf.size
+        pdf.delete()
@@ -0,0 +1,174 @@
+"""Job store shared by the processes of a multi-process server.
+
+Every server process keeps its own jobs in its :class:`ExpiringPDFCache
+<pdfserver.cache.ExpiringPDFCache>`, which writes their state through to a
+SQLite index in the shared store directory. Finished PDFs are files in the
+spool directory below it. Any process can then answer ``/status`` and
+``/pdf`` for jobs accepted by another one.
+
+Writes can wait for other processes holding the database lock, they are
+done by a thread of the store so the event loop does not block on them.
+"""
+from concurrent.futures import Future
+from contextlib import suppress
+from pdfserver.log import logger
+from pdfserver.storage import PDFFile
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    uid TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    message TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    expires REAL NOT NULL,
+    content_type TEXT NOT NULL,
+    path TEXT,
+    size INTEGER,
+    items TEXT,
+    stats TEXT,
+    profile TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_expires ON jobs (expires);
+"""
+
+
+class JobStore:
+    """SQLite index of the jobs of all server processes.
+
+    :param path: The database file, in a directory shared by all processes.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        # Read by the event loop thread, written by the writer thread.
+        # Concurrent processes are serialized by SQLite
+        self.db = self._connect()
+        self.db.executescript(SCHEMA)
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='job-store', daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def _write_loop(self):
+        db = self._connect()
+        try:
+            while True:
+                write = self._writes.get()
+                if write is None:
+                    break
+                func, future = write
+                try:
+                    future.set_result(func(db))
+                except Exception as e:
+                    logger.error(f"Job store write failed: {e}")
+                    future.set_exception(e)
+        finally:
+            db.close()
+
+    def _write(self, func):
+        """Run ``func(db)`` in the writer thread, in submission order.
+
+        :return: A :class:`concurrent.futures.Future` of its result.
+        """
+        future = Future()
+        self._writes.put((func, future))
+        return future
+
+    def flush(self):
+        """Wait until the writes submitted so far are done."""
+        self._write(lambda db: None).result()
+
+    def close(self):
+        self._writes.put(None)
+        self._writer.join()
+        self.db.close()
+
+    def put(self, job, expires):
+        """Insert or update the record of ``job``, which is removed by
+        :meth:`remove_expired` after ``expires`` (a timestamp).
+        """
+        data = job.data
+        row = (
+            job.uid, job.status, job.filename, job.message, job.timestamp, expires,
+            job.content_type,
+            None if data is None else data.path,
+            None if data is None else data.size,
+            None if job.items is None else json.dumps(job.items),
+            None if job.stats is None else json.dumps(job.stats),
+            job.profile,
+        )
+        self._write(lambda db: db.execute(
+            'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row
+        ))
+
+    def get(self, uid, job_class):
+        """Return the job ``uid`` as an instance of ``job_class`` (see
+        ``pdfserver.cache.PDFJob``), or None.
+
+        The PDF of a completed job is a :class:`PDFFile` which is not owned
+        by the caller, the process which stored it removes it.
+        """
+        row = self.db.execute(
+            'SELECT status, filename, message, timestamp, content_type, path, size, '
+            'items, stats, profile FROM jobs WHERE uid = ? AND expires >= ?',
+            (uid, time.time()),
+        ).fetchone()
+        if row is None:
+            return None
+        status, filename, message, timestamp, content_type, path, size, items, stats, profile = row
+        job = job_class(uid)
+        job.status = status
+        job.filename = filename
+        job.message = message
+        job.timestamp = timestamp
+        job.content_type = content_type
+        if path is not None:
+            job.data = PDFFile(path, size)
+        if items is not None:
+            job.items = json.loads(items)
+        if stats is not None:
+            job.stats = json.loads(stats)
+        job.profile = profile
+        return job
+
+    def delete(self, uid):
+        self._write(lambda db: db.execute('DELETE FROM jobs WHERE uid = ?', (uid,)))
+
+    def remove_expired(self, grace=300):
+        """Remove the records and files of jobs which expired more than
+        ``grace`` seconds ago. Processes remove their own jobs when they
+        expire, this cleans up after processes which exited before.
+
+        :return: A :class:`concurrent.futures.Future` of the number of
+            removed jobs.
+        """
+        before = time.time() - grace
+
+        def remove(db):
+            rows = db.execute('SELECT path, profile FROM jobs WHERE expires < ?', (before,)).fetchall()
+            db.execute('DELETE FROM jobs WHERE expires < ?', (before,))
+            for paths in rows:
+                for path in paths:
+                    # Results are shared by the jobs of identical requests
+                    if path is None or db.execute(
+                        'SELECT 1 FROM jobs WHERE path = ?', (path,)
+                    ).fetchone():
+                        continue
+                    with suppress(FileNotFoundError):
+                        os.unlink(path)
+            return len(rows)
+        return self._write(remove)
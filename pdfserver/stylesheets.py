@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from pdfserver import config
+from pdfserver.fetcher import basic_auth_url_fetcher
+from pdfserver.fetcher import cache_lifetime
+from pdfserver.fetcher import read_result
+from pdfserver.log import logger
+from urllib.error import HTTPError
+from weasyprint import CSS
+from weasyprint.urls import URLFetchingError
+import io
+import time
+
+
+class CachedStylesheet:
+    __slots__ = ('css', 'etag', 'last_modified', 'fresh_until')
+
+    def __init__(self, css, headers, lifetime):
+        self.css = css
+        self.etag = headers.get('ETag')
+        self.last_modified = headers.get('Last-Modified')
+        self.fresh_until = time.monotonic() + lifetime
+
+
+class StylesheetCache:
+    """Bounded LRU cache of parsed stylesheets, keyed by URL.
+
+    Stylesheets are used without any request while they are fresh and are
+    revalidated with If-None-Match / If-Modified-Since afterwards, so an
+    unchanged stylesheet is never downloaded or parsed again.
+
+    Parsed stylesheets hold the ``@font-face`` rules registered in the font
+    configuration they were parsed with, the cache must be cleared when the
+    font configuration is replaced.
+
+    :param url_fetcher: Fetcher used for resources referenced by the
+        stylesheets, like fonts and imports.
+    """
+
+    def __init__(self, max_entries=None, ttl=None, url_fetcher=basic_auth_url_fetcher):
+        self.url_fetcher = url_fetcher
+        self.max_entries = config.CSS_CACHE_SIZE if max_entries is None else max_entries
+        self.ttl = config.CSS_CACHE_TTL if ttl is None else ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def get(self, url, font_config=None):
+        """Return the parsed stylesheet at ``url``."""
+        entry = self.entries.get(url)
+        if entry is not None:
+            self.entries.move_to_end(url)
+            if time.monotonic() < entry.fresh_until:
+                self.hits += 1
+                return entry.css
+
+        request_headers = {}
+        if entry is not None:
+            if entry.etag:
+                request_headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                request_headers['If-Modified-Since'] = entry.last_modified
+
+        try:
+            result = basic_auth_url_fetcher(url, headers=request_headers)
+        except HTTPError as e:
+            if e.code == 304 and entry is not None:
+                self.hits += 1
+                lifetime = cache_lifetime(e.headers, self.ttl)
+                entry.fresh_until = time.monotonic() + (lifetime or 0)
+                return entry.css
+            raise URLFetchingError(f'{type(e).__name__}: {e}')
+        except Exception as e:
+            raise URLFetchingError(f'{type(e).__name__}: {e}')
+
+        self.misses += 1
+        css = CSS(
+            file_obj=io.BytesIO(read_result(result)),
+            encoding=result['encoding'],
+            base_url=result['redirected_url'],
+            url_fetcher=self.url_fetcher,
+            font_config=font_config,
+        )
+
+        lifetime = cache_lifetime(result['headers'], self.ttl)
+        if lifetime is None or self.max_entries <= 0:
+            self.entries.pop(url, None)
+            return css
+
+        self.entries[url] = CachedStylesheet(css, result['headers'], lifetime)
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last=False)
+            logger.info(f"Evicted stylesheet from cache: {evicted}")
+        return css
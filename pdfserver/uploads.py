@@ -0,0 +1,62 @@
+"""HTML documents uploaded as raw or multipart request bodies.
+
+The body is streamed to a file in the spool directory while it arrives
+(``Content-Encoding: gzip`` / ``deflate`` is decoded by aiohttp on the way),
+so the server never holds the document in memory. Render workers read it
+from the file, see ``pdfserver.worker.render_html_file``.
+"""
+from contextlib import suppress
+from pdfserver import config
+from pdfserver.storage import spool_dir
+import hashlib
+import os
+import tempfile
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BodyTooLarge(Exception):
+    """The uploaded document exceeds ``config.HTML_MAX_BYTES``."""
+
+
+class UploadedHTML:
+    """An uploaded HTML document in the spool directory, with the sha256
+    ``digest`` of its content.
+    """
+
+    def __init__(self, path, size, digest):
+        self.path = path
+        self.size = size
+        self.digest = digest
+
+    def delete(self):
+        with suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+
+async def spool_upload(read_chunk, max_bytes=None):
+    """Write a body to the spool directory.
+
+    :param read_chunk: Coroutine function returning the next chunk of the
+        (decoded) body, or ``b''`` at its end.
+    :return: The :class:`UploadedHTML`.
+    :raises BodyTooLarge: If the body is larger than ``max_bytes``
+        (defaults to ``config.HTML_MAX_BYTES``), nothing is kept then.
+    """
+    max_bytes = config.HTML_MAX_BYTES if max_bytes is None else max_bytes
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=spool_dir(), suffix='.html', delete=False) as f:
+        try:
+            while chunk := await read_chunk(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise BodyTooLarge(f"HTML content exceeds {max_bytes} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
+    return UploadedHTML(f.name, size, digest.hexdigest())
@@ -1,7 +1,16 @@
 from aiohttp import web
 from enum import Enum
-from pdfserver.fetcher import basic_auth_url_fetcher
-from weasyprint import CSS
+from pdfserver import bundles
+from pdfserver import chunks
+from pdfserver import config
+from pdfserver import presets
+from pdfserver.profiling import PROFILERS
+from pdfserver.uploads import BodyTooLarge
+from pdfserver.uploads import CHUNK_SIZE
+from pdfserver.uploads import spool_upload
+from pdfserver.uploads import UploadedHTML
+from pdfserver.webhooks import CALLBACK_MODES
+import hashlib
 import json
 
 
@@ -11,17 +20,180 @@ class TaskStatus(Enum):
     FAILED = "failed"
 
 
-def pdf_response(file, filename):
-    """Utility function to create a PDF response."""
-    file.seek(0)
-    return web.Response(
-            body=file.getvalue(),
-            content_type='application/pdf',
-            headers={
-                'Content-Length': str(len(file.getvalue())),
-                'Content-Disposition': f'attachment; filename="{filename}"',
-            }
-        )
+def byte_range(request, size):
+    """Return the (start, stop) offsets requested by the Range header of
+    ``request``, or None if the whole content is requested.
+
+    :raises ValueError: If the range is malformed or not satisfiable.
+    """
+    requested = request.http_range
+    start, stop = requested.start, requested.stop
+    if start is None:
+        return None
+    if start < 0:
+        start = max(size + start, 0)
+    if stop is None or stop > size:
+        stop = size
+    if start >= stop:
+        raise ValueError("Range not satisfiable")
+    return start, stop
+
+
+def pdf_response(request, pdf, filename, content_type='application/pdf'):
+    """Utility function to create a PDF response.
+
+    PDFs stored in a file are sent from the file (using sendfile), PDFs in
+    memory are sent without copying them. Both support Range requests and
+    ETag / If-None-Match validation.
+    """
+    headers = {
+        'Content-Type': content_type,
+        'Content-Disposition': f'attachment; filename="{filename}"',
+    }
+    if pdf.path is not None:
+        return web.FileResponse(pdf.path, headers=headers)
+
+    etag = f'"{pdf.etag}"'
+    headers['ETag'] = etag
+    headers['Accept-Ranges'] = 'bytes'
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and request.method in ('GET', 'HEAD') and (
+        if_none_match.strip() == '*'
+        or etag in (value.strip().removeprefix('W/') for value in if_none_match.split(','))
+    ):
+        return web.Response(status=304, headers={'ETag': etag})
+
+    data = memoryview(pdf.data)
+    if_range = request.headers.get('If-Range')
+    if if_range is None or if_range == etag:
+        try:
+            requested = byte_range(request, pdf.size)
+        except ValueError:
+            return web.Response(status=416, headers={'Content-Range': f'bytes */{pdf.size}'})
+        if requested is not None:
+            start, stop = requested
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{pdf.size}'
+            return web.Response(status=206, body=data[start:stop], headers=headers)
+    return web.Response(body=data, headers=headers)
+
+
+def render_key(*parts):
+    """Content address of a render: a hash over its normalized inputs."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, str):
+            part = json.dumps(part, sort_keys=True)
+        digest.update(part.encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def parse_timeout(data):
+    """Read the optional client deadline (in seconds) from the payload.
+
+    :return: A (timeout, error) tuple.
+    """
+    timeout = data.get('timeout')
+    if timeout is None:
+        return None, None
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+        return None, "Timeout must be a positive number of seconds"
+    return timeout, None
+
+
+def parse_wait(query):
+    """Read the optional long-poll duration (in seconds) from the query,
+    limited to ``config.STATUS_MAX_WAIT``.
+
+    :return: A (wait, error) tuple.
+    """
+    wait = query.get('wait')
+    if wait is None:
+        return 0, None
+    try:
+        wait = float(wait)
+    except ValueError:
+        return 0, "Wait must be a number of seconds"
+    if not wait >= 0:
+        return 0, "Wait must be a number of seconds"
+    return min(wait, config.STATUS_MAX_WAIT), None
+
+
+def parse_profile(data):
+    """Read the optional profiler (``cprofile`` or ``tracemalloc``) from
+    the payload. Profiling must be enabled with ``PDF_PROFILING``.
+
+    :return: A (profile, error) tuple.
+    """
+    profile = data.get('profile')
+    if profile is None:
+        return None, None
+    if not config.PROFILING:
+        return None, "Profiling is disabled"
+    if profile not in PROFILERS:
+        return None, f"Profile must be one of {', '.join(PROFILERS)}"
+    return profile, None
+
+
+def parse_render_options(data):
+    """Read the optional output ``preset`` and ``options`` overriding it
+    from the payload, see ``pdfserver.presets``.
+
+    :return: An (options, error) tuple.
+    """
+    try:
+        return presets.resolve(data.get('preset'), data.get('options')), None
+    except ValueError as e:
+        return None, str(e)
+
+
+def parse_css_profile(data):
+    """Read the optional name of a stylesheet bundle from the payload, see
+    ``pdfserver.bundles``.
+
+    :return: A (css_profile, error) tuple.
+    """
+    name = data.get('css_profile')
+    if name is None:
+        return None, None
+    if not isinstance(name, str) or name not in bundles.BUNDLES:
+        return None, f"Unknown css_profile: {name}"
+    return name, None
+
+
+def parse_split(data):
+    """Read the optional selector of the elements before which the document
+    is split into chunks rendered in parallel, see ``pdfserver.chunks``.
+
+    :return: A (split, error) tuple.
+    """
+    split = data.get('split')
+    if split is None:
+        return None, None
+    if data.get('profile'):
+        return None, "Profiling is not available for split documents"
+    try:
+        chunks.validate_selector(split)
+    except ValueError as e:
+        return None, str(e)
+    return split, None
+
+
+def parse_callback(data):
+    """Read the optional callback URL and mode (``link`` or ``pdf``) from
+    the payload.
+
+    :return: A (callback, callback_mode, error) tuple.
+    """
+    callback = data.get('callback')
+    mode = data.get('callback_mode', 'link')
+    if callback is None:
+        return None, mode, None
+    if not isinstance(callback, str) or not callback.startswith(('http://', 'https://')):
+        return None, mode, "Callback must be an http(s) URL"
+    if mode not in CALLBACK_MODES:
+        return None, mode, f"Callback mode must be one of {', '.join(CALLBACK_MODES)}"
+    return callback, mode, None
 
 
 async def extrat_data_from_request(request):
@@ -31,6 +203,13 @@ async def extrat_data_from_request(request):
         'url': None,
         'css': [],
         'filename': None,
+        'timeout': None,
+        'profile': None,
+        'options': None,
+        'css_profile': None,
+        'split': None,
+        'callback': None,
+        'callback_mode': None,
     }
 
     data = {}
@@ -47,18 +226,160 @@ async def extrat_data_from_request(request):
 
     result['url'] = data['url']
     result['filename'] = data.get('filename', 'output.pdf')
-    for css_file in data.get('css', []):
-        result['css'].append(CSS(filename=css_file, url_fetcher=basic_auth_url_fetcher))
+    result['css'] = list(data.get('css', []))
+    result['timeout'], result['error'] = parse_timeout(data)
+    if not result['error']:
+        result['profile'], result['error'] = parse_profile(data)
+    if not result['error']:
+        result['options'], result['error'] = parse_render_options(data)
+    if not result['error']:
+        result['css_profile'], result['error'] = parse_css_profile(data)
+    if not result['error']:
+        result['split'], result['error'] = parse_split(data)
+    if not result['error']:
+        result['callback'], result['callback_mode'], result['error'] = parse_callback(data)
 
     return result
 
 
+def form_fields(fields):
+    """Convert the fields of a query string or multipart form to the types
+    of the JSON payload: ``timeout`` is a number, ``options`` a JSON object.
+
+    :return: A (data, error) tuple.
+    """
+    data = dict(fields)
+    if 'timeout' in data:
+        try:
+            data['timeout'] = float(data['timeout'])
+        except ValueError:
+            return data, "Timeout must be a positive number of seconds"
+    if 'options' in data:
+        try:
+            data['options'] = json.loads(data['options'])
+        except json.JSONDecodeError:
+            return data, "Invalid JSON in options"
+    return data, None
+
+
+async def read_form_field(part, max_bytes=None):
+    """Read a multipart form field other than the document into memory.
+
+    :raises BodyTooLarge: If it exceeds ``max_bytes`` (defaults to
+        ``config.FORM_FIELD_MAX_BYTES``).
+    """
+    max_bytes = config.FORM_FIELD_MAX_BYTES if max_bytes is None else max_bytes
+    data = bytearray()
+    while chunk := await part.read_chunk(CHUNK_SIZE):
+        data += chunk
+        if len(data) > max_bytes:
+            raise BodyTooLarge(f"Field {part.name} exceeds {max_bytes} bytes")
+    return data.decode(part.get_charset('utf-8'))
+
+
+async def read_html_upload(request):
+    """Read an HTML document sent as ``text/html`` body (with the other
+    fields in the query string) or as ``html`` part of a
+    ``multipart/form-data`` body. The document is streamed to the spool
+    directory, see ``pdfserver.uploads``.
+
+    :return: A (data, error) tuple, ``data['html']`` is the
+        :class:`UploadedHTML`.
+    :raises BodyTooLarge: If the document exceeds ``config.HTML_MAX_BYTES``.
+    """
+    if request.content_type == 'text/html':
+        data, error = form_fields(request.query)
+        if not error:
+            data['html'] = await spool_upload(request.content.read)
+        return data, error
+
+    fields = {}
+    html = None
+    try:
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name == 'html' and html is None:
+                html = await spool_upload(part.read_chunk)
+            elif part.name:
+                fields[part.name] = await read_form_field(part)
+    except BaseException:
+        if html is not None:
+            html.delete()
+        raise
+    data, error = form_fields(fields)
+    if html is not None:
+        data['html'] = html
+    return data, error
+
+
 async def extract_html_data_from_request(request):
 
     result = {
         'error': None,
+        'error_status': 400,
         'html': None,
-        'css': [],
+        'css': None,
+        'filename': None,
+        'timeout': None,
+        'profile': None,
+        'options': None,
+        'css_profile': None,
+        'split': None,
+        'callback': None,
+        'callback_mode': None,
+    }
+
+    data = {}
+    if request.content_type in ('text/html', 'multipart/form-data'):
+        try:
+            data, result['error'] = await read_html_upload(request)
+        except BodyTooLarge as e:
+            result['error'] = str(e)
+            result['error_status'] = 413
+            return result
+        except ValueError:
+            result['error'] = "Invalid multipart body"
+            return result
+    else:
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            result["error"] = "Invalid JSON in request body"
+            return result
+
+    if not result['error'] and 'html' not in data:
+        result["error"] = "HTML content is required"
+
+    if not result['error']:
+        result['html'] = data['html']
+        result['filename'] = data.get('filename', 'output.pdf')
+        result['css'] = data.get('css') or None
+        result['timeout'], result['error'] = parse_timeout(data)
+    if not result['error']:
+        result['profile'], result['error'] = parse_profile(data)
+    if not result['error']:
+        result['options'], result['error'] = parse_render_options(data)
+    if not result['error']:
+        result['css_profile'], result['error'] = parse_css_profile(data)
+    if not result['error']:
+        result['split'], result['error'] = parse_split(data)
+    if not result['error']:
+        result['callback'], result['callback_mode'], result['error'] = parse_callback(data)
+
+    if result['error'] and isinstance(data.get('html'), UploadedHTML):
+        data['html'].delete()
+    return result
+
+
+BATCH_OUTPUTS = ('pdf', 'zip')
+
+
+async def extract_batch_data_from_request(request):
+
+    result = {
+        'error': None,
+        'items': [],
+        'output': None,
         'filename': None,
     }
 
@@ -69,13 +390,46 @@ async def extract_html_data_from_request(request):
         result["error"] = "Invalid JSON in request body"
         return result
 
-    if 'html' not in data:
-        result["error"] = "HTML content is required"
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        result["error"] = "Items are required"
+        return result
+    if len(items) > config.BATCH_MAX_ITEMS:
+        result["error"] = f"At most {config.BATCH_MAX_ITEMS} items are allowed"
         return result
 
-    result['html'] = data['html']
-    result['filename'] = data.get('filename', 'output.pdf')
-    if data.get('css'):
-        result['css'].append(CSS(string=data['css']))
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or ('url' in item) == ('html' in item):
+            result["error"] = f"Item {index} requires either url or html"
+            return result
+        options, error = parse_render_options(item)
+        if not error:
+            css_profile, error = parse_css_profile(item)
+        if error:
+            result["error"] = f"Item {index}: {error}"
+            return result
+        if 'url' in item:
+            result['items'].append({
+                'url': item['url'],
+                'css': list(item.get('css', [])),
+                'filename': item.get('filename', 'output.pdf'),
+                'options': options,
+                'css_profile': css_profile,
+            })
+        else:
+            result['items'].append({
+                'html': item['html'],
+                'css': item.get('css') or None,
+                'filename': item.get('filename', 'output.pdf'),
+                'options': options,
+                'css_profile': css_profile,
+            })
+
+    output = data.get('output')
+    if output is not None and output not in BATCH_OUTPUTS:
+        result["error"] = f"Output must be one of {', '.join(BATCH_OUTPUTS)}"
+        return result
+    result['output'] = output
+    result['filename'] = data.get('filename', f'batch.{output or "pdf"}')
 
     return result
@@ -0,0 +1,89 @@
+"""Callbacks notifying clients about finished asynchronous jobs."""
+from pdfserver import config
+from pdfserver.log import logger
+import aiohttp
+import asyncio
+import json
+
+
+CALLBACK_MODES = ('link', 'pdf')
+
+
+class WebhookSender:
+    """Delivers callbacks through a shared pool of connections.
+
+    Failed deliveries (connection errors, 429 and 5xx responses) are retried
+    with exponential backoff. Delivery runs on the event loop of the server,
+    render workers are never involved.
+
+    :param retries: Attempts after the first one failed.
+    :param backoff: Delay in seconds before the first retry, doubled for
+        every further retry.
+    :param timeout: Timeout of a single attempt in seconds.
+    """
+
+    def __init__(self, retries=None, backoff=None, timeout=None):
+        self.retries = config.WEBHOOK_RETRIES if retries is None else retries
+        self.backoff = config.WEBHOOK_BACKOFF if backoff is None else backoff
+        self.timeout = config.WEBHOOK_TIMEOUT if timeout is None else timeout
+        self.delivered = 0
+        self.failed = 0
+        self._session = None
+
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=config.WEBHOOK_CONNECTIONS),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _post(self, url, status, job):
+        if job is None:
+            async with self.session().post(url, json=status) as response:
+                return response.status
+        headers = {
+            'Content-Type': job.content_type,
+            'Content-Disposition': f'attachment; filename="{status["filename"]}"',
+            'X-PDF-Status': json.dumps(status),
+        }
+        with job.data.open() as body:
+            async with self.session().post(url, data=body, headers=headers) as response:
+                return response.status
+
+    async def deliver(self, url, status, job=None):
+        """POST the ``status`` of a job (see ``/status``) as JSON to ``url``.
+
+        :param job: The finished job, if its PDF itself should be posted.
+            The status is sent in the ``X-PDF-Status`` header then.
+        :return: Whether the callback was delivered.
+        """
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response_status = await self._post(url, status, job)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Callback to {url} failed (attempt {attempt + 1}): {e!r}")
+                continue
+            except OSError as e:
+                # The PDF is gone (expired)
+                logger.error(f"Callback to {url} failed: {e!r}")
+                break
+            if response_status < 300:
+                self.delivered += 1
+                logger.info(f"Delivered callback for {status['uid']} to {url}")
+                return True
+            logger.warning(
+                f"Callback to {url} failed (attempt {attempt + 1}): HTTP {response_status}"
+            )
+            if response_status != 429 and response_status < 500:
+                break
+        self.failed += 1
+        logger.error(f"Giving up callback for {status['uid']} to {url}")
+        return False
@@ -0,0 +1,459 @@
+"""Code running inside the render worker processes.
+
+Everything in here is executed by a child process of the server. WeasyPrint
+is imported once per process when this module is loaded.
+"""
+from pdfserver import chunks
+from pdfserver import config
+from pdfserver import metrics
+from pdfserver.fetcher import basic_auth_url_fetcher
+from pdfserver.fetcher import read_result
+from pdfserver.fetcher import ResourceCache
+from pdfserver.fonts import FontCache
+from pdfserver.images import ImageCache
+from pdfserver.log import logger
+from pdfserver.profiling import peak_memory
+from pdfserver.profiling import profiled
+from pdfserver.profiling import reset_peak_memory
+from pdfserver.profiling import StageTimer
+from pdfserver.storage import SpoolWriter
+from pdfserver.stylesheets import StylesheetCache
+from pypdf import PdfReader
+from pypdf import PdfWriter
+from weasyprint import CSS
+from weasyprint import HTML
+from weasyprint.text.fonts import FontConfiguration
+from weasyprint.urls import URLFetchingError
+from urllib.parse import urljoin
+import json
+import os
+import time
+import zipfile
+
+
+resource_cache = ResourceCache()
+font_cache = FontCache(url_fetcher=resource_cache.fetch)
+image_cache = ImageCache(validator=resource_cache.validator)
+
+
+_fetch_seconds = 0.0
+
+
+def url_fetcher(url):
+    """URL fetcher used by all renders of this worker."""
+    global _fetch_seconds
+    start = time.perf_counter()
+    try:
+        return font_cache.fetch(url)
+    finally:
+        _fetch_seconds += time.perf_counter() - start
+
+
+def document_fetcher(document_url):
+    """Return the URL fetcher for the document at ``document_url``.
+
+    The document itself is always fetched again, a page edited since the
+    last render must not come from the resource cache. Its subresources
+    go through ``url_fetcher``.
+    """
+    def fetch(url):
+        global _fetch_seconds
+        if url != document_url:
+            return url_fetcher(url)
+        start = time.perf_counter()
+        try:
+            return basic_auth_url_fetcher(url)
+        finally:
+            _fetch_seconds += time.perf_counter() - start
+    return fetch
+
+
+stylesheet_cache = StylesheetCache(url_fetcher=url_fetcher)
+_font_config = None
+_font_config_jobs = 0
+# Stylesheet bundles: name -> (css, base_url) sources, and the parsed
+# stylesheets, see ``pdfserver.bundles``
+_bundle_sources = {}
+_bundles = {}
+
+
+def init_worker(bundles):
+    """Initializer of the render workers: parse the stylesheet ``bundles``
+    (name -> list of (css, base_url)) before the first job arrives.
+    """
+    global _font_config
+    _bundle_sources.update(bundles)
+    if _font_config is None:
+        _font_config = FontConfiguration()
+    for name in bundles:
+        bundle_stylesheets(name, _font_config)
+    if bundles:
+        logger.info(f"Parsed stylesheet bundles: {', '.join(bundles)}")
+
+
+def bundle_stylesheets(name, font_config):
+    """Return the parsed stylesheets of the bundle ``name``. They are
+    parsed again after the font configuration was recycled.
+    """
+    stylesheets = _bundles.get(name)
+    if stylesheets is None:
+        stylesheets = _bundles[name] = [
+            CSS(string=css, base_url=base_url, url_fetcher=url_fetcher, font_config=font_config)
+            for css, base_url in _bundle_sources[name]
+        ]
+    return stylesheets
+
+
+def recycle_fonts():
+    """Drop the font configuration together with everything bound to it."""
+    global _font_config, _font_config_jobs
+    logger.info(
+        f"Recycling font configuration after {_font_config_jobs} jobs "
+        f"({font_cache.size} bytes of cached fonts)"
+    )
+    _font_config = None
+    _font_config_jobs = 0
+    font_cache.clear()
+    stylesheet_cache.clear()
+    _bundles.clear()
+
+
+def get_font_config():
+    """Return the font configuration shared by the renders of this worker.
+
+    Cached stylesheets register their ``@font-face`` rules in it, so it has
+    to live as long as the stylesheet cache. It is recycled after
+    ``config.FONT_RECYCLE_JOBS`` jobs or when the font cache grows beyond
+    ``config.FONT_CACHE_MAX_BYTES``.
+    """
+    global _font_config, _font_config_jobs
+    if _font_config is not None and (
+        (config.FONT_RECYCLE_JOBS and _font_config_jobs >= config.FONT_RECYCLE_JOBS)
+        or font_cache.size > config.FONT_CACHE_MAX_BYTES
+    ):
+        recycle_fonts()
+    if _font_config is None:
+        _font_config = FontConfiguration()
+    _font_config_jobs += 1
+    return _font_config
+
+
+def _stylesheets(css_files=(), css_string=None, font_config=None, css_profile=None):
+    # Stylesheets of the request come after the bundle, so they override it
+    stylesheets = []
+    if css_profile is not None:
+        stylesheets.extend(bundle_stylesheets(css_profile, font_config))
+    stylesheets.extend(stylesheet_cache.get(css_file, font_config) for css_file in css_files)
+    if css_string:
+        stylesheets.append(CSS(string=css_string, url_fetcher=url_fetcher, font_config=font_config))
+    return stylesheets
+
+
+def _render(temp_file, parse, font_config, profile=None, options=None):
+    """Render into ``temp_file`` and record the timings of the stages.
+
+    :param parse: Returns the ``HTML`` document and its stylesheets.
+    :param profile: Profiler to run during the render, see
+        ``pdfserver.profiling``.
+    :param options: WeasyPrint options and the name of their ``preset``,
+        see ``pdfserver.presets``.
+    :return: The PDF, with the render statistics as ``stats`` and the path
+        of the profile as ``profile``.
+    """
+    global _fetch_seconds
+    options = dict(options or {})
+    preset = options.pop('preset', 'default')
+    _fetch_seconds = 0.0
+    reset_peak_memory()
+    timer = StageTimer()
+    options['cache'] = image_cache.for_options(options)
+    try:
+        with profiled(profile) as profile_paths:
+            html, stylesheets = parse()
+            timer.stage('parse')
+            # Images are loaded while rendering, fonts are subset when writing
+            document = html.render(stylesheets=stylesheets, font_config=font_config, **options)
+            timer.stage('render')
+            document.write_pdf(temp_file, **options)
+            timer.stage('write_pdf')
+    finally:
+        image_cache.end_render()
+    pdf = temp_file.result()
+    # Fetches happen during the other stages, their time is included there
+    pdf.stats = {
+        **{stage: round(seconds, 4) for stage, seconds in timer.timings.items()},
+        'fetch': round(_fetch_seconds, 4),
+        'peak_memory': peak_memory(),
+        'pages': len(document.pages),
+        'size': pdf.size,
+        'preset': preset,
+    }
+    pdf.profile = profile_paths[0] if profile_paths else None
+    logger.info(f"Render stats: {json.dumps(pdf.stats)}")
+    metrics.PDF_SIZE.observe(pdf.size, preset=preset)
+    return pdf
+
+
+def render_url(url, css_files, profile=None, options=None, css_profile=None):
+    """Render the document at ``url`` with the given CSS URLs, after the
+    stylesheet bundle ``css_profile``.
+
+    :return: The PDF, see ``pdfserver.storage``.
+    """
+    temp_file = SpoolWriter()
+    font_config = get_font_config()
+
+    def parse():
+        css = _stylesheets(css_files, font_config=font_config, css_profile=css_profile)
+        return HTML(url, url_fetcher=document_fetcher(url)), css
+
+    try:
+        return _render(temp_file, parse, font_config, profile, options)
+    except URLFetchingError:
+        temp_file.discard()
+        logger.error(f"Failed to fetch URL: {url}")
+        raise
+    except Exception as e:
+        temp_file.discard()
+        logger.error(f"Error generating PDF: {e}")
+        raise
+
+
+def render_html(html_content, css_string, profile=None, options=None, css_profile=None):
+    """Render an HTML string with an optional CSS string, after the
+    stylesheet bundle ``css_profile``.
+
+    :return: The PDF, see ``pdfserver.storage``.
+    """
+    temp_file = SpoolWriter()
+    font_config = get_font_config()
+
+    def parse():
+        css = _stylesheets(
+            css_string=css_string, font_config=font_config, css_profile=css_profile
+        )
+        return HTML(string=html_content, url_fetcher=url_fetcher), css
+
+    try:
+        return _render(temp_file, parse, font_config, profile, options)
+    except Exception as e:
+        temp_file.discard()
+        logger.error(f"Error generating PDF: {e}")
+        raise
+
+
+def render_html_file(path, css_string, profile=None, options=None, css_profile=None):
+    """Render an HTML document uploaded to ``path``, see
+    ``pdfserver.uploads``. Its encoding is detected like for a response
+    (BOM, ``<meta charset>``), it has no base URL.
+
+    :return: The PDF, see ``pdfserver.storage``.
+    """
+    with open(path, 'rb') as f:
+        html_content = f.read()
+    return render_html(html_content, css_string, profile, options, css_profile)
+
+
+# Rendered by every worker before it takes jobs. Uses text, a table and an
+# image (data URL), so fonts, layout and image code are loaded.
+WARMUP_HTML = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<style>
+@page { size: A4; margin: 2cm; @bottom-center { content: counter(page) } }
+body { font-family: sans-serif; font-size: 11pt }
+h1 { font-family: serif }
+td { border: 1px solid; padding: 2pt }
+</style>
+</head>
+<body>
+<h1>Warm-up</h1>
+<p>Lorem <b>ipsum</b> <i>dolor</i> sit amet, <code>consectetur</code> adipiscing elit.</p>
+<table><tr><th>A</th><td>1</td></tr><tr><th>B</th><td>2</td></tr></table>
+<img alt="" src="data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7">
+</body>
+</html>
+"""
+
+
+def warm_up():
+    """Render ``WARMUP_HTML``, so that WeasyPrint loads fontconfig, its
+    user agent stylesheets and the code paths of a render before the first
+    request.
+
+    :return: Seconds spent in the phases of the warm-up.
+    """
+    timer = StageTimer()
+    get_font_config()
+    timer.stage('fonts')
+    pdf = render_html(WARMUP_HTML, None)
+    pdf.delete()
+    # The warm-up is not a request
+    metrics.drain()
+    return {
+        **timer.timings,
+        **{stage: pdf.stats[stage] for stage in ('parse', 'render', 'write_pdf')},
+    }
+
+
+def _parse_document(document):
+    kind, source = document
+    if kind == 'url':
+        return HTML(source, url_fetcher=document_fetcher(source))
+    if kind == 'html-file':
+        with open(source, 'rb') as f:
+            source = f.read()
+    return HTML(string=source, url_fetcher=url_fetcher)
+
+
+def _css_sources(html, document, css, css_profile):
+    """Return the text of the stylesheets of a parsed document: those of
+    the bundle, the request, ``<style>`` elements, ``style`` attributes and
+    linked stylesheets.
+    """
+    sources = [source for source, _ in _bundle_sources.get(css_profile, ())]
+    urls = list(css) if document[0] == 'url' else []
+    if document[0] != 'url' and css:
+        sources.append(css)
+    for element in html.etree_element.iter():
+        if element.tag == 'style':
+            sources.append(element.text or '')
+        elif element.tag == 'link' and 'stylesheet' in element.get('rel', '').lower().split():
+            if element.get('href') and html.base_url:
+                urls.append(urljoin(html.base_url, element.get('href')))
+        if element.get('style'):
+            sources.append(element.get('style'))
+    for url in urls:
+        try:
+            result = url_fetcher(url)
+            sources.append(read_result(result).decode(result.get('encoding') or 'utf-8', 'replace'))
+        except Exception as e:
+            logger.warning(f"Failed to fetch stylesheet {url}: {e}")
+    return sources
+
+
+def plan_chunks(document, css, css_profile, split):
+    """Count the chunks of a document split before the elements matching
+    the selector ``split``, see ``pdfserver.chunks``.
+
+    :param document: ``('url', url)``, ``('html', content)`` or
+        ``('html-file', path)``.
+    :param css: The CSS URLs of a URL, or the CSS string of HTML content.
+    :return: A (chunks, page numbers) tuple, page numbers tells whether
+        the document shows them (see ``chunks.uses_page_counter``).
+        Documents which can not be split have one chunk.
+    """
+    html = _parse_document(document)
+    sources = _css_sources(html, document, css, css_profile)
+    reason = chunks.unsplittable(sources)
+    if reason:
+        logger.info(f"Not splitting document, {reason}")
+        return 1, False
+    return chunks.count(html.etree_element, split), chunks.uses_page_counter(sources)
+
+
+def _parse_chunk(document, css, css_profile, split, index, font_config, page_offset=0):
+    html = _parse_document(document)
+    chunks.select(html.etree_element, split, index)
+    if document[0] == 'url':
+        stylesheets = _stylesheets(css, font_config=font_config, css_profile=css_profile)
+    else:
+        stylesheets = _stylesheets(css_string=css, font_config=font_config, css_profile=css_profile)
+    if page_offset:
+        # Continue the page numbers of the previous chunks
+        stylesheets.append(CSS(
+            string=f'@page :first {{ counter-reset: page {page_offset + 1} }}',
+            font_config=font_config,
+        ))
+    return html, stylesheets
+
+
+def count_chunk_pages(document, css, options, css_profile, split, index):
+    """Lay out the chunk ``index`` of a document, see :func:`plan_chunks`.
+
+    :return: Its number of pages.
+    """
+    font_config = get_font_config()
+    options = dict(options or {})
+    options.pop('preset', None)
+    options['cache'] = image_cache.for_options(options)
+    try:
+        html, stylesheets = _parse_chunk(document, css, css_profile, split, index, font_config)
+        return len(html.render(stylesheets=stylesheets, font_config=font_config, **options).pages)
+    finally:
+        image_cache.end_render()
+
+
+def render_chunk(document, css, options, css_profile, split, index, page_offset=0):
+    """Render the chunk ``index`` of a document, see :func:`plan_chunks`.
+
+    :param page_offset: Number of pages of the previous chunks.
+    :return: The PDF, see ``pdfserver.storage``.
+    """
+    temp_file = SpoolWriter()
+    font_config = get_font_config()
+
+    def parse():
+        return _parse_chunk(
+            document, css, css_profile, split, index, font_config, page_offset
+        )
+
+    try:
+        return _render(temp_file, parse, font_config, None, options)
+    except Exception as e:
+        temp_file.discard()
+        logger.error(f"Error generating PDF chunk {index}: {e}")
+        raise
+
+
+def merge_pdfs(pdfs, keep_metadata=False):
+    """Concatenate PDFs into one.
+
+    :param pdfs: PDFs as returned by the render functions.
+    :param keep_metadata: Copy the document information (title, author,
+        ...) of the first PDF.
+    :return: The merged PDF, see ``pdfserver.storage``.
+    """
+    temp_file = SpoolWriter()
+    try:
+        writer = PdfWriter()
+        for index, pdf in enumerate(pdfs):
+            with pdf.open() as f:
+                reader = PdfReader(f)
+                writer.append(reader)
+                if keep_metadata and index == 0 and reader.metadata:
+                    writer.add_metadata(reader.metadata)
+        writer.write(temp_file)
+        return temp_file.result()
+    except Exception as e:
+        temp_file.discard()
+        logger.error(f"Error merging PDFs: {e}")
+        raise
+
+
+def zip_pdfs(files):
+    """Pack PDFs into a ZIP archive. Duplicate file names are numbered.
+
+    :param files: (filename, pdf) tuples.
+    :return: The archive, see ``pdfserver.storage``.
+    """
+    temp_file = SpoolWriter()
+    names = set()
+    try:
+        # PDFs are compressed already
+        with zipfile.ZipFile(temp_file, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for filename, pdf in files:
+                name, ext = os.path.splitext(filename)
+                unique, number = filename, 1
+                while unique in names:
+                    number += 1
+                    unique = f'{name}-{number}{ext}'
+                names.add(unique)
+                with pdf.open() as f, archive.open(unique, 'w') as entry:
+                    while chunk := f.read(1024 * 1024):
+                        entry.write(chunk)
+        return temp_file.result()
+    except Exception as e:
+        temp_file.discard()
+        logger.error(f"Error creating ZIP archive: {e}")
+        raise
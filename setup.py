@@ -13,6 +13,7 @@ setup(name='wcs.pdfserver',
             'weasyprint',
             'urllib3',
             'markdown',
+            'pypdf',
       ],
       extras_require={
             'test': [
@@ -0,0 +1,53 @@
+from pdfserver import bundles
+from pdfserver import worker
+from unittest.mock import patch
+import json
+import pytest
+
+
+@pytest.fixture
+def bundle_file(tmp_path, httpserver):
+    httpserver.expect_request("/corporate.css").respond_with_data(
+        'h1 { color: navy; }', content_type='text/css'
+    )
+    (tmp_path / 'a4.css').write_text('@page { size: A4; }')
+    path = tmp_path / 'bundles.json'
+    path.write_text(json.dumps({
+        'corporate-a4': [
+            httpserver.url_for('/corporate.css'), 'a4.css', {'css': 'p { margin: 0; }'},
+        ],
+    }))
+    yield str(path)
+    bundles.BUNDLES.clear()
+    worker._bundle_sources.clear()
+    worker._bundles.clear()
+
+
+def test_load_bundles(bundle_file, tmp_path, httpserver):
+    loaded = bundles.load_bundles(bundle_file)
+    assert loaded['corporate-a4'].sources == [
+        ('h1 { color: navy; }', httpserver.url_for('/corporate.css')),
+        ('@page { size: A4; }', str(tmp_path / 'a4.css')),
+        ('p { margin: 0; }', None),
+    ]
+
+    path = tmp_path / 'invalid.json'
+    path.write_text(json.dumps({'broken': 'a4.css'}))
+    with pytest.raises(ValueError):
+        bundles.load_bundles(str(path))
+
+
+def test_bundles_are_parsed_once_per_worker(bundle_file):
+    worker.init_worker(bundles.register_bundles(bundle_file))
+    assert 'corporate-a4' in bundles.BUNDLES
+    assert len(worker._bundles['corporate-a4']) == 3
+
+    with patch('pdfserver.worker.CSS', side_effect=AssertionError('parsed again')):
+        pdf = worker.render_html('<h1>Invoice</h1>', None, css_profile='corporate-a4')
+    assert pdf.read().startswith(b'%PDF')
+
+
+async def test_unknown_css_profile_is_rejected(client):
+    resp = await client.post('/convert-html', json={'html': '<p>a</p>', 'css_profile': 'letter'})
+    assert resp.status == 400
+    assert (await resp.json())['error'] == 'Unknown css_profile: letter'
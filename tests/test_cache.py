@@ -0,0 +1,165 @@
+from pdfserver.cache import ExpiringPDFCache
+from pdfserver.storage import PDFData
+from pdfserver.storage import SpoolWriter
+from pdfserver.store import JobStore
+from pdfserver.utils import TaskStatus
+from unittest.mock import patch
+import os
+import pytest
+import time
+
+
+@pytest.fixture(autouse=True)
+def spool_dir(tmp_path):
+    with patch('pdfserver.config.SPOOL_DIR', str(tmp_path)):
+        yield tmp_path
+
+
+def test_spool_writer_keeps_small_pdfs_in_memory():
+    writer = SpoolWriter(threshold=10)
+    writer.write(b'%PDF-')
+    pdf = writer.result()
+    assert pdf.path is None
+    assert pdf.read() == b'%PDF-'
+
+
+def test_spool_writer_moves_large_pdfs_to_disk(spool_dir):
+    writer = SpoolWriter(threshold=10)
+    writer.write(b'%PDF-1.7\n')
+    writer.write(b'more data')
+    pdf = writer.result()
+    assert os.path.dirname(pdf.path) == str(spool_dir)
+    assert pdf.size == 18
+    assert pdf.read() == b'%PDF-1.7\nmore data'
+
+
+async def test_pdfs_beyond_memory_budget_are_written_to_disk():
+    cache = ExpiringPDFCache(memory_budget=10)
+    uid, _ = cache.add()
+    cache.save_pdf(uid, 'a.pdf', await cache.fit_to_budget(PDFData(b'12345678')))
+    assert cache.get_pdf(uid).data.path is None
+
+    uid, _ = cache.add()
+    cache.save_pdf(uid, 'b.pdf', await cache.fit_to_budget(PDFData(b'12345678')))
+    assert cache.get_pdf(uid).data.path is not None
+    assert (cache.pdfs.memory_bytes, cache.pdfs.disk_bytes) == (8, 8)
+
+
+async def test_expired_pdf_files_are_deleted():
+    cache = ExpiringPDFCache(expiry_minutes=1)
+    writer = SpoolWriter(threshold=0)
+    writer.write(b'%PDF-')
+    pdf = writer.result()
+    now = time.time()
+
+    first, _ = cache.add()
+    cache.save_pdf(first, 'a.pdf', pdf, key='same')
+    with patch('pdfserver.cache.time.time', return_value=now + 30):
+        second, _ = cache.add()
+        cache.save_pdf(second, 'a.pdf', cache.find_result('same'))
+    assert cache.get_pdf(second).status == TaskStatus.COMPLETED.value
+
+    with patch('pdfserver.cache.time.time', return_value=now + 61):
+        await cache._remove_expired()
+    assert cache.get_pdf(first) is None
+    assert os.path.exists(pdf.path)
+
+    with patch('pdfserver.cache.time.time', return_value=now + 91):
+        await cache._remove_expired()
+    assert not os.path.exists(pdf.path)
+    assert cache.pdfs.disk_bytes == 0
+    assert cache.stats()['expirations'] == 2
+
+
+def test_least_recently_used_pdfs_are_evicted():
+    cache = ExpiringPDFCache(max_bytes=20)
+    uids = []
+    for _ in range(2):
+        uid, _ = cache.add()
+        cache.save_pdf(uid, 'a.pdf', PDFData(b'x' * 8))
+        uids.append(uid)
+    cache.get_pdf(uids[0])
+
+    uid, _ = cache.add()
+    cache.save_pdf(uid, 'c.pdf', PDFData(b'x' * 8))
+    assert cache.get_pdf(uids[1]) is None
+    assert cache.get_pdf(uids[0]) is not None
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['memory_bytes'] == 16
+
+
+async def test_completed_jobs_expire_after_completion():
+    cache = ExpiringPDFCache(expiry_minutes=1)
+    now = time.time()
+    uid, _ = cache.add()
+    with patch('pdfserver.cache.time.time', return_value=now + 50):
+        cache.save_pdf(uid, 'a.pdf', PDFData(b'%PDF-'))
+
+    with patch('pdfserver.cache.time.time', return_value=now + 61):
+        await cache._remove_expired()
+    assert cache.get_pdf(uid) is not None
+
+    with patch('pdfserver.cache.time.time', return_value=now + 111):
+        await cache._remove_expired()
+    assert cache.get_pdf(uid) is None
+
+
+async def test_jobs_are_shared_through_the_store(tmp_path):
+    # Two server processes
+    path = str(tmp_path / 'jobs.sqlite')
+    first = ExpiringPDFCache(store=JobStore(path))
+    second = ExpiringPDFCache(store=JobStore(path))
+
+    uid, _ = first.add('a.pdf')
+    # Written in the background
+    first.store.flush()
+    assert second.get_pdf(uid).status == TaskStatus.RUNNING.value
+    assert second.get_pdf(uid).filename == 'a.pdf'
+
+    first.save_pdf(uid, 'a.pdf', await first.fit_to_budget(PDFData(b'%PDF-')))
+    first.store.flush()
+    job = second.get_pdf(uid)
+    assert job.status == TaskStatus.COMPLETED.value
+    assert job.data.read() == b'%PDF-'
+    assert uid not in second.storage
+
+    batch_id, batch = first.add_batch('all.pdf', ['1.pdf', '2.pdf'])
+    first.fail_pdf(batch_id, 'Failed')
+    first.store.flush()
+    job = second.get_pdf(batch_id)
+    assert (job.status, job.message, job.items) == (TaskStatus.FAILED.value, 'Failed', batch.items)
+
+    first._remove(uid)
+    first.store.flush()
+    assert second.get_pdf(uid) is None
+
+
+async def test_store_removes_jobs_left_behind(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.sqlite'))
+    cache = ExpiringPDFCache(expiry_minutes=1, store=store)
+    uid, _ = cache.add()
+    cache.save_pdf(uid, 'a.pdf', await cache.fit_to_budget(PDFData(b'%PDF-')))
+    path = cache.get_pdf(uid).data.path
+    store.flush()
+
+    # The process exited without removing its jobs
+    other = ExpiringPDFCache(expiry_minutes=1, store=store)
+    with patch('pdfserver.store.time.time', return_value=time.time() + 61):
+        assert other.get_pdf(uid) is None
+        assert store.remove_expired(grace=0).result() == 1
+    assert not os.path.exists(path)
+
+
+async def test_store_writes_do_not_wait_for_other_processes(tmp_path):
+    import sqlite3
+    path = str(tmp_path / 'jobs.sqlite')
+    cache = ExpiringPDFCache(store=JobStore(path))
+    # Another process holds the write lock
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    start = time.monotonic()
+    uid, _ = cache.add('a.pdf')
+    assert time.monotonic() - start < 0.5
+    other.execute('COMMIT')
+    cache.store.flush()
+    assert ExpiringPDFCache(store=JobStore(path)).get_pdf(uid).filename == 'a.pdf'
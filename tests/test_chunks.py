@@ -0,0 +1,70 @@
+from pdfserver import chunks
+import pytest
+import tinyhtml5
+import xml.etree.ElementTree as ET
+
+
+DOCUMENT = (
+    '<html><head><style>h1 { color: red }</style></head><body>intro<main><h1>Title</h1>'
+    '<section id="a">A<section id="nested">N</section></section>between'
+    '<section id="b">B</section><p>after</p></main>end</body></html>'
+)
+
+
+def chunk(index, selector='section'):
+    root = tinyhtml5.parse(DOCUMENT, namespace_html_elements=False)
+    chunks.select(root, selector, index)
+    return root
+
+
+def test_documents_are_split_before_top_level_matches():
+    root = tinyhtml5.parse(DOCUMENT, namespace_html_elements=False)
+    assert chunks.count(root, 'section') == 2
+    assert chunks.count(root, '#nested') == 1
+    assert chunks.count(root, 'p') == 1
+
+    first = chunk(0)
+    assert ET.tostring(first.find('body'), encoding='unicode') == (
+        '<body>intro<main><h1>Title</h1><section id="a">A<section id="nested">N</section>'
+        '</section>between</main></body>'
+    )
+    second = chunk(1)
+    assert ET.tostring(second.find('body'), encoding='unicode') == (
+        '<body><main><section id="b">B</section><p>after</p></main>end</body>'
+    )
+    # The head is repeated in every chunk
+    assert second.find('head/style').text == 'h1 { color: red }'
+
+    with pytest.raises(IndexError):
+        chunk(2)
+
+
+def test_page_counters():
+    page_numbers = '@page { @bottom-center { content: "Page " counter(page) } }'
+    assert not chunks.uses_page_counter(['h1 { color: red }'])
+    assert chunks.uses_page_counter(['h1 { color: red }', page_numbers])
+    assert chunks.unsplittable([page_numbers, 'section { break-before: page }']) is None
+
+
+@pytest.mark.parametrize('css', (
+    '@page { @bottom-right { content: counter(pages, lower-roman) } }',
+    'a::after { content: target-counter(attr(href), page) }',
+    'h2::before { content: counter(chapter) ". " }',
+    'h2 { counter-increment: chapter }',
+    'li::marker { content: counters(list-item, ".") }',
+    '@page :first { margin-top: 5cm }',
+    '@page chapter:left { margin-left: 3cm }',
+    '@page :blank { @top-center { content: none } }',
+    'h1 { break-before: right }',
+    'h1 { string-set: title content() }',
+    'header { position: running(header) }',
+))
+def test_state_across_chunks_prevents_splitting(css):
+    assert chunks.unsplittable(['h1 { color: red }', css])
+
+
+def test_invalid_selector():
+    with pytest.raises(ValueError):
+        chunks.validate_selector('section[')
+    with pytest.raises(ValueError):
+        chunks.validate_selector('')
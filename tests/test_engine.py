@@ -0,0 +1,256 @@
+from pdfserver import metrics
+from pdfserver.engine import PRIORITY_INTERACTIVE
+from pdfserver.engine import QueueFull
+from pdfserver.engine import RenderEngine
+from pdfserver.engine import RenderLimitExceeded
+from pdfserver.engine import RenderWorker
+from pdfserver.engine import WorkerDied
+from unittest.mock import patch
+import asyncio
+import os
+import pytest
+import time
+
+
+@pytest.fixture
+def engine():
+    engine = RenderEngine(workers=2)
+    yield engine
+    engine.shutdown()
+
+
+async def test_run_executes_in_worker_process(engine):
+    pid = await engine.run(os.getpid)
+    assert pid != os.getpid()
+
+
+async def test_run_propagates_exceptions(engine):
+    with pytest.raises(ValueError):
+        await engine.run(int, 'not a number')
+
+
+async def test_jobs_run_in_parallel(engine):
+    await asyncio.gather(engine.run(os.getpid), engine.run(os.getpid))
+    start = time.monotonic()
+    await asyncio.gather(engine.run(time.sleep, 1), engine.run(time.sleep, 1))
+    assert time.monotonic() - start < 1.8
+
+
+def restarts(reason):
+    return metrics.WORKER_RESTARTS.values.get((reason,), 0)
+
+
+async def test_cancel_kills_running_job(engine):
+    cancelled = restarts('cancelled')
+    job = engine.submit(time.sleep, 30)
+    await asyncio.sleep(0.5)
+    job.cancel()
+    with pytest.raises(WorkerDied):
+        await asyncio.wait_for(asyncio.wrap_future(job.future), 5)
+    assert restarts('cancelled') == cancelled + 1
+
+    # The slot is usable again
+    assert await engine.run(os.getpid)
+
+
+async def test_abandoned_job_restart_reason(engine):
+    died, timeout = restarts('died'), restarts('timeout')
+    job = engine.submit(time.sleep, 30)
+    with pytest.raises(asyncio.TimeoutError):
+        await engine.wait(job, 0.5)
+    with pytest.raises(WorkerDied):
+        await asyncio.wait_for(asyncio.wrap_future(job.future), 5)
+    assert (restarts('died'), restarts('timeout')) == (died, timeout + 1)
+
+
+async def test_cancel_after_completion_keeps_worker(engine):
+    job = engine.submit(os.getpid)
+    pid = await asyncio.wrap_future(job.future)
+    worker = next(worker for worker in engine._workers if worker.process.pid == pid)
+    # A late cancel must not kill the worker, it may render another job
+    worker.abort(job, 'cancelled')
+    assert worker.process.is_alive()
+
+
+async def test_admitted_jobs_hold_queue_slots():
+    engine = RenderEngine(workers=1, max_queued=2)
+    try:
+        admission = engine.admit(2)
+        with pytest.raises(QueueFull):
+            engine.admit()
+        first = admission.take()
+        await engine.run(os.getpid, admission=first)
+        assert first.count == 0
+        engine.admit().release()
+        admission.release()
+        assert engine._reserved == 0
+    finally:
+        engine.shutdown()
+
+
+async def test_jobs_with_same_key_run_once(engine):
+    first = engine.submit(time.sleep, 0.5, key='same')
+    second = engine.submit(time.sleep, 0.5, key='same')
+    assert first is second
+    assert first.waiters == 2
+
+    await asyncio.wrap_future(first.future)
+    assert engine.submit(os.getpid, key='same') is not first
+
+
+async def test_shared_job_survives_one_waiter_leaving(engine):
+    waiter = asyncio.ensure_future(engine.run(time.sleep, 0.5, key='shared'))
+    other = asyncio.ensure_future(engine.run(time.sleep, 0.5, key='shared'))
+    await asyncio.sleep(0.1)
+    waiter.cancel()
+    await other
+
+
+async def test_interactive_jobs_are_dispatched_first():
+    engine = RenderEngine(workers=1, max_queued=2)
+    try:
+        blocker = engine.submit(time.sleep, 0.5)
+        await asyncio.sleep(0.2)
+        background = engine.submit(time.time)
+        shared = engine.submit(time.time, key='shared')
+        assert engine.position(background) == 0
+        assert engine.position(shared) == 1
+        with pytest.raises(QueueFull):
+            engine.admit()
+
+        interactive = engine.submit(time.time, priority=PRIORITY_INTERACTIVE)
+        # Waiting for a queued job with a higher priority moves it up
+        assert engine.submit(time.time, key='shared', priority=PRIORITY_INTERACTIVE) is shared
+        assert engine.position(interactive) == 0
+        assert engine.position(shared) == 1
+        assert engine.position(background) == 2
+
+        results = [
+            await asyncio.wrap_future(job.future)
+            for job in (blocker, interactive, shared, background)
+        ]
+        assert results[1] < results[2] < results[3]
+        assert engine.position(background) is None
+        engine.admit()
+    finally:
+        engine.shutdown()
+
+
+async def test_initializer_runs_in_every_worker():
+    engine = RenderEngine(workers=2, initializer=os.chdir, initargs=('/',))
+    try:
+        assert await asyncio.gather(engine.run(os.getcwd), engine.run(os.getcwd)) == ['/', '/']
+    finally:
+        engine.shutdown()
+
+
+async def test_workers_are_warmed_up_before_ready():
+    from pdfserver.worker import warm_up
+    engine = RenderEngine(workers=2, warmup=warm_up)
+    try:
+        assert not engine.ready()
+        engine.start()
+        for _ in range(100):
+            if engine.ready():
+                break
+            await asyncio.sleep(0.1)
+        report = engine.startup_report()
+        assert report['ready']
+        assert report['workers'] == {'ready': 2, 'total': 2}
+        assert len(report['warmup']) == 2
+        assert set(report['warmup'][0]) >= {'process', 'fonts', 'render', 'total'}
+        # Warmed up workers are reused for jobs
+        pids = {await engine.run(os.getpid) for _ in range(4)}
+        assert pids <= {worker.process.pid for worker in engine._workers}
+    finally:
+        engine.shutdown()
+
+
+async def test_failed_worker_starts_are_retried():
+    from pdfserver.worker import warm_up
+    start = RenderWorker.start
+    calls = []
+
+    def start_once_failing(worker):
+        calls.append(worker)
+        if len(calls) == 1:
+            raise OSError(11, 'Resource temporarily unavailable')
+        return start(worker)
+
+    engine = RenderEngine(workers=2, warmup=warm_up)
+    with patch('pdfserver.engine.WORKER_START_BACKOFF', 0.1), \
+            patch.object(RenderWorker, 'start', start_once_failing):
+        try:
+            engine.start()
+            for _ in range(100):
+                if engine.ready():
+                    break
+                await asyncio.sleep(0.1)
+            assert engine.startup_report()['workers'] == {'ready': 2, 'total': 2}
+            assert len(calls) == 3
+            pids = {await engine.run(os.getpid) for _ in range(4)}
+            assert pids <= {worker.process.pid for worker in engine._workers}
+        finally:
+            engine.shutdown()
+
+
+def allocate(megabytes):
+    """Job holding ``megabytes`` of resident memory for a while."""
+    data = b'x' * (megabytes * 2 ** 20)
+    time.sleep(30)
+    return len(data)
+
+
+async def test_job_exceeding_memory_limit_kills_worker():
+    engine = RenderEngine(workers=1, max_memory=100 * 2 ** 20)
+    try:
+        pid = await engine.run(os.getpid)
+        start = time.monotonic()
+        with pytest.raises(RenderLimitExceeded, match='memory limit of 100 MB'):
+            await engine.run(allocate, 300)
+        assert time.monotonic() - start < 5
+        assert await engine.run(os.getpid) != pid
+    finally:
+        engine.shutdown()
+
+
+async def test_job_exceeding_time_limit_kills_worker():
+    engine = RenderEngine(workers=1, timeout=0.5)
+    try:
+        pid = await engine.run(os.getpid)
+        start = time.monotonic()
+        with pytest.raises(RenderLimitExceeded, match='time limit of 0.5 seconds'):
+            await engine.run(time.sleep, 30)
+        assert time.monotonic() - start < 5
+        assert await engine.run(os.getpid) != pid
+    finally:
+        engine.shutdown()
+
+
+async def test_workers_are_recycled_after_max_jobs():
+    engine = RenderEngine(workers=1, max_jobs=2)
+    try:
+        pids = [await engine.run(os.getpid) for _ in range(4)]
+        assert pids[0] == pids[1] != pids[2] == pids[3]
+    finally:
+        engine.shutdown()
+
+
+async def test_failed_recycling_keeps_the_dispatcher_running():
+    stop = RenderWorker.stop
+    failures = []
+
+    def stop_once_failing(worker):
+        if worker.process is not None and not failures:
+            failures.append(worker.process.pid)
+            raise OSError('Broken pipe')
+        return stop(worker)
+
+    engine = RenderEngine(workers=1, max_jobs=1)
+    with patch.object(RenderWorker, 'stop', stop_once_failing):
+        try:
+            pids = [await asyncio.wait_for(engine.run(os.getpid), 10) for _ in range(3)]
+            assert failures == pids[:1]
+            assert len(set(pids)) == 3
+        finally:
+            engine.shutdown()
@@ -1,9 +1,15 @@
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from pdfserver.fetcher import basic_auth_url_fetcher
+from pdfserver.fetcher import pool_manager
+from pdfserver.fetcher import ResourceCache
 from pytest_httpserver import RequestMatcher
 from unittest.mock import patch
+from urllib.error import HTTPError
 import os
 import pytest
 import gzip
+import threading
 
 
 def test_basic_auth_url_fetcher_with_auth(httpserver):
@@ -54,3 +60,135 @@ def test_basic_auth_url_fetcher_gzip_encoding(httpserver):
     assert result['mime_type'] == 'text/html'
     assert 'file_obj' in result
     httpserver.assert_request_made(RequestMatcher("/test.gz"))
+
+
+def test_resource_cache_serves_fresh_responses(httpserver):
+    httpserver.expect_request("/logo.png").respond_with_data(
+        b'png-data', content_type="image/png", headers={'Cache-Control': 'max-age=60'}
+    )
+    url = httpserver.url_for("/logo.png")
+    cache = ResourceCache()
+
+    assert cache.fetch(url)['string'] == b'png-data'
+    result = cache.fetch(url)
+    assert result['string'] == b'png-data'
+    assert result['mime_type'] == 'image/png'
+    assert (cache.hits, cache.misses) == (1, 1)
+    httpserver.assert_request_made(RequestMatcher("/logo.png"), count=1)
+
+
+def test_resource_cache_revalidates_stale_responses(httpserver):
+    httpserver.expect_request(
+        "/logo.png", headers={'If-None-Match': '"v1"'}
+    ).respond_with_data('', status=304)
+    httpserver.expect_request("/logo.png").respond_with_data(
+        b'png-data', content_type="image/png", headers={'ETag': '"v1"', 'Cache-Control': 'no-cache'}
+    )
+    url = httpserver.url_for("/logo.png")
+    cache = ResourceCache()
+
+    cache.fetch(url)
+    assert cache.fetch(url)['string'] == b'png-data'
+    assert cache.revalidations == 1
+    httpserver.assert_request_made(RequestMatcher("/logo.png"), count=2)
+
+
+def test_resource_cache_memory_budget(httpserver, tmp_path):
+    for name in ('a', 'b'):
+        httpserver.expect_request(f"/{name}.png").respond_with_data(b'x' * 100, content_type="image/png")
+    cache = ResourceCache(max_bytes=150, ttl=60, disk_dir='')
+
+    cache.fetch(httpserver.url_for("/a.png"))
+    cache.fetch(httpserver.url_for("/b.png"))
+    assert list(cache.entries) == [httpserver.url_for("/b.png")]
+    assert cache.evictions == 1
+
+    cache = ResourceCache(max_bytes=150, ttl=60, disk_dir=str(tmp_path))
+    cache.fetch(httpserver.url_for("/a.png"))
+    cache.fetch(httpserver.url_for("/b.png"))
+    assert cache.stats()['disk_bytes'] == 100
+    result = cache.fetch(httpserver.url_for("/a.png"))
+    assert result['file_obj'].read() == b'x' * 100
+    result['file_obj'].close()
+
+
+def test_resource_cache_spills_redirected_urls_separately(httpserver, tmp_path):
+    for name in ('a', 'b'):
+        httpserver.expect_request(f"/{name}.png").respond_with_data(
+            '', status=302, headers={'Location': '/logo.png'}
+        )
+    httpserver.expect_request("/logo.png").respond_with_data(b'x' * 100, content_type="image/png")
+    httpserver.expect_request("/other.png").respond_with_data(b'y' * 100, content_type="image/png")
+    cache = ResourceCache(max_bytes=50, ttl=60, disk_dir=str(tmp_path))
+
+    a, b = httpserver.url_for("/a.png"), httpserver.url_for("/b.png")
+    cache.fetch(a)
+    cache.fetch(b)
+    assert cache.entries[a].path != cache.entries[b].path
+    cache._remove(a)
+    result = cache.fetch(b)
+    assert result['file_obj'].read() == b'x' * 100
+    result['file_obj'].close()
+
+
+def test_basic_auth_url_fetcher_follows_redirects(httpserver):
+    httpserver.expect_request("/old.html").respond_with_data('', status=302, headers={'Location': '/new.html'})
+    httpserver.expect_request("/new.html").respond_with_data('<html></html>', content_type="text/html")
+
+    result = basic_auth_url_fetcher(httpserver.url_for("/old.html"))
+    assert result['redirected_url'] == httpserver.url_for("/new.html")
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', '3')
+        self.end_headers()
+        self.wfile.write(b'png')
+
+    def log_message(self, *args):
+        pass
+
+
+def test_basic_auth_url_fetcher_reuses_connections():
+    server = ThreadingHTTPServer(('localhost', 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://localhost:{server.server_port}/image.png'
+    try:
+        for _ in range(5):
+            result = basic_auth_url_fetcher(url)
+            with result['file_obj'] as file_obj:
+                assert file_obj.read() == b'png'
+        assert pool_manager().connection_from_url(url).num_connections == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_basic_auth_url_fetcher_http_error(httpserver):
+    httpserver.expect_request("/missing.png").respond_with_data('Not Found', status=404)
+    with pytest.raises(HTTPError):
+        basic_auth_url_fetcher(httpserver.url_for("/missing.png"))
+
+
+def test_documents_are_not_served_from_the_resource_cache(httpserver):
+    from io import BytesIO
+    from pdfserver import worker
+    from pypdf import PdfReader
+    section = '<section style="break-before: page">Part</section>'
+    httpserver.expect_ordered_request("/doc.html").respond_with_data(
+        f'<body>{section}</body>', content_type='text/html'
+    )
+    httpserver.expect_ordered_request("/doc.html").respond_with_data(
+        f'<body>{section * 2}</body>', content_type='text/html'
+    )
+    url = httpserver.url_for("/doc.html")
+
+    for pages in (1, 2):
+        pdf = worker.render_url(url, [])
+        assert len(PdfReader(BytesIO(pdf.read())).pages) == pages
+    assert url not in worker.resource_cache.entries
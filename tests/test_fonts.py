@@ -0,0 +1,31 @@
+from pdfserver.fonts import FontCache
+from pdfserver.fonts import is_font
+from pytest_httpserver import RequestMatcher
+
+
+def test_is_font():
+    assert is_font('http://localhost/a.woff2', None)
+    assert is_font('http://localhost/font', 'font/ttf')
+    assert not is_font('http://localhost/logo.png', 'image/png')
+
+
+def test_fonts_are_cached_by_url(httpserver):
+    httpserver.expect_request("/font.woff").respond_with_data(b'wOFF-data', content_type="font/woff")
+    url = httpserver.url_for("/font.woff")
+    cache = FontCache()
+
+    assert cache.fetch(url)['string'] == b'wOFF-data'
+    assert cache.fetch(url)['string'] == b'wOFF-data'
+    assert (cache.hits, cache.misses, cache.size) == (1, 1, 9)
+    httpserver.assert_request_made(RequestMatcher("/font.woff"), count=1)
+
+
+def test_other_resources_are_not_cached(httpserver):
+    httpserver.expect_request("/logo.png").respond_with_data(b'png', content_type="image/png")
+    url = httpserver.url_for("/logo.png")
+    cache = FontCache()
+
+    cache.fetch(url)
+    cache.fetch(url)
+    assert cache.fonts == {}
+    httpserver.assert_request_made(RequestMatcher("/logo.png"), count=2)
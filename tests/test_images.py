@@ -0,0 +1,122 @@
+from io import BytesIO
+from pdfserver.fetcher import ResourceCache
+from pdfserver.images import ImageCache
+from PIL import Image
+from pytest_httpserver import RequestMatcher
+from weasyprint import DEFAULT_OPTIONS
+from weasyprint.images import get_image_from_uri
+
+
+def png(color, size=4):
+    output = BytesIO()
+    Image.new('RGB', (size, size), color).save(output, format='PNG')
+    return output.getvalue()
+
+
+def load(cache, resources, url, **options):
+    """Load an image the way a render does."""
+    return get_image_from_uri(
+        cache=cache.for_options(options), url_fetcher=resources.fetch,
+        options={**DEFAULT_OPTIONS, **options}, url=url,
+    )
+
+
+def test_images_are_reused_across_renders(httpserver):
+    httpserver.expect_request("/logo.png").respond_with_data(
+        png('red'), content_type='image/png', headers={'ETag': '"v1"'}
+    )
+    url = httpserver.url_for("/logo.png")
+    resources = ResourceCache(ttl=60)
+    cache = ImageCache(validator=resources.validator)
+
+    image = load(cache, resources, url)
+    assert load(cache, resources, url) is image
+    cache.end_render()
+    assert load(cache, resources, url) is image
+    cache.end_render()
+    assert (cache.hits, cache.misses) == (1, 1)
+    httpserver.assert_request_made(RequestMatcher("/logo.png"), count=1)
+
+    # Other image options encode images differently
+    assert load(cache, resources, url, dpi=96) is not image
+
+
+def test_downsampled_images_are_restored_for_later_renders(httpserver):
+    httpserver.expect_request("/photo.png").respond_with_data(
+        png('red', size=40), content_type='image/png', headers={'ETag': '"v1"'}
+    )
+    url = httpserver.url_for("/photo.png")
+    resources = ResourceCache(ttl=60)
+    cache = ImageCache(validator=resources.validator)
+
+    # Drawn small, WeasyPrint replaces the data of the image by a thumbnail
+    image = load(cache, resources, url, dpi=96)
+    assert image.get_x_object(True, 0.25).extra['Width'] == 10
+    cache.end_render()
+
+    # Drawn at full size by a later render
+    assert load(cache, resources, url, dpi=96) is image
+    assert image.get_x_object(True, 1).extra['Width'] == 40
+    assert Image.open(BytesIO(image.image_data.data)).size == (40, 40)
+    cache.end_render()
+    assert cache.size == len(png('red', size=40))
+
+
+def test_changed_images_are_loaded_again(httpserver):
+    httpserver.expect_ordered_request("/logo.png").respond_with_data(
+        png('red'), content_type='image/png', headers={'ETag': '"v1"'}
+    )
+    httpserver.expect_ordered_request("/logo.png").respond_with_data(
+        png('blue'), content_type='image/png', headers={'ETag': '"v2"'}
+    )
+    url = httpserver.url_for("/logo.png")
+    resources = ResourceCache(ttl=0)
+    cache = ImageCache(validator=resources.validator)
+
+    image = load(cache, resources, url)
+    cache.end_render()
+    assert load(cache, resources, url) is not image
+    cache.end_render()
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_uncacheable_images_are_kept_for_one_render(httpserver):
+    httpserver.expect_request("/logo.png").respond_with_data(
+        png('red'), content_type='image/png', headers={'Cache-Control': 'no-store'}
+    )
+    url = httpserver.url_for("/logo.png")
+    resources = ResourceCache(ttl=60)
+    cache = ImageCache(validator=resources.validator)
+
+    image = load(cache, resources, url)
+    assert load(cache, resources, url) is image
+    cache.end_render()
+    assert load(cache, resources, url) is not image
+    assert cache.size > 0
+    cache.end_render()
+    assert cache.size == 0
+
+
+def test_least_recently_used_images_are_evicted(httpserver):
+    resources = ResourceCache(ttl=60)
+    colors = (('a', 'red'), ('b', 'green'), ('c', 'blue'))
+    cache = ImageCache(
+        validator=resources.validator, max_bytes=2 * max(len(png(color)) for _, color in colors)
+    )
+    urls = []
+    for name, color in colors:
+        httpserver.expect_request(f"/{name}.png").respond_with_data(
+            png(color), content_type='image/png'
+        )
+        urls.append(httpserver.url_for(f"/{name}.png"))
+
+    first = load(cache, resources, urls[0])
+    load(cache, resources, urls[1])
+    cache.end_render()
+    assert load(cache, resources, urls[0]) is first
+    load(cache, resources, urls[2])
+    cache.end_render()
+
+    assert cache.stats()['evictions'] == 1
+    assert load(cache, resources, urls[0]) is first
+    assert cache.size <= cache.max_bytes
@@ -0,0 +1,63 @@
+from email.message import Message
+from pdfserver import metrics
+from pdfserver.fetcher import ResourceCache
+from urllib.error import HTTPError
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.Histogram('test_duration_seconds', 'Test.', ['endpoint'], buckets=(1, 5))
+    histogram.observe(0.5, endpoint='a')
+    histogram.observe(3, endpoint='a')
+    histogram.observe(10, endpoint='a')
+
+    assert histogram.collect() == [
+        'test_duration_seconds_bucket{endpoint="a",le="1"} 1',
+        'test_duration_seconds_bucket{endpoint="a",le="5"} 2',
+        'test_duration_seconds_bucket{endpoint="a",le="+Inf"} 3',
+        'test_duration_seconds_sum{endpoint="a"} 13.5',
+        'test_duration_seconds_count{endpoint="a"} 3',
+    ]
+
+
+def test_samples_are_merged_from_other_processes():
+    counter = metrics.Counter('test_bytes_total', 'Test.', ['host'])
+    counter.inc(10, host='example.com')
+    samples = {counter.name: counter.drain()}
+    assert counter.collect() == []
+
+    counter.inc(5, host='example.com')
+    metrics.merge(samples)
+    assert counter.collect() == ['test_bytes_total{host="example.com"} 15']
+
+
+def test_label_values_are_escaped():
+    counter = metrics.Counter('test_escaped_total', 'Test.', ['host'])
+    counter.inc(host='a"b')
+    assert counter.collect() == ['test_escaped_total{host="a\\"b"} 1']
+
+
+def test_resource_cache_counters_are_exported():
+    def url_fetcher(url, headers=None):
+        if headers:
+            raise HTTPError(url, 304, 'Not Modified', Message(), None)
+        return {
+            'string': b'x' * 100, 'mime_type': 'image/png', 'encoding': None,
+            'filename': None, 'redirected_url': url,
+            'headers': {'ETag': '"v1"', 'Cache-Control': 'max-age=60'},
+        }
+
+    metrics.drain()
+    cache = ResourceCache(max_bytes=150, ttl=60, disk_dir='', url_fetcher=url_fetcher)
+    cache.fetch('http://example.com/a.png')
+    cache.fetch('http://example.com/a.png')
+    cache.entries['http://example.com/a.png'].fresh_until = 0
+    cache.fetch('http://example.com/a.png')
+    cache.fetch('http://example.com/b.png')
+
+    # Recorded in the render workers, and sent back with the job results
+    metrics.merge(metrics.drain())
+    text = metrics.render()
+    assert 'pdfserver_resource_cache_hits_total 2\n' in text
+    assert 'pdfserver_resource_cache_misses_total 2\n' in text
+    assert 'pdfserver_resource_cache_revalidations_total 1\n' in text
+    assert 'pdfserver_resource_cache_evictions_total 1\n' in text
@@ -1,4 +1,5 @@
 from pdfserver.server import TaskStatus
+from unittest.mock import patch
 import time
 import asyncio
 
@@ -75,6 +76,21 @@ async def test_sync_conversion_to_pdf_success(client, httpserver):
     assert resp.headers['Content-Disposition'] == 'attachment; filename="test.pdf"'
 
 
+async def test_validators_are_only_fetched_for_result_reuse(client, httpserver):
+    from pdfserver import config
+    httpserver.expect_request("/test.html").respond_with_data(
+        TEST_HTML_RESPONSE, content_type="text/html", headers={'ETag': '"v1"'}
+    )
+    with patch.object(config, 'RESULT_CACHE', 0):
+        resp = await client.post('/convert_sync', json={'url': httpserver.url_for("/test.html")})
+    assert resp.status == 200
+    assert [request.method for request, _ in httpserver.log] == ['GET']
+
+    resp = await client.post('/convert_sync', json={'url': httpserver.url_for("/test.html")})
+    assert resp.status == 200
+    assert [request.method for request, _ in httpserver.log][1:] == ['HEAD', 'GET']
+
+
 async def test_sync_convert_to_pdf_missing_url(client):
     """Test PDF conversion with missing URL."""
     resp = await client.post(
@@ -319,3 +335,607 @@ async def test_sync_convert_html_to_pdf_invalid_json(client):
     assert resp.status == 400
     data = await resp.json()
     assert data['error'] == 'Invalid JSON in request body'
+
+
+def _slow_response(request):
+    from werkzeug import Response
+    time.sleep(2)
+    return Response(TEST_HTML_RESPONSE, content_type="text/html")
+
+
+async def test_sync_convert_to_pdf_deadline_exceeded(client, httpserver):
+    httpserver.expect_request("/slow.html").respond_with_handler(_slow_response)
+    start = time.monotonic()
+    resp = await client.post(
+        '/convert_sync',
+        json={
+            'url': httpserver.url_for("/slow.html"),
+            'filename': 'test.pdf',
+            'timeout': 0.5,
+        }
+    )
+    assert resp.status == 504
+    # The deadline includes the lookup of the document validators
+    assert time.monotonic() - start < 1.5
+    data = await resp.json()
+    assert 'deadline' in data['error']
+
+
+async def test_sync_convert_does_not_block_other_requests(client, httpserver):
+    httpserver.expect_request("/slow.html").respond_with_handler(_slow_response)
+    render = asyncio.ensure_future(client.post(
+        '/convert_sync',
+        json={'url': httpserver.url_for("/slow.html"), 'filename': 'test.pdf'}
+    ))
+    await asyncio.sleep(0.2)
+
+    start = time.monotonic()
+    resp = await client.get('/health')
+    assert resp.status == 200
+    assert time.monotonic() - start < 1
+    assert not render.done()
+
+    resp = await render
+    assert (await resp.read()).startswith(b'%PDF-')
+
+
+async def test_sync_convert_html_to_pdf_invalid_timeout(client):
+    resp = await client.post(
+        '/convert-html_sync',
+        json={'html': TEST_HTML_RESPONSE, 'timeout': 'soon'}
+    )
+    assert resp.status == 400
+    data = await resp.json()
+    assert data['error'] == 'Timeout must be a positive number of seconds'
+
+
+async def test_sync_convert_to_pdf_with_css_url(client, httpserver):
+    httpserver.expect_request("/test.html").respond_with_data(TEST_HTML_RESPONSE, content_type="text/html")
+    httpserver.expect_request("/style.css").respond_with_data('h1 { color: red; }', content_type="text/css")
+    resp = await client.post(
+        '/convert_sync',
+        json={
+            'url': httpserver.url_for("/test.html"),
+            'css': [httpserver.url_for("/style.css")],
+            'filename': 'test.pdf'
+        }
+    )
+    assert resp.status == 200
+    pdf_content = await resp.read()
+    assert pdf_content.startswith(b'%PDF-')
+
+
+async def test_identical_requests_reuse_rendered_pdf(client):
+    from pdfserver import server
+    payload = {'html': TEST_HTML_RESPONSE + '<p>reuse</p>', 'filename': 'test.pdf'}
+    resp = await client.post('/convert-html_sync', json=payload)
+    first = await resp.read()
+
+    with patch.object(server.render_engine, 'submit', side_effect=AssertionError('rendered again')):
+        resp = await client.post('/convert-html_sync', json=payload)
+        assert await resp.read() == first
+
+        resp = await client.post('/convert-html', json=payload)
+        uid = (await resp.json())['uid']
+        for _ in range(20):
+            status_data = await (await client.get(f'/status/{uid}')).json()
+            if status_data['status'] == TaskStatus.COMPLETED.value:
+                break
+            await asyncio.sleep(0.1)
+        resp_pdf = await client.get(status_data['download'])
+        assert await resp_pdf.read() == first
+
+
+async def test_sync_result_evicted_when_stored_is_sent(client):
+    from pdfserver import server
+    # Every PDF is written to disk and evicted as soon as it is stored
+    with patch.object(server.pdf_cache, 'max_bytes', 1), \
+            patch.object(server.pdf_cache.pdfs, 'memory_budget', 0):
+        resp = await client.post(
+            '/convert-html_sync', json={'html': TEST_HTML_RESPONSE + '<p>evicted</p>'}
+        )
+        assert resp.status == 200
+        assert (await resp.read()).startswith(b'%PDF-')
+
+
+async def test_download_pdf_stored_on_disk(client, tmp_path):
+    from pdfserver import server
+    from pdfserver.storage import PDFFile
+    path = tmp_path / 'stored.pdf'
+    path.write_bytes(b'%PDF-1.7 on disk')
+    uid, _ = server.pdf_cache.add()
+    server.pdf_cache.save_pdf(uid, 'disk.pdf', PDFFile(str(path), path.stat().st_size))
+
+    resp = await client.get(f'/pdf/{uid}')
+    assert resp.status == 200
+    assert resp.content_type == 'application/pdf'
+    assert resp.headers['Content-Disposition'] == 'attachment; filename="disk.pdf"'
+    assert await resp.read() == b'%PDF-1.7 on disk'
+
+
+async def test_download_pdf_supports_range_and_etag(client):
+    from pdfserver import server
+    from pdfserver.storage import PDFData
+    uid, _ = server.pdf_cache.add()
+    server.pdf_cache.save_pdf(uid, 'a.pdf', PDFData(b'%PDF-1.7 in memory'))
+
+    resp = await client.get(f'/pdf/{uid}', headers={'Range': 'bytes=0-4'})
+    assert resp.status == 206
+    assert resp.headers['Content-Range'] == 'bytes 0-4/18'
+    assert await resp.read() == b'%PDF-'
+
+    resp = await client.get(f'/pdf/{uid}', headers={'Range': 'bytes=-6'})
+    assert resp.status == 206
+    assert await resp.read() == b'memory'
+
+    resp = await client.get(f'/pdf/{uid}', headers={'Range': 'bytes=100-'})
+    assert resp.status == 416
+
+    resp = await client.get(f'/pdf/{uid}')
+    etag = resp.headers['ETag']
+    resp = await client.get(f'/pdf/{uid}', headers={'If-None-Match': etag})
+    assert resp.status == 304
+
+
+async def test_download_unknown_or_running_pdf(client):
+    from pdfserver import server
+    resp = await client.get('/pdf/unknown')
+    assert resp.status == 404
+
+    uid, _ = server.pdf_cache.add()
+    resp = await client.get(f'/pdf/{uid}')
+    assert resp.status == 404
+
+
+async def wait_for_batch(client, batch_id):
+    return await (await client.get(f'/batch/{batch_id}?wait=5')).json()
+
+
+async def test_convert_batch_merged(client, httpserver):
+    import pypdf
+    import io
+    httpserver.expect_request("/test.html").respond_with_data(
+        TEST_HTML_RESPONSE,
+        content_type="text/html"
+    )
+    resp = await client.post('/convert-batch', json={
+        'items': [
+            {'url': httpserver.url_for("/test.html"), 'filename': 'a.pdf'},
+            {'html': TEST_HTML_RESPONSE, 'css': 'h1 { color: red; }', 'filename': 'b.pdf'},
+        ],
+        'output': 'pdf',
+    })
+    assert resp.status == 200
+    data = await resp.json()
+    assert [item['filename'] for item in data['items']] == ['a.pdf', 'b.pdf']
+
+    data = await wait_for_batch(client, data['batch_id'])
+    assert data['status'] == TaskStatus.COMPLETED.value
+    assert all(item['status'] == TaskStatus.COMPLETED.value for item in data['items'])
+
+    resp = await client.get(data['download'])
+    assert resp.headers['Content-Disposition'] == 'attachment; filename="batch.pdf"'
+    reader = pypdf.PdfReader(io.BytesIO(await resp.read()))
+    assert len(reader.pages) == 2
+
+
+async def test_convert_batch_zip(client):
+    import io
+    import zipfile
+    resp = await client.post('/convert-batch', json={
+        'items': [{'html': TEST_HTML_RESPONSE}, {'html': TEST_HTML_RESPONSE + '<p>2</p>'}],
+        'output': 'zip',
+    })
+    data = await wait_for_batch(client, (await resp.json())['batch_id'])
+    assert data['status'] == TaskStatus.COMPLETED.value
+
+    resp = await client.get(data['download'])
+    assert resp.content_type == 'application/zip'
+    archive = zipfile.ZipFile(io.BytesIO(await resp.read()))
+    assert archive.namelist() == ['output.pdf', 'output-2.pdf']
+
+
+async def test_convert_batch_invalid_items(client):
+    resp = await client.post('/convert-batch', json={'items': [{'filename': 'a.pdf'}]})
+    assert resp.status == 400
+    resp = await client.post('/convert-batch', json={'items': [{'html': 'a'}], 'output': 'tar'})
+    assert resp.status == 400
+    resp = await client.get('/batch/unknown')
+    assert resp.status == 404
+
+
+async def test_full_queue_is_refused(client):
+    from pdfserver import server
+    from pdfserver.engine import QueueFull
+    with patch.object(server.render_engine, 'admit', side_effect=QueueFull(7)):
+        resp = await client.post('/convert-html', json={'html': TEST_HTML_RESPONSE})
+        assert resp.status == 429
+        assert resp.headers['Retry-After'] == '7'
+
+        resp = await client.post('/convert-html_sync', json={'html': TEST_HTML_RESPONSE})
+        assert resp.status == 429
+
+
+def _delayed_response(request):
+    from werkzeug import Response
+    time.sleep(0.2)
+    return Response(TEST_HTML_RESPONSE, content_type="text/html")
+
+
+async def test_queue_slots_are_reserved_on_admission(client, httpserver):
+    from pdfserver import server
+    from pdfserver.engine import RenderEngine
+    httpserver.expect_request("/delayed.html").respond_with_handler(_delayed_response)
+    engine = RenderEngine(workers=1, max_queued=2)
+    with patch.object(server, 'render_engine', engine):
+        try:
+            # The jobs are only submitted once the document was looked up
+            responses = await asyncio.gather(*(
+                client.post('/convert', json={'url': httpserver.url_for(f"/delayed.html?n={n}")})
+                for n in range(6)
+            ))
+            assert sorted(resp.status for resp in responses) == [200, 200, 429, 429, 429, 429]
+            for resp in responses:
+                if resp.status == 200:
+                    data = await wait_for_pdf(client, (await resp.json())['uid'])
+                    assert data['status'] == TaskStatus.COMPLETED.value
+            assert engine._reserved == 0
+        finally:
+            engine.shutdown()
+
+
+async def test_metrics(client, httpserver):
+    httpserver.expect_request("/test.html").respond_with_data(
+        TEST_HTML_RESPONSE,
+        content_type="text/html"
+    )
+    resp = await client.post('/convert_sync', json={'url': httpserver.url_for("/test.html")})
+    assert resp.status == 200
+
+    resp = await client.get('/metrics')
+    assert resp.status == 200
+    assert resp.content_type == 'text/plain'
+    text = await resp.text()
+    assert 'pdfserver_render_duration_seconds_count{endpoint="convert_sync",preset="default"}' in text
+    assert 'pdfserver_fetch_duration_seconds_count{host="localhost"}' in text
+    assert 'pdfserver_fetch_bytes_total{host="localhost"}' in text
+    assert 'pdfserver_pdf_size_bytes_count' in text
+    assert 'pdfserver_queue_depth 0' in text
+
+
+async def wait_for_pdf(client, uid):
+    return await (await client.get(f'/status/{uid}?wait=5')).json()
+
+
+async def test_status_reports_render_stats(client):
+    resp = await client.post('/convert-html', json={'html': TEST_HTML_RESPONSE + '<p>stats</p>'})
+    data = await wait_for_pdf(client, (await resp.json())['uid'])
+    assert data['status'] == TaskStatus.COMPLETED.value
+    assert set(data['stats']) >= {'parse', 'render', 'write_pdf', 'fetch', 'peak_memory', 'size'}
+    assert 'profile' not in data
+
+
+async def test_render_presets(client):
+    resp = await client.post('/convert-html', json={'html': TEST_HTML_RESPONSE, 'preset': 'tiny'})
+    assert resp.status == 400
+    assert (await resp.json())['error'] == 'Preset must be one of default, screen, ebook, print'
+    resp = await client.post('/convert-html_sync', json={
+        'html': TEST_HTML_RESPONSE, 'options': {'jpeg_quality': 200},
+    })
+    assert resp.status == 400
+    assert (await resp.json())['error'] == 'Option jpeg_quality must be an integer from 1 to 95'
+
+    resp = await client.post('/convert-html', json={
+        'html': TEST_HTML_RESPONSE + '<p>presets</p>', 'preset': 'screen', 'options': {'dpi': 72},
+    })
+    data = await wait_for_pdf(client, (await resp.json())['uid'])
+    assert data['status'] == TaskStatus.COMPLETED.value
+    assert data['stats']['preset'] == 'screen'
+
+    resp = await client.get('/metrics')
+    assert 'pdfserver_pdf_size_bytes_count{preset="screen"} 1' in await resp.text()
+
+
+async def test_profile_render(client, tmp_path):
+    import pstats
+    resp = await client.post('/convert-html', json={'html': TEST_HTML_RESPONSE, 'profile': 'cprofile'})
+    assert resp.status == 400
+
+    with patch('pdfserver.config.PROFILING', 1):
+        resp = await client.post('/convert-html', json={'html': TEST_HTML_RESPONSE, 'profile': 'gprof'})
+        assert resp.status == 400
+        resp = await client.post('/convert-html_sync', json={'html': TEST_HTML_RESPONSE, 'profile': 'cprofile'})
+        assert resp.status == 400
+        resp = await client.post('/convert-html', json={'html': TEST_HTML_RESPONSE, 'profile': 'cprofile'})
+    data = await wait_for_pdf(client, (await resp.json())['uid'])
+    assert data['status'] == TaskStatus.COMPLETED.value
+
+    resp = await client.get(data['profile'])
+    assert resp.status == 200
+    path = tmp_path / 'render.prof'
+    path.write_bytes(await resp.read())
+    assert pstats.Stats(str(path)).total_calls > 0
+
+
+async def test_status_long_poll_returns_on_completion(client):
+    resp = await client.post('/convert-html', json={'html': '<p>long poll</p>'})
+    uid = (await resp.json())['uid']
+
+    start = time.monotonic()
+    resp = await client.get(f'/status/{uid}?wait=10')
+    data = await resp.json()
+    assert data['status'] == TaskStatus.COMPLETED.value
+    assert time.monotonic() - start < 5
+
+    resp = await client.get(f'/status/{uid}?wait=soon')
+    assert resp.status == 400
+
+
+async def test_status_events(client):
+    import json
+    uids = []
+    for html in ('<p>events 1</p>', '<p>events 2</p>'):
+        resp = await client.post('/convert-html', json={'html': html})
+        uids.append((await resp.json())['uid'])
+
+    resp = await client.get(f'/events?ids={",".join(uids)},unknown')
+    assert resp.content_type == 'text/event-stream'
+    events = [
+        json.loads(line[len('data: '):])
+        for line in (await resp.text()).splitlines()
+        if line.startswith('data: ')
+    ]
+    finished = {event['uid']: event for event in events if event.get('status') != 'running'}
+    assert finished['unknown']['error'] == 'PDF not found'
+    assert all(finished[uid]['status'] == TaskStatus.COMPLETED.value for uid in uids)
+
+
+async def wait_for_callbacks(httpserver, count):
+    for _ in range(50):
+        requests = [request for request, _ in httpserver.log if request.path == '/hook']
+        if len(requests) >= count:
+            return requests
+        await asyncio.sleep(0.1)
+    return requests
+
+
+async def test_callback_with_download_link(client, httpserver):
+    from pdfserver import server
+    httpserver.expect_request('/hook', method='POST').respond_with_data('OK')
+    resp = await client.post('/convert-html', json={
+        'html': TEST_HTML_RESPONSE, 'filename': 'hook.pdf', 'callback': httpserver.url_for('/hook'),
+    })
+    uid = (await resp.json())['uid']
+    try:
+        [request] = await wait_for_callbacks(httpserver, 1)
+    finally:
+        await server.webhook_sender.close()
+    data = request.get_json()
+    assert data['uid'] == uid
+    assert data['status'] == TaskStatus.COMPLETED.value
+    assert data['download'].startswith('http://')
+    assert data['download'].endswith(f'/pdf/{uid}')
+
+
+async def test_callback_links_use_the_public_origin(client, httpserver):
+    from pdfserver import config
+    from pdfserver import server
+    httpserver.expect_request('/hook', method='POST').respond_with_data('OK')
+    payload = {'html': TEST_HTML_RESPONSE, 'callback': httpserver.url_for('/hook')}
+    try:
+        resp = await client.post('/convert-html', json=payload, headers={
+            'X-Forwarded-Proto': 'https', 'X-Forwarded-Host': 'pdf.example.com, proxy.local',
+        })
+        uid = (await resp.json())['uid']
+        [request] = await wait_for_callbacks(httpserver, 1)
+        assert request.get_json()['download'] == f'https://pdf.example.com/pdf/{uid}'
+
+        with patch.object(config, 'PUBLIC_URL', 'https://example.com/pdfs/'):
+            resp = await client.post('/convert-html', json=payload)
+        uid = (await resp.json())['uid']
+        request = (await wait_for_callbacks(httpserver, 2))[1]
+        assert request.get_json()['download'] == f'https://example.com/pdfs/pdf/{uid}'
+    finally:
+        await server.webhook_sender.close()
+
+
+async def test_callback_with_pdf_is_retried(client, httpserver):
+    import json
+    from pdfserver import server
+    httpserver.expect_oneshot_request('/hook', method='POST').respond_with_data('Busy', status=503)
+    httpserver.expect_request('/hook', method='POST').respond_with_data('OK')
+    with patch.object(server.webhook_sender, 'backoff', 0.01):
+        resp = await client.post('/convert-html', json={
+            'html': TEST_HTML_RESPONSE, 'callback': httpserver.url_for('/hook'),
+            'callback_mode': 'pdf',
+        })
+        uid = (await resp.json())['uid']
+        try:
+            requests = await wait_for_callbacks(httpserver, 2)
+        finally:
+            await server.webhook_sender.close()
+    assert len(requests) == 2
+    assert requests[1].content_type == 'application/pdf'
+    assert requests[1].get_data().startswith(b'%PDF-')
+    assert json.loads(requests[1].headers['X-PDF-Status'])['uid'] == uid
+
+
+async def test_callback_pdf_outlives_its_job(client, httpserver):
+    from pdfserver import server
+    httpserver.expect_oneshot_request('/hook', method='POST').respond_with_data('Busy', status=503)
+    httpserver.expect_request('/hook', method='POST').respond_with_data('OK')
+    with patch.object(server.webhook_sender, 'backoff', 0.5):
+        resp = await client.post('/convert-html', json={
+            'html': TEST_HTML_RESPONSE + '<p>removed</p>', 'callback': httpserver.url_for('/hook'),
+            'callback_mode': 'pdf',
+        })
+        uid = (await resp.json())['uid']
+        try:
+            await wait_for_callbacks(httpserver, 1)
+            # Removed (e.g. evicted) before the retry
+            server.pdf_cache._remove(uid)
+            requests = await wait_for_callbacks(httpserver, 2)
+        finally:
+            await server.webhook_sender.close()
+    assert requests[1].get_data().startswith(b'%PDF-')
+
+
+async def test_invalid_callback(client):
+    resp = await client.post('/convert-html', json={'html': TEST_HTML_RESPONSE, 'callback': 'file:///etc'})
+    assert resp.status == 400
+
+
+async def test_convert_html_raw_body(client):
+    resp = await client.post(
+        '/convert-html_sync?filename=raw.pdf&css=h1{color:red}',
+        data=TEST_HTML_RESPONSE.encode(), headers={'Content-Type': 'text/html; charset=utf-8'},
+    )
+    assert resp.status == 200
+    assert resp.headers['Content-Disposition'] == 'attachment; filename="raw.pdf"'
+    assert (await resp.read()).startswith(b'%PDF-')
+
+
+async def test_convert_html_compressed_body(client):
+    import gzip
+    resp = await client.post(
+        '/convert-html',
+        data=gzip.compress(TEST_HTML_RESPONSE.encode()),
+        headers={'Content-Type': 'text/html', 'Content-Encoding': 'gzip'},
+    )
+    assert resp.status == 200
+    uid = (await resp.json())['uid']
+    status_data = await wait_for_pdf(client, uid)
+    assert status_data['status'] == TaskStatus.COMPLETED.value
+
+
+async def test_convert_html_multipart_upload(client, tmp_path):
+    from aiohttp import FormData
+    from pdfserver import config
+    form = FormData()
+    form.add_field('html', TEST_HTML_RESPONSE.encode(), filename='page.html', content_type='text/html')
+    form.add_field('css', 'h1 { color: blue; }')
+    form.add_field('filename', 'upload.pdf')
+    form.add_field('options', '{"dpi": 96}')
+    with patch.object(config, 'SPOOL_DIR', str(tmp_path)):
+        resp = await client.post('/convert-html_sync', data=form)
+        assert resp.status == 200
+        assert resp.headers['Content-Disposition'] == 'attachment; filename="upload.pdf"'
+        assert (await resp.read()).startswith(b'%PDF-')
+    await asyncio.sleep(0.1)
+    assert not list(tmp_path.glob('*.html'))
+
+
+async def test_convert_html_body_too_large(client, tmp_path):
+    from pdfserver import config
+    with patch.object(config, 'HTML_MAX_BYTES', 100), patch.object(config, 'SPOOL_DIR', str(tmp_path)):
+        resp = await client.post(
+            '/convert-html', data=b'<p>' + b'x' * 200, headers={'Content-Type': 'text/html'},
+        )
+    assert resp.status == 413
+    assert not list(tmp_path.glob('*.html'))
+
+
+async def test_ready_after_warm_up(client):
+    from pdfserver import server
+    from pdfserver.engine import RenderEngine
+    from pdfserver.worker import warm_up
+    engine = RenderEngine(workers=1, warmup=warm_up)
+    with patch.object(server, 'render_engine', engine):
+        try:
+            resp = await client.get('/ready')
+            assert resp.status == 503
+            assert (await resp.json())['ready'] is False
+            engine.start()
+            for _ in range(100):
+                resp = await client.get('/ready')
+                if resp.status == 200:
+                    break
+                await asyncio.sleep(0.1)
+            data = await resp.json()
+            assert data['ready'] is True
+            assert data['ready_after'] > 0
+            assert data['warmup'][0]['total'] > 0
+        finally:
+            engine.shutdown()
+
+
+SPLIT_CSS = (
+    '@page { size: A6; @bottom-center { content: "Page " counter(page) } }'
+    ' section, .more { break-before: page }'
+)
+# A title page and three parts of two pages each
+SPLIT_HTML = '<html><body><h1>Catalog</h1>' + ''.join(
+    f'<section><h2>Part {part}</h2><p class="more">Part {part} continued</p></section>'
+    for part in range(3)
+) + '</body></html>'
+
+
+def page_texts(pdf):
+    from io import BytesIO
+    from pypdf import PdfReader
+    return [page.extract_text() for page in PdfReader(BytesIO(pdf)).pages]
+
+
+async def test_split_document_is_rendered_in_chunks(client):
+    resp = await client.post('/convert-html', json={
+        'html': SPLIT_HTML, 'css': SPLIT_CSS, 'split': 'section',
+    })
+    data = await wait_for_pdf(client, (await resp.json())['uid'])
+    assert data['status'] == TaskStatus.COMPLETED.value
+    assert data['stats']['chunks'] == 3
+    assert data['stats']['passes'] == 2
+    texts = page_texts(await (await client.get(data['download'])).read())
+    assert len(texts) == 7
+    for number, text in enumerate(texts, 1):
+        assert f'Page {number}' in text
+
+    resp = await client.post('/convert-html_sync', json={'html': SPLIT_HTML, 'split': 'section['})
+    assert resp.status == 400
+    assert (await resp.json())['error'].startswith('Invalid split selector')
+
+
+async def test_documents_with_state_across_chunks_are_not_split(client):
+    css = SPLIT_CSS + ' h2 { counter-increment: part }'
+    resp = await client.post('/convert-html', json={'html': SPLIT_HTML, 'css': css, 'split': 'section'})
+    data = await wait_for_pdf(client, (await resp.json())['uid'])
+    assert data['status'] == TaskStatus.COMPLETED.value
+    assert 'chunks' not in data['stats']
+    texts = page_texts(await (await client.get(data['download'])).read())
+    assert [f'Page {number}' in text for number, text in enumerate(texts, 1)] == [True] * 7
+
+
+def test_chunks_continue_page_numbers():
+    from pdfserver import worker
+    document = ('html', SPLIT_HTML)
+    assert worker.plan_chunks(document, SPLIT_CSS, None, 'section') == (3, True)
+    assert worker.count_chunk_pages(document, SPLIT_CSS, None, None, 'section', 1) == 2
+    pdf = worker.render_chunk(document, SPLIT_CSS, None, None, 'section', 1, page_offset=3)
+    assert page_texts(pdf.read()) == ['Page 4', 'Page 5']
+
+
+async def test_convert_html_form_field_too_large(client):
+    from aiohttp import FormData
+    from pdfserver import config
+    form = FormData()
+    form.add_field('html', TEST_HTML_RESPONSE.encode(), filename='page.html', content_type='text/html')
+    form.add_field('css', 'h1 { color: blue; }' * 10)
+    with patch.object(config, 'FORM_FIELD_MAX_BYTES', 100):
+        resp = await client.post('/convert-html', data=form)
+    assert resp.status == 413
+    assert (await resp.json())['error'] == 'Field css exceeds 100 bytes'
+
+
+def test_crashing_server_processes_are_restarted_with_backoff():
+    import signal
+    from pdfserver import server
+    handlers = signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM)
+    sleeps = []
+    try:
+        with patch.object(server, 'serve', side_effect=RuntimeError('port in use')), \
+                patch.object(server, 'RESTART_ATTEMPTS', 3), \
+                patch.object(server.time, 'sleep', side_effect=sleeps.append):
+            assert server.serve_processes(1) == 1
+    finally:
+        signal.signal(signal.SIGINT, handlers[0])
+        signal.signal(signal.SIGTERM, handlers[1])
+    assert sleeps == [1, 2, 4]
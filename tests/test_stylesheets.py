@@ -0,0 +1,63 @@
+from pdfserver.stylesheets import StylesheetCache
+from pytest_httpserver import RequestMatcher
+from weasyprint.urls import URLFetchingError
+import pytest
+
+CSS_CONTENT = 'h1 { color: red; }'
+
+
+def test_fresh_stylesheet_is_not_fetched_again(httpserver):
+    httpserver.expect_request("/style.css").respond_with_data(CSS_CONTENT, content_type="text/css")
+    url = httpserver.url_for("/style.css")
+    cache = StylesheetCache(ttl=60)
+
+    css = cache.get(url)
+    assert cache.get(url) is css
+    assert cache.hits == 1
+    assert cache.misses == 1
+    httpserver.assert_request_made(RequestMatcher("/style.css"), count=1)
+
+
+def test_stale_stylesheet_is_revalidated_with_etag(httpserver):
+    httpserver.expect_request(
+        "/style.css", headers={'If-None-Match': '"v1"'}
+    ).respond_with_data('', status=304)
+    httpserver.expect_request("/style.css").respond_with_data(
+        CSS_CONTENT, content_type="text/css", headers={'ETag': '"v1"'}
+    )
+    url = httpserver.url_for("/style.css")
+    cache = StylesheetCache(ttl=0)
+
+    css = cache.get(url)
+    assert cache.get(url) is css
+    assert cache.hits == 1
+    httpserver.assert_request_made(RequestMatcher("/style.css"), count=2)
+
+
+def test_cache_control_no_store_is_respected(httpserver):
+    httpserver.expect_request("/style.css").respond_with_data(
+        CSS_CONTENT, content_type="text/css", headers={'Cache-Control': 'no-store'}
+    )
+    url = httpserver.url_for("/style.css")
+    cache = StylesheetCache(ttl=60)
+
+    cache.get(url)
+    cache.get(url)
+    assert cache.misses == 2
+    assert url not in cache.entries
+
+
+def test_cache_is_bounded(httpserver):
+    for name in ('a', 'b', 'c'):
+        httpserver.expect_request(f"/{name}.css").respond_with_data(CSS_CONTENT, content_type="text/css")
+    cache = StylesheetCache(max_entries=2, ttl=60)
+
+    for name in ('a', 'b', 'c'):
+        cache.get(httpserver.url_for(f"/{name}.css"))
+    assert list(cache.entries) == [httpserver.url_for("/b.css"), httpserver.url_for("/c.css")]
+
+
+def test_fetch_error(httpserver):
+    httpserver.expect_request("/missing.css").respond_with_data("Not Found", status=404)
+    with pytest.raises(URLFetchingError):
+        StylesheetCache().get(httpserver.url_for("/missing.css"))